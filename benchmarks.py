@@ -23,15 +23,22 @@ Requirements:
 
 Usage:
     $ python benchmarks.py --weights yolov5s.pt --img 640
+    $ python benchmarks.py --nms --img 640 --batch-size 32  # NMS engines only
+    $ python benchmarks.py --prefilter --weights yolov5s.pt --img 640  # Detect() prefilter only
+    $ python benchmarks.py --getitem --data coco128.yaml --img 640  # training dataloader samples only
 """
 
 import argparse
 import platform
 import sys
 import time
+import tracemalloc
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
+import torch
+import yaml
 
 FILE = Path(__file__).resolve()
 ROOT = FILE.parents[0]  # YOLOv5 root directory
@@ -40,11 +47,14 @@ if str(ROOT) not in sys.path:
 # ROOT = ROOT.relative_to(Path.cwd())  # relative
 
 import export
+from models.common import DetectMultiBackend
 from models.experimental import attempt_load
 from models.yolo import SegmentationModel
 from segment.val import run as val_seg
 from utils import notebook_init
-from utils.general import LOGGER, check_yaml, file_size, print_args
+from utils.dataloaders import LoadImages, LoadImagesAndLabels
+from utils.general import (LOGGER, Profile, check_dataset, check_yaml, file_size, non_max_suppression,
+                           non_max_suppression_numpy, print_args)
 from utils.torch_utils import select_device
 from val import run as val_det
 
@@ -59,6 +69,9 @@ def run(
         test=False,  # test exports only
         pt_only=False,  # test PyTorch only
         hard_fail=False,  # throw error on benchmark failure
+        nms=False,  # benchmark NMS engines only
+        prefilter=False,  # benchmark Detect() objectness prefilter only
+        getitem=False,  # benchmark training dataloader samples only
 ):
     y, t = [], time.time()
     device = select_device(device)
@@ -121,6 +134,9 @@ def test(
         test=False,  # test exports only
         pt_only=False,  # test PyTorch only
         hard_fail=False,  # throw error on benchmark failure
+        nms=False,  # benchmark NMS engines only
+        prefilter=False,  # benchmark Detect() objectness prefilter only
+        getitem=False,  # benchmark training dataloader samples only
 ):
     y, t = [], time.time()
     device = select_device(device)
@@ -143,6 +159,120 @@ def test(
     return py
 
 
+def run_nms(
+        imgsz=640,  # inference size (pixels)
+        batch_size=1,  # batch size
+        device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+        n=50,  # timed iterations per engine
+        **kwargs,  # unused run() arguments
+):
+    # Benchmark NMS engines on random YOLOv5 COCO-shaped predictions
+    y, t = [], time.time()
+    device = select_device(device)
+    na = 3 * sum((imgsz // s) ** 2 for s in (8, 16, 32))  # number of anchors, i.e. 25200 at 640
+    x = torch.rand(batch_size, na, 85, device=device)
+    x[..., :4] *= torch.tensor([imgsz, imgsz, imgsz / 4, imgsz / 4], device=device)  # xywh pixels
+    x[..., 4] **= 16  # sparse objectness, ~8% of anchors above conf_thres=0.25
+    xn = x.cpu().numpy()
+    engines = {
+        'torch': lambda: non_max_suppression(x.clone()),
+        'torch batched': lambda: non_max_suppression(x.clone(), batched=True),
+        'numpy': lambda: non_max_suppression_numpy(xn.copy())}
+    for name, f in engines.items():
+        try:
+            f()  # warmup
+            dt = Profile()
+            for _ in range(n):
+                with dt:
+                    f()
+            y.append([name, round(dt.t / n * 1E3, 2), round(dt.t / n / batch_size * 1E3, 2)])  # ms per batch, image
+        except Exception as e:
+            LOGGER.warning(f'WARNING ⚠️ NMS benchmark failure for {name}: {e}')
+            y.append([name, None, None])
+
+    # Print results
+    py = pd.DataFrame(y, columns=['Engine', 'NMS time (ms/batch)', 'NMS time (ms/image)'])
+    LOGGER.info(f'\nNMS benchmarks complete ({time.time() - t:.2f}s) at shape {tuple(x.shape)}')
+    LOGGER.info(str(py))
+    return py
+
+
+def run_prefilter(
+        weights=ROOT / 'yolov5s.pt',  # weights path
+        imgsz=640,  # inference size (pixels)
+        batch_size=1,  # batch size
+        device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
+        half=False,  # use FP16 half-precision inference
+        conf_thres=0.25,  # confidence threshold
+        n=50,  # timed iterations per mode
+        **kwargs,  # unused run() arguments
+):
+    # Benchmark full Detect() decode vs objectness-prefiltered decode, inference + NMS on data/images
+    y, t = [], time.time()
+    device = select_device(device)
+    model = DetectMultiBackend(weights, device=device, fp16=half)
+    assert model.pt, 'prefilter benchmarks require PyTorch *.pt weights'
+    ims = [im for _, im, *_ in LoadImages(ROOT / 'data/images', img_size=imgsz, stride=model.stride, auto=False)]
+    im = torch.from_numpy(np.stack([ims[i % len(ims)] for i in range(batch_size)])).to(device)
+    im = (im.half() if model.fp16 else im.float()) / 255  # uint8 to fp16/32
+    for name, c in ('full decode', None), ('prefilter', conf_thres):
+        non_max_suppression(model(im, conf_thres=c)[0], conf_thres)  # warmup
+        dt = [Profile(), Profile()]
+        for _ in range(n):
+            with dt[0]:
+                pred = model(im, conf_thres=c)[0]
+            with dt[1]:
+                non_max_suppression(pred, conf_thres)
+        y.append([name, pred.shape[1], *(round(x.t / n * 1E3, 2) for x in dt)])  # candidates, ms per batch
+
+    # Print results
+    py = pd.DataFrame(y, columns=['Mode', 'Candidates', 'Inference (ms/batch)', 'NMS (ms/batch)'])
+    LOGGER.info(f'\nPrefilter benchmarks complete ({time.time() - t:.2f}s) at shape {tuple(im.shape)}')
+    LOGGER.info(str(py))
+    return py
+
+
+def run_getitem(
+        imgsz=640,  # image size (pixels)
+        data=ROOT / 'data/coco128.yaml',  # dataset.yaml path
+        hyp=ROOT / 'data/hyps/hyp.scratch-low.yaml',  # training hyperparameters
+        n=200,  # timed samples per mode
+        **kwargs,  # unused run() arguments
+):
+    # Benchmark training LoadImagesAndLabels.__getitem__() samples/s and peak bytes allocated per sample, with and
+    # without reused mosaic buffers. Images are cached in RAM so mosaic assembly and augmentation dominate
+    y, t = [], time.time()
+    data = check_dataset(data)
+    with open(hyp, errors='ignore') as f:
+        hyp = yaml.safe_load(f)
+    dataset = LoadImagesAndLabels(data['train'], imgsz, augment=True, hyp=hyp, cache_images='ram')
+    modes = {True: Profile(), False: Profile()}  # {reuse_buffers: timer}
+    for reuse in modes:  # warmup, touches cached images and allocates buffers
+        dataset.reuse_buffers = reuse
+        for i in range(min(n, len(dataset))):
+            dataset[i]
+    for i in range(0, n, 10):  # alternate modes in blocks of 10 samples so clock and cache drift affect both alike
+        for reuse, dt in modes.items():
+            dataset.reuse_buffers = reuse
+            with dt:
+                for j in range(i, min(i + 10, n)):
+                    dataset[j % len(dataset)]
+    for reuse, dt in modes.items():
+        dataset.reuse_buffers, mb = reuse, []
+        for i in range(min(n, 50)):
+            tracemalloc.start()
+            dataset[i % len(dataset)]
+            mb.append(tracemalloc.get_traced_memory()[1] / 1E6)  # peak MB allocated during sample
+            tracemalloc.stop()
+        y.append(['reused buffers' if reuse else 'new arrays', round(n / dt.t, 1), round(np.mean(mb), 2)])
+
+    # Print results
+    py = pd.DataFrame(y, columns=['Mode', 'Samples/s', 'Peak allocated (MB/sample)'])
+    LOGGER.info(f'\n__getitem__ benchmarks complete ({time.time() - t:.2f}s) at --img {imgsz}')
+    LOGGER.info(str(py))
+    return py
+
+
 def parse_opt():
     parser = argparse.ArgumentParser()
     parser.add_argument('--weights', type=str, default=ROOT / 'yolov5s.pt', help='weights path')
@@ -154,6 +284,9 @@ def parse_opt():
     parser.add_argument('--test', action='store_true', help='test exports only')
     parser.add_argument('--pt-only', action='store_true', help='test PyTorch only')
     parser.add_argument('--hard-fail', nargs='?', const=True, default=False, help='Exception on error or < min metric')
+    parser.add_argument('--nms', action='store_true', help='benchmark NMS engines only')
+    parser.add_argument('--prefilter', action='store_true', help='benchmark Detect() objectness prefilter only')
+    parser.add_argument('--getitem', action='store_true', help='benchmark training dataloader samples only')
     opt = parser.parse_args()
     opt.data = check_yaml(opt.data)  # check YAML
     print_args(vars(opt))
@@ -161,7 +294,12 @@ def parse_opt():
 
 
 def main(opt):
-    test(**vars(opt)) if opt.test else run(**vars(opt))
+    if opt.test:
+        test(**vars(opt))
+    elif opt.nms or opt.prefilter or opt.getitem:
+        (run_nms if opt.nms else run_prefilter if opt.prefilter else run_getitem)(**vars(opt))
+    else:
+        run(**vars(opt))
 
 
 if __name__ == "__main__":
@@ -32,6 +32,7 @@ import platform
 import sys
 from pathlib import Path
 
+import numpy as np
 import torch
 
 FILE = Path(__file__).resolve()
@@ -42,8 +43,10 @@ ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 
 from models.common import DetectMultiBackend
 from utils.dataloaders import IMG_FORMATS, VID_FORMATS, LoadImages, LoadScreenshots, LoadStreams
-from utils.general import (LOGGER, Profile, check_file, check_img_size, check_imshow, check_requirements, colorstr, cv2,
-                           increment_path, non_max_suppression, print_args, scale_boxes, strip_optimizer, xyxy2xywh)
+from utils.general import (DETECTIONS_FORMATS, LOGGER, NMS_METHODS, DetectionsWriter, LabelWriter, NMSStats, Profile,
+                           Stage, check_file, check_img_size, check_imshow, check_requirements, colorstr, cv2,
+                           increment_path, nms_cost, non_max_suppression, non_max_suppression_numpy, prefetch,
+                           print_args, scale_boxes, strip_optimizer)
 from utils.plots import Annotator, colors, save_one_box
 from utils.torch_utils import select_device, smart_inference_mode
 
@@ -57,11 +60,16 @@ def run(
         conf_thres=0.25,  # confidence threshold
         iou_thres=0.45,  # NMS IOU threshold
         max_det=1000,  # maximum detections per image
+        nms_budget=None,  # NMS latency target per image (ms), truncates pre-NMS boxes instead of dropping images
+        nms='hard',  # NMS method: hard, merge, soft, matrix or wbf
         device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
         view_img=False,  # show results
         save_txt=False,  # save results to *.txt
         save_conf=False,  # save confidences in --save-txt labels
+        save_txt_file=None,  # (optional) append all --save-txt labels to this one file, prefixed by image name
+        save_txt_async=False,  # write --save-txt labels in a background thread
         save_crop=False,  # save cropped prediction boxes
+        save_detections=None,  # (optional) save detections to a columnar file: npz, parquet or arrow
         nosave=False,  # do not save images/videos
         classes=None,  # filter by class: --class 0, or --class 0 2 3
         agnostic_nms=False,  # class-agnostic NMS
@@ -77,6 +85,11 @@ def run(
         half=False,  # use FP16 half-precision inference
         dnn=False,  # use OpenCV DNN for ONNX inference
         vid_stride=1,  # video frame-rate stride
+        numpy=False,  # NumPy pre-process, inference and NMS for non-PyTorch backends
+        batch_size=1,  # batch size for image and video sources
+        rect=False,  # rectangular batches of aspect-ratio sorted images, with --batch-size
+        prefilter=False,  # decode only anchors with objectness > conf-thres in Detect() (PyTorch only)
+        pipeline_depth=0,  # overlap decode, inference and results writing with this many queued batches, 0 = serial
 ):
     source = str(source)
     save_img = not nosave and not source.endswith('.txt')  # save inference images
@@ -96,6 +109,12 @@ def run(
     model = DetectMultiBackend(weights, device=device, dnn=dnn, data=data, fp16=half)
     stride, names, pt = model.stride, model.names, model.pt
     imgsz = check_img_size(imgsz, s=stride)  # check image size
+    if numpy and not model.numpy_io:
+        LOGGER.warning('WARNING ⚠️ --numpy requires a non-PyTorch backend, i.e. ONNX or OpenVINO, ignoring')
+        numpy = False
+    if numpy and (nms != 'hard' or nms_budget):
+        LOGGER.warning(f'WARNING ⚠️ --numpy runs hard NMS only, ignoring --nms {nms} and --nms-budget {nms_budget}')
+        nms, nms_budget = 'hard', None
 
     # Dataloader
     bs = 1  # batch_size
@@ -106,51 +125,44 @@ def run(
     elif screenshot:
         dataset = LoadScreenshots(source, img_size=imgsz, stride=stride, auto=pt)
     else:
-        dataset = LoadImages(source, img_size=imgsz, stride=stride, auto=pt, vid_stride=vid_stride)
+        dataset = LoadImages(source,
+                             img_size=imgsz,
+                             stride=stride,
+                             auto=pt,
+                             vid_stride=vid_stride,
+                             batch_size=batch_size,
+                             rect=rect)
+        bs = batch_size
     vid_path, vid_writer = [None] * bs, [None] * bs
+    label_writer = None  # --save-txt labels
+    if save_txt:
+        label_writer = LabelWriter(save_dir / 'labels', save_conf, file=save_txt_file, threaded=save_txt_async)
+    det_writer = DetectionsWriter(save_dir / f'detections.{save_detections}') if save_detections else None
 
-    # Run inference
-    model.warmup(imgsz=(1 if pt or model.triton else bs, 3, *imgsz))  # warmup
-    seen, windows, dt = 0, [], (Profile(), Profile(), Profile())
-    for path, im, im0s, vid_cap, s in dataset:
-        with dt[0]:
-            im = torch.from_numpy(im).to(model.device)
-            im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
-            im /= 255  # 0 - 255 to 0.0 - 1.0
-            if len(im.shape) == 3:
-                im = im[None]  # expand for batch dim
-
-        # Inference
-        with dt[1]:
-            visualize = increment_path(save_dir / Path(path).stem, mkdir=True) if visualize else False
-            pred = model(im, augment=augment, visualize=visualize)
-
-        # NMS
-        with dt[2]:
-            pred = non_max_suppression(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
-
-        # Second-stage classifier (optional)
-        # pred = utils.general.apply_classifier(pred, classifier_model, im, im0s)
-
-        # Process predictions
+    # Process predictions
+    @smart_inference_mode()  # inference tensors are edited in place, also in the writer thread
+    def write_results(path, shape, im0s, vid_cap, s, mode, frame, pred, nms_stats, dt_infer):
+        batch_s, batch_frame = (s, frame) if isinstance(s, list) else (None, None)  # LoadImages batch
         for i, det in enumerate(pred):  # per image
-            seen += 1
             if webcam:  # batch_size >= 1
-                p, im0, frame = path[i], im0s[i].copy(), dataset.count
+                p, im0, v = path[i], im0s[i].copy(), i
                 s += f'{i}: '
+            elif batch_s:  # one string and frame per image, one video writer
+                p, im0, v, s, frame = path[i], im0s[i].copy(), 0, batch_s[i], batch_frame[i]
             else:
-                p, im0, frame = path, im0s.copy(), getattr(dataset, 'frame', 0)
+                p, im0, v = path, im0s.copy(), 0
 
             p = Path(p)  # to Path
             save_path = str(save_dir / p.name)  # im.jpg
-            txt_path = str(save_dir / 'labels' / p.stem) + ('' if dataset.mode == 'image' else f'_{frame}')  # im.txt
-            s += '%gx%g ' % im.shape[2:]  # print string
-            gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
+            txt_name = p.stem + ('' if mode == 'image' else f'_{frame}')  # im.txt
+            s += '%gx%g ' % shape  # print string
+            if nms_stats and nms_stats.truncated[i]:
+                s += f'{nms_stats.truncated[i]} boxes over NMS top-{nms_stats.k}, '
             imc = im0.copy() if save_crop else im0  # for save_crop
             annotator = Annotator(im0, line_width=line_thickness, example=str(names))
             if len(det):
                 # Rescale boxes from img_size to im0 size
-                det[:, :4] = scale_boxes(im.shape[2:], det[:, :4], im0.shape).round()
+                det[:, :4] = scale_boxes(shape, det[:, :4], im0.shape).round()
 
                 # Print results
                 for c in det[:, 5].unique():
@@ -158,13 +170,11 @@ def run(
                     s += f"{n} {names[int(c)]}{'s' * (n > 1)}, "  # add to string
 
                 # Write results
+                if save_txt:  # Write to file
+                    label_writer.write(txt_name, det.flip(0), im0.shape)
+                if det_writer:
+                    det_writer.write(txt_name, det)
                 for *xyxy, conf, cls in reversed(det):
-                    if save_txt:  # Write to file
-                        xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
-                        line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
-                        with open(f'{txt_path}.txt', 'a') as f:
-                            f.write(('%g ' * len(line)).rstrip() % line + '\n')
-
                     if save_img or save_crop or view_img:  # Add bbox to image
                         c = int(cls)  # integer class
                         label = None if hide_labels else (names[c] if hide_conf else f'{names[c]} {conf:.2f}')
@@ -184,13 +194,13 @@ def run(
 
             # Save results (image with detections)
             if save_img:
-                if dataset.mode == 'image':
+                if mode == 'image':
                     cv2.imwrite(save_path, im0)
                 else:  # 'video' or 'stream'
-                    if vid_path[i] != save_path:  # new video
-                        vid_path[i] = save_path
-                        if isinstance(vid_writer[i], cv2.VideoWriter):
-                            vid_writer[i].release()  # release previous video writer
+                    if vid_path[v] != save_path:  # new video
+                        vid_path[v] = save_path
+                        if isinstance(vid_writer[v], cv2.VideoWriter):
+                            vid_writer[v].release()  # release previous video writer
                         if vid_cap:  # video
                             fps = vid_cap.get(cv2.CAP_PROP_FPS)
                             w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
@@ -198,17 +208,90 @@ def run(
                         else:  # stream
                             fps, w, h = 30, im0.shape[1], im0.shape[0]
                         save_path = str(Path(save_path).with_suffix('.mp4'))  # force *.mp4 suffix on results videos
-                        vid_writer[i] = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
-                    vid_writer[i].write(im0)
+                        vid_writer[v] = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (w, h))
+                    vid_writer[v].write(im0)
+
+            if batch_s:  # print time (batch inference-only)
+                LOGGER.info(f"{s}{'' if len(det) else '(no detections), '}{dt_infer * 1E3:.1f}ms")
 
         # Print time (inference-only)
-        LOGGER.info(f"{s}{'' if len(det) else '(no detections), '}{dt[1].dt * 1E3:.1f}ms")
+        if not batch_s:
+            LOGGER.info(f"{s}{'' if len(det) else '(no detections), '}{dt_infer * 1E3:.1f}ms")
+
+    def state(x):  # dataset item with its (mode, frame), read at decode time
+        frame = dataset.count if webcam else dataset.batch_frames if bs > 1 else getattr(dataset, 'frame', 0)
+        return (*x, dataset.mode, frame)
+
+    # Run inference
+    model.warmup(imgsz=(1 if pt or model.triton else bs, 3, *imgsz))  # warmup
+    if nms_budget and not numpy:
+        nms_cost(model.device)  # measure NMS cost for --nms-budget before timed inference
+    seen, windows, dt = 0, [], (Profile(), Profile(), Profile())
+    if pipeline_depth and view_img:
+        LOGGER.warning('WARNING ⚠️ --pipeline-depth is not supported with --view-img, running serially')
+        pipeline_depth = 0
+    if pipeline_depth:  # decode, inference and results writing overlap in separate threads
+        dt += (Profile(cuda=False), Profile(cuda=False))  # decode, write
+        stream = prefetch(dataset, pipeline_depth, dt[3], fn=state)
+        writer = Stage(write_results, pipeline_depth, dt[4])
+    else:
+        stream, writer = map(state, dataset), None
+    for path, im, im0s, vid_cap, s, mode, frame in stream:
+        with dt[0]:
+            if numpy:
+                im = im.astype(np.float32) / 255  # uint8 to fp32, 0 - 255 to 0.0 - 1.0
+            else:
+                im = torch.from_numpy(im).to(model.device)
+                im = im.half() if model.fp16 else im.float()  # uint8 to fp16/32
+                im /= 255  # 0 - 255 to 0.0 - 1.0
+            if len(im.shape) == 3:
+                im = im[None]  # expand for batch dim
+
+        # Inference
+        with dt[1]:
+            visualize = increment_path(save_dir / Path(path if isinstance(path, str) else path[0]).stem,
+                                       mkdir=True) if visualize else False
+            pred = model(im, augment=augment, visualize=visualize, conf_thres=conf_thres if prefilter else None)
+
+        # NMS
+        with dt[2]:
+            budget = nms_budget / 1E3 if nms_budget else None  # ms to seconds
+            if numpy:
+                pred = non_max_suppression_numpy(pred, conf_thres, iou_thres, classes, agnostic_nms, max_det=max_det)
+                pred, nms_stats = [torch.from_numpy(x) for x in pred], None  # zero-copy views for results handling
+            else:
+                nms_stats = NMSStats() if budget else None
+                pred = non_max_suppression(pred,
+                                           conf_thres,
+                                           iou_thres,
+                                           classes,
+                                           agnostic_nms,
+                                           max_det=max_det,
+                                           budget=budget,
+                                           method=nms,
+                                           stats=nms_stats)
+
+        # Second-stage classifier (optional)
+        # pred = utils.general.apply_classifier(pred, classifier_model, im, im0s)
+
+        seen += len(pred)
+        args = path, im.shape[2:], im0s, vid_cap, s, mode, frame, pred, nms_stats, dt[1].dt
+        writer.put(args) if writer else write_results(*args)
+    if writer:
+        writer.close()  # flush queued results
+    if label_writer:
+        label_writer.close()  # flush buffered labels
+    if det_writer:
+        det_writer.close()  # flush last row group
 
     # Print results
     t = tuple(x.t / seen * 1E3 for x in dt)  # speeds per image
-    LOGGER.info(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per image at shape {(1, 3, *imgsz)}' % t)
+    LOGGER.info(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per image at shape {(1, 3, *imgsz)}' % t[:3])
+    if pipeline_depth:
+        LOGGER.info('Pipeline: %.1fms decode, %.1fms write per image (overlapped with inference)' % t[3:])
     if save_txt or save_img:
         s = f"\n{len(list(save_dir.glob('labels/*.txt')))} labels saved to {save_dir / 'labels'}" if save_txt else ''
+        s = f'\nlabels saved to {save_txt_file}' if save_txt and save_txt_file else s
         LOGGER.info(f"Results saved to {colorstr('bold', save_dir)}{s}")
     if update:
         strip_optimizer(weights[0])  # update model (to fix SourceChangeWarning)
@@ -223,10 +306,15 @@ def parse_opt():
     parser.add_argument('--conf-thres', type=float, default=0.25, help='confidence threshold')
     parser.add_argument('--iou-thres', type=float, default=0.45, help='NMS IoU threshold')
     parser.add_argument('--max-det', type=int, default=1000, help='maximum detections per image')
+    parser.add_argument('--nms-budget', type=float, default=None, help='NMS latency target per image (ms)')
+    parser.add_argument('--nms', default='hard', choices=NMS_METHODS, help='NMS method')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     parser.add_argument('--view-img', action='store_true', help='show results')
     parser.add_argument('--save-txt', action='store_true', help='save results to *.txt')
     parser.add_argument('--save-conf', action='store_true', help='save confidences in --save-txt labels')
+    parser.add_argument('--save-txt-file', type=str, default=None, help='append --save-txt labels to one file')
+    parser.add_argument('--save-txt-async', action='store_true', help='write --save-txt labels in a background thread')
+    parser.add_argument('--save-detections', choices=DETECTIONS_FORMATS, help='save detections to a columnar file')
     parser.add_argument('--save-crop', action='store_true', help='save cropped prediction boxes')
     parser.add_argument('--nosave', action='store_true', help='do not save images/videos')
     parser.add_argument('--classes', nargs='+', type=int, help='filter by class: --classes 0, or --classes 0 2 3')
@@ -243,6 +331,11 @@ def parse_opt():
     parser.add_argument('--half', action='store_true', help='use FP16 half-precision inference')
     parser.add_argument('--dnn', action='store_true', help='use OpenCV DNN for ONNX inference')
     parser.add_argument('--vid-stride', type=int, default=1, help='video frame-rate stride')
+    parser.add_argument('--numpy', action='store_true', help='NumPy pre-process and NMS for non-PyTorch backends')
+    parser.add_argument('--prefilter', action='store_true', help='decode only anchors above conf-thres in Detect()')
+    parser.add_argument('--batch-size', type=int, default=1, help='batch size for image and video sources')
+    parser.add_argument('--rect', action='store_true', help='rectangular batches of aspect-ratio sorted images')
+    parser.add_argument('--pipeline-depth', type=int, default=0, help='overlap decode/infer/write, queued batches')
     opt = parser.parse_args()
     opt.imgsz *= 2 if len(opt.imgsz) == 1 else 1  # expand
     print_args(vars(opt))
@@ -27,13 +27,26 @@ from torch.cuda import amp
 
 from utils import TryExcept
 from utils.dataloaders import exif_transpose, letterbox
-from utils.general import (LOGGER, ROOT, Profile, check_requirements, check_suffix, check_version, colorstr,
-                           increment_path, is_notebook, make_divisible, non_max_suppression, scale_boxes, xywh2xyxy,
-                           xyxy2xywh, yaml_load)
+from utils.general import (LOGGER, ROOT, NMSStats, Profile, check_requirements, check_suffix, check_version, colorstr,
+                           increment_path, is_notebook, make_divisible, nms_cost, non_max_suppression,
+                           non_max_suppression_numpy, scale_boxes, xywh2xyxy, xyxy2xywh, yaml_load)
 from utils.plots import Annotator, colors, save_one_box
 from utils.torch_utils import copy_attr, smart_inference_mode
 
 
+@contextlib.contextmanager
+def detect_conf_thres(heads, conf_thres):
+    # Set the objectness prefilter of Detect() heads for one forward, restoring the previous values afterwards
+    previous = [m.conf_thres for m in heads]
+    for m in heads:
+        m.conf_thres = conf_thres
+    try:
+        yield
+    finally:
+        for m, c in zip(heads, previous):
+            m.conf_thres = c
+
+
 def autopad(k, p=None, d=1):  # kernel, padding, dilation
     # Pad to 'same' shape outputs
     if d > 1:
@@ -336,6 +349,7 @@ class DetectMultiBackend(nn.Module):
         pt, jit, onnx, xml, engine, coreml, saved_model, pb, tflite, edgetpu, tfjs, paddle, triton = self._model_type(w)
         fp16 &= pt or jit or onnx or engine  # FP16
         nhwc = coreml or saved_model or pb or tflite or edgetpu  # BHWC formats (vs torch BCWH)
+        numpy_io = not (pt or jit or engine or triton)  # backend runs on numpy arrays, accepts numpy inputs
         stride = 32  # default stride
         cuda = torch.cuda.is_available() and device.type != 'cpu'  # use CUDA
         if not (pt or triton):
@@ -346,6 +360,7 @@ class DetectMultiBackend(nn.Module):
             stride = max(int(model.stride.max()), 32)  # model stride
             names = model.module.names if hasattr(model, 'module') else model.names  # get class names
             model.half() if fp16 else model.float()
+            heads = [m for m in model.modules() if hasattr(m, 'conf_thres')]  # Detect() heads, objectness prefilter
             self.model = model  # explicitly assign for to(), cpu(), cuda(), half()
         elif jit:  # TorchScript
             LOGGER.info(f'Loading {w} for TorchScript inference...')
@@ -503,27 +518,34 @@ class DetectMultiBackend(nn.Module):
 
         self.__dict__.update(locals())  # assign all variables to self
 
-    def forward(self, im, augment=False, visualize=False):
-        # YOLOv5 MultiBackend inference
+    def forward(self, im, augment=False, visualize=False, conf_thres=None):
+        # YOLOv5 MultiBackend inference, optional conf_thres decodes only candidate anchors (PyTorch only)
         b, ch, h, w = im.shape  # batch, channel, height, width
-        if self.fp16 and im.dtype != torch.float16:
-            im = im.half()  # to FP16
-        if self.nhwc:
-            im = im.permute(0, 2, 3, 1)  # torch BCHW to numpy BHWC shape(1,320,192,3)
+        numpy = isinstance(im, np.ndarray)  # numpy in, numpy out (non-torch backends only)
+        if numpy:
+            assert self.numpy_io, 'numpy inputs require a non-PyTorch backend, i.e. ONNX, OpenVINO or TFLite'
+            im = im.astype(np.float16) if self.fp16 else im  # to FP16
+            im = im.transpose(0, 2, 3, 1) if self.nhwc else im  # BCHW to BHWC
+        else:
+            if self.fp16 and im.dtype != torch.float16:
+                im = im.half()  # to FP16
+            if self.nhwc:
+                im = im.permute(0, 2, 3, 1)  # torch BCHW to numpy BHWC shape(1,320,192,3)
 
         if self.pt:  # PyTorch
-            y = self.model(im, augment=augment, visualize=visualize) if augment or visualize else self.model(im)
+            with detect_conf_thres(self.heads, None if augment else conf_thres):  # augment merges full-size outputs
+                y = self.model(im, augment=augment, visualize=visualize) if augment or visualize else self.model(im)
         elif self.jit:  # TorchScript
             y = self.model(im)
         elif self.dnn:  # ONNX OpenCV DNN
-            im = im.cpu().numpy()  # torch to numpy
+            im = self.to_numpy(im)  # torch to numpy
             self.net.setInput(im)
             y = self.net.forward()
         elif self.onnx:  # ONNX Runtime
-            im = im.cpu().numpy()  # torch to numpy
+            im = self.to_numpy(im)  # torch to numpy
             y = self.session.run(self.output_names, {self.session.get_inputs()[0].name: im})
         elif self.xml:  # OpenVINO
-            im = im.cpu().numpy()  # FP32
+            im = self.to_numpy(im)  # FP32
             y = list(self.executable_network([im]).values())
         elif self.engine:  # TensorRT
             if self.dynamic and im.shape != self.bindings['images'].shape:
@@ -539,7 +561,7 @@ class DetectMultiBackend(nn.Module):
             self.context.execute_v2(list(self.binding_addrs.values()))
             y = [self.bindings[x].data for x in sorted(self.output_names)]
         elif self.coreml:  # CoreML
-            im = im.cpu().numpy()
+            im = self.to_numpy(im)
             im = Image.fromarray((im[0] * 255).astype('uint8'))
             # im = im.resize((192, 320), Image.ANTIALIAS)
             y = self.model.predict({'image': im})  # coordinates are xywh normalized
@@ -550,14 +572,14 @@ class DetectMultiBackend(nn.Module):
             else:
                 y = list(reversed(y.values()))  # reversed for segmentation models (pred, proto)
         elif self.paddle:  # PaddlePaddle
-            im = im.cpu().numpy().astype(np.float32)
+            im = self.to_numpy(im).astype(np.float32)
             self.input_handle.copy_from_cpu(im)
             self.predictor.run()
             y = [self.predictor.get_output_handle(x).copy_to_cpu() for x in self.output_names]
         elif self.triton:  # NVIDIA Triton Inference Server
             y = self.model(im)
         else:  # TensorFlow (SavedModel, GraphDef, Lite, Edge TPU)
-            im = im.cpu().numpy()
+            im = self.to_numpy(im)
             if self.saved_model:  # SavedModel
                 y = self.model(im, training=False) if self.keras else self.model(im)
             elif self.pb:  # GraphDef
@@ -580,6 +602,8 @@ class DetectMultiBackend(nn.Module):
             y = [x if isinstance(x, np.ndarray) else x.numpy() for x in y]
             y[0][..., :4] *= [w, h, w, h]  # xywh normalized to pixels
 
+        if numpy:  # skip torch round-trip
+            return y[0] if isinstance(y, (list, tuple)) and len(y) == 1 else y
         if isinstance(y, (list, tuple)):
             return self.from_numpy(y[0]) if len(y) == 1 else [self.from_numpy(x) for x in y]
         else:
@@ -588,6 +612,10 @@ class DetectMultiBackend(nn.Module):
     def from_numpy(self, x):
         return torch.from_numpy(x).to(self.device) if isinstance(x, np.ndarray) else x
 
+    @staticmethod
+    def to_numpy(x):
+        return x.cpu().numpy() if isinstance(x, torch.Tensor) else x
+
     def warmup(self, imgsz=(1, 3, 640, 640)):
         # Warmup model by running inference once
         warmup_types = self.pt, self.jit, self.onnx, self.engine, self.saved_model, self.pb, self.triton
@@ -628,6 +656,10 @@ class AutoShape(nn.Module):
     multi_label = False  # NMS multiple labels per box
     classes = None  # (optional list) filter by class, i.e. = [0, 15, 16] for COCO persons, cats and dogs
     max_det = 1000  # maximum number of detections per image
+    nms_budget = None  # (optional) NMS latency target per image (ms), i.e. = 10, truncates pre-NMS boxes to a top-k
+    nms = 'hard'  # NMS method: hard, merge, soft, matrix or wbf
+    numpy = False  # NumPy pre-process, inference and NMS for non-PyTorch DetectMultiBackend models (no torch tensors)
+    prefilter = False  # decode only anchors with objectness > conf in Detect() (PyTorch models only)
     amp = False  # Automatic Mixed Precision (AMP) inference
 
     def __init__(self, model, verbose=True):
@@ -652,6 +684,7 @@ class AutoShape(nn.Module):
             m.grid = list(map(fn, m.grid))
             if isinstance(m.anchor_grid, list):
                 m.anchor_grid = list(map(fn, m.anchor_grid))
+            m._apply_grid_cache(fn)
         return self
 
     @smart_inference_mode()
@@ -665,6 +698,8 @@ class AutoShape(nn.Module):
         #   torch:           = torch.zeros(16,3,320,640)  # BCHW (scaled to size=640, 0-1 values)
         #   multiple:        = [Image.open('image1.jpg'), Image.open('image2.jpg'), ...]  # list of images
 
+        if self.nms_budget:  # measure NMS cost for nms_budget outside the timed NMS
+            nms_cost(next(self.model.parameters()).device if self.pt else self.model.device)
         dt = (Profile(), Profile(), Profile())
         with dt[0]:
             if isinstance(size, int):  # expand
@@ -697,31 +732,56 @@ class AutoShape(nn.Module):
             shape1 = [make_divisible(x, self.stride) for x in np.array(shape1).max(0)]  # inf shape
             x = [letterbox(im, shape1, auto=False)[0] for im in ims]  # pad
             x = np.ascontiguousarray(np.array(x).transpose((0, 3, 1, 2)))  # stack and BHWC to BCHW
-            x = torch.from_numpy(x).to(p.device).type_as(p) / 255  # uint8 to fp16/32
+            numpy = self.numpy and self.dmb and self.model.numpy_io  # NumPy end-to-end
+            assert not (numpy and (self.nms != 'hard' or self.nms_budget)), 'AutoShape.numpy runs hard NMS only, set ' \
+                "nms='hard' and nms_budget=None"
+            x = x.astype(np.float32) / 255 if numpy else torch.from_numpy(x).to(p.device).type_as(p) / 255  # to fp
 
         with amp.autocast(autocast):
             # Inference
             with dt[1]:
-                y = self.model(x, augment=augment)  # forward
+                conf_thres = self.conf if self.prefilter and self.pt and not augment else None  # Detect() prefilter
+                if self.dmb:
+                    y = self.model(x, augment=augment, conf_thres=conf_thres)  # forward
+                else:
+                    with detect_conf_thres([self.model.model[-1]], conf_thres):
+                        y = self.model(x, augment=augment)  # forward
 
             # Post-process
             with dt[2]:
-                y = non_max_suppression(y if self.dmb else y[0],
-                                        self.conf,
-                                        self.iou,
-                                        self.classes,
-                                        self.agnostic,
-                                        self.multi_label,
-                                        max_det=self.max_det)  # NMS
+                budget = self.nms_budget / 1E3 if self.nms_budget else None  # ms to seconds
+                if numpy:
+                    y = non_max_suppression_numpy(y,
+                                                  self.conf,
+                                                  self.iou,
+                                                  self.classes,
+                                                  self.agnostic,
+                                                  self.multi_label,
+                                                  max_det=self.max_det)  # NMS
+                    nms_stats = None
+                else:
+                    nms_stats = NMSStats() if budget else None
+                    y = non_max_suppression(y if self.dmb else y[0],
+                                            self.conf,
+                                            self.iou,
+                                            self.classes,
+                                            self.agnostic,
+                                            self.multi_label,
+                                            max_det=self.max_det,
+                                            budget=budget,
+                                            method=self.nms,
+                                            stats=nms_stats)  # NMS
                 for i in range(n):
                     scale_boxes(shape1, y[i][:, :4], shape0[i])
+                if numpy:
+                    y = [torch.from_numpy(x) for x in y]  # zero-copy views for Detections
 
-            return Detections(ims, y, files, dt, self.names, x.shape)
+            return Detections(ims, y, files, dt, self.names, x.shape, nms_stats)
 
 
 class Detections:
     # YOLOv5 detections class for inference results
-    def __init__(self, ims, pred, files, times=(0, 0, 0), names=None, shape=None):
+    def __init__(self, ims, pred, files, times=(0, 0, 0), names=None, shape=None, nms_stats=None):
         super().__init__()
         d = pred[0].device  # device
         gn = [torch.tensor([*(im.shape[i] for i in [1, 0, 1, 0]), 1, 1], device=d) for im in ims]  # normalizations
@@ -737,6 +797,7 @@ class Detections:
         self.n = len(self.pred)  # number of images (batch size)
         self.t = tuple(x.t / self.n * 1E3 for x in times)  # timestamps (ms)
         self.s = tuple(shape)  # inference BCHW shape
+        self.nms_stats = nms_stats  # (optional) NMSStats pre-NMS truncation counts
 
     def _run(self, pprint=False, show=False, save=False, crop=False, render=False, labels=True, save_dir=Path('')):
         s, crops = '', []
@@ -764,6 +825,8 @@ class Detections:
                     im = annotator.im
             else:
                 s += '(no detections)'
+            if self.nms_stats and self.nms_stats.truncated[i]:
+                s += f' ({self.nms_stats.truncated[i]} boxes over NMS top-{self.nms_stats.k})'
 
             im = Image.fromarray(im.astype(np.uint8)) if isinstance(im, np.ndarray) else im  # from np
             if show:
@@ -11,6 +11,7 @@ import contextlib
 import os
 import platform
 import sys
+from collections import OrderedDict
 from copy import deepcopy
 from pathlib import Path
 
@@ -40,6 +41,8 @@ class Detect(nn.Module):
     stride = None  # strides computed during build
     dynamic = False  # force grid reconstruction
     export = False  # export mode
+    conf_thres = None  # (optional) inference objectness threshold, decode only anchors above it
+    cache_size = 16  # grid shapes cached per detection layer (LRU)
 
     def __init__(self, nc=80, anchors=(), ch=(), inplace=True):  # detection layer
         super().__init__()
@@ -49,6 +52,7 @@ class Detect(nn.Module):
         self.na = len(anchors[0]) // 2  # number of anchors
         self.grid = [torch.empty(0) for _ in range(self.nl)]  # init grid
         self.anchor_grid = [torch.empty(0) for _ in range(self.nl)]  # init anchor grid
+        self.grid_cache = [OrderedDict() for _ in range(self.nl)]  # (ny, nx, dtype, device): (grid, anchor_grid)
         self.register_buffer('anchors', torch.tensor(anchors).float().view(self.nl, -1, 2))  # shape(nl,na,2)
         self.m = nn.ModuleList(nn.Conv2d(x, self.no * self.na, 1) for x in ch)  # output conv
         self.inplace = inplace  # use inplace ops (e.g. slice assignment)
@@ -62,8 +66,11 @@ class Detect(nn.Module):
 
             if not self.training:  # inference
                 if self.dynamic or self.grid[i].shape[2:4] != x[i].shape[2:4]:
-                    self.grid[i], self.anchor_grid[i] = self._make_grid(nx, ny, i)
+                    self.grid[i], self.anchor_grid[i] = self._cached_grid(nx, ny, i)
 
+                if self.conf_thres is not None:  # prefilter by objectness before decoding
+                    z.append(self._decode_candidates(x[i], i))
+                    continue
                 if isinstance(self, Segment):  # (boxes + masks)
                     xy, wh, conf, mask = x[i].split((2, 2, self.nc + 1, self.no - self.nc - 5), 4)
                     xy = (xy.sigmoid() * 2 + self.grid[i]) * self.stride[i]  # xy
@@ -76,7 +83,39 @@ class Detect(nn.Module):
                     y = torch.cat((xy, wh, conf), 4)
                 z.append(y.view(bs, self.na * nx * ny, self.no))
 
-        return x if self.training else (torch.cat(z, 1),) if self.export else (torch.cat(z, 1), x)
+        if self.training:
+            return x
+        z = self._pack_candidates(z, bs) if self.conf_thres is not None else torch.cat(z, 1)
+        return (z,) if self.export else (z, x)
+
+    def _decode_candidates(self, x, i):
+        # Decode anchors of level i with objectness > conf_thres only, returns (image index, (n,no) candidates)
+        t = min(max(self.conf_thres, 1E-6), 1 - 1E-6)
+        b, a, gy, gx = (x[..., 4] > math.log(t / (1 - t))).nonzero(as_tuple=True)  # threshold logits, no sigmoid
+        y = x[b, a, gy, gx]
+        grid, anchor_grid = self.grid[i][0, a, gy, gx], self.anchor_grid[i][0, a, gy, gx]  # (n,2)
+        if isinstance(self, Segment):  # (boxes + masks)
+            xy, wh, conf, mask = y.split((2, 2, self.nc + 1, self.no - self.nc - 5), 1)
+            xy = (xy.sigmoid() * 2 + grid) * self.stride[i]  # xy
+            wh = (wh.sigmoid() * 2) ** 2 * anchor_grid  # wh
+            y = torch.cat((xy, wh, conf.sigmoid(), mask), 1)
+        else:  # Detect (boxes only)
+            xy, wh, conf = y.sigmoid().split((2, 2, self.nc + 1), 1)
+            xy = (xy * 2 + grid) * self.stride[i]  # xy
+            wh = (wh * 2) ** 2 * anchor_grid  # wh
+            y = torch.cat((xy, wh, conf), 1)
+        return b, y
+
+    @staticmethod
+    def _pack_candidates(z, bs):
+        # Pack per-level (image index, candidates) into a (bs,n,no) tensor, zero-padded rows have zero objectness
+        b, y = (torch.cat(x, 0) for x in zip(*z))
+        i = b.argsort()  # group by image
+        b, y = b[i], y[i]
+        n = torch.bincount(b, minlength=bs)  # candidates per image
+        out = y.new_zeros((bs, int(n.max()), y.shape[1]))
+        out[b, torch.arange(len(b), device=b.device) - (n.cumsum(0) - n)[b]] = y  # index within image
+        return out
 
     def _make_grid(self, nx=20, ny=20, i=0, torch_1_10=check_version(torch.__version__, '1.10.0')):
         d = self.anchors[i].device
@@ -88,6 +127,33 @@ class Detect(nn.Module):
         anchor_grid = (self.anchors[i] * self.stride[i]).view((1, self.na, 1, 1, 2)).expand(shape)
         return grid, anchor_grid
 
+    def _cached_grid(self, nx=20, ny=20, i=0):
+        # Return layer i grids from an LRU cache keyed by (ny, nx, dtype, device), traced exports always rebuild
+        if torch.jit.is_tracing():
+            return self._make_grid(nx, ny, i)
+        if not hasattr(self, 'grid_cache'):  # models saved before grid caching
+            self.grid_cache = [OrderedDict() for _ in range(self.nl)]
+        cache, key = self.grid_cache[i], (ny, nx, self.anchors.dtype, self.anchors.device)
+        if key in cache:
+            cache.move_to_end(key)  # mark most recently used
+        else:
+            cache[key] = self._make_grid(nx, ny, i)
+            while len(cache) > self.cache_size:
+                cache.popitem(last=False)  # evict least recently used
+        return cache[key]
+
+    def __getstate__(self):
+        # Leave cached grids out of pickles (torch.save checkpoints, EMA deepcopy), _cached_grid() rebuilds them lazily
+        return {**self.__dict__, 'grid_cache': [OrderedDict() for _ in range(self.nl)]}
+
+    def _apply_grid_cache(self, fn):
+        # Apply to(), cpu(), cuda(), half() to cached grids and re-key them, avoids regeneration after device moves
+        for cache in getattr(self, 'grid_cache', ()):
+            grids = [(k[:2], tuple(map(fn, v))) for k, v in cache.items()]
+            cache.clear()
+            for (ny, nx), (grid, anchor_grid) in grids:
+                cache[ny, nx, grid.dtype, grid.device] = grid, anchor_grid
+
 
 class Segment(Detect):
     # YOLOv5 Segment head for segmentation models
@@ -159,6 +225,7 @@ class BaseModel(nn.Module):
             m.grid = list(map(fn, m.grid))
             if isinstance(m.anchor_grid, list):
                 m.anchor_grid = list(map(fn, m.anchor_grid))
+            m._apply_grid_cache(fn)
         return self
 
 
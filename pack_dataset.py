@@ -0,0 +1,107 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Pack a dataset split into sequential tar shards of pre-resized images for streaming training
+
+Shards are read front to back by each dataloader worker instead of one small random read per image and label file,
+which is much faster on network and object-store-backed volumes. Train from shards by pointing the data.yaml split at
+the output directory, i.e. `train: coco128/shards/train_640`, with the same --img used for packing.
+
+Usage:
+    $ python pack_dataset.py --data coco128.yaml --img 640 --split train
+    $ python pack_dataset.py --data coco128.yaml --img 640 --benchmark  # then compare dataloader throughput
+"""
+
+import argparse
+import os
+import sys
+from pathlib import Path
+
+import pandas as pd
+import yaml
+from tqdm import tqdm
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[0]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
+
+from utils.dataloaders import LoadImagesAndLabels, LoadShardedImagesAndLabels, create_dataloader
+from utils.general import LOGGER, TQDM_BAR_FORMAT, Profile, check_dataset, check_yaml, colorstr, print_args
+
+
+def run(
+        data=ROOT / 'data/coco128.yaml',  # dataset.yaml path
+        imgsz=640,  # image size (pixels) images are resized to, must match train.py --img
+        split='train',  # dataset split to pack
+        out='',  # output directory, default <dataset path>/shards/<split>_<imgsz>
+        shard_size=1024,  # max MB per shard
+        ext='.jpg',  # image encoding
+        benchmark=False,  # compare training dataloader throughput of files and shards after packing
+        batch_size=16,  # benchmark batch size
+        workers=8,  # benchmark max dataloader workers
+        hyp=ROOT / 'data/hyps/hyp.scratch-low.yaml',  # benchmark augmentation hyperparameters
+        batches=100,  # benchmark timed batches per loader
+):
+    data = check_dataset(data)
+    out = Path(out or Path(data['path']) / 'shards' / f'{split}_{imgsz}')
+    prefix = colorstr(f'{split}: ')
+    dataset = LoadImagesAndLabels(data[split], imgsz, augment=False, prefix=prefix)
+    b, gb = 0, 1 << 30  # bytes of packed images, bytes per gigabytes
+    pbar = tqdm(LoadShardedImagesAndLabels.write(out, dataset, shard_size << 20, ext),
+                total=dataset.n,
+                bar_format=TQDM_BAR_FORMAT)
+    for nb in pbar:
+        b += nb
+        pbar.desc = f'{prefix}Packing images ({b / gb:.2f}GB)'
+    pbar.close()
+    LOGGER.info(f"{prefix}{dataset.n} images packed into {len(list(out.glob('*.tar')))} shards in {out}")
+    if benchmark:
+        return run_benchmark(imgsz, {'files': data[split], 'shards': out}, batch_size, workers, hyp, batches)
+
+
+def run_benchmark(imgsz, paths, batch_size=16, workers=8, hyp=ROOT / 'data/hyps/hyp.scratch-low.yaml', batches=100):
+    # Training create_dataloader() images/s for each {name: path}, timed after the first batch has started the workers
+    with open(hyp, errors='ignore') as f:
+        hyp = yaml.safe_load(f)
+    y = []
+    for name, path in paths.items():
+        loader = create_dataloader(path, imgsz, batch_size, 32, hyp=hyp, augment=True, workers=workers, shuffle=True)[0]
+        iterator, dt, n = iter(loader), Profile(), 0
+        next(iterator)  # warmup
+        with dt:
+            for _, (imgs, *_) in zip(range(min(batches, len(loader) - 1)), iterator):
+                n += len(imgs)
+        y.append([name, str(path), n, round(n / dt.t, 1)])
+    py = pd.DataFrame(y, columns=['Loader', 'Path', 'Images', 'Images/s'])
+    LOGGER.info(f'\nDataloader throughput at --img {imgsz} --batch-size {batch_size} --workers {workers}\n{py}')
+    LOGGER.info('Images and shards were just read by packing and may be page cached, drop caches for a cold comparison')
+    return py
+
+
+def parse_opt():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', type=str, default=ROOT / 'data/coco128.yaml', help='dataset.yaml path')
+    parser.add_argument('--imgsz', '--img', '--img-size', type=int, default=640, help='train, val image size (pixels)')
+    parser.add_argument('--split', type=str, default='train', help='dataset split, i.e. train, val or test')
+    parser.add_argument('--out', type=str, default='', help='output directory, default <path>/shards/<split>_<imgsz>')
+    parser.add_argument('--shard-size', type=int, default=1024, help='max MB per shard')
+    parser.add_argument('--ext', type=str, default='.jpg', choices=['.jpg', '.png', '.webp'], help='image encoding')
+    parser.add_argument('--benchmark', action='store_true', help='compare files and shards dataloader throughput')
+    parser.add_argument('--batch-size', type=int, default=16, help='benchmark batch size')
+    parser.add_argument('--workers', type=int, default=8, help='benchmark max dataloader workers')
+    parser.add_argument('--hyp', type=str, default=ROOT / 'data/hyps/hyp.scratch-low.yaml', help='hyperparameters path')
+    parser.add_argument('--batches', type=int, default=100, help='benchmark timed batches per dataloader')
+    opt = parser.parse_args()
+    opt.data = check_yaml(opt.data)  # check YAML
+    print_args(vars(opt))
+    return opt
+
+
+def main(opt):
+    run(**vars(opt))
+
+
+if __name__ == "__main__":
+    opt = parse_opt()
+    main(opt)
@@ -42,10 +42,10 @@ import torch.nn.functional as F
 from models.common import DetectMultiBackend
 from models.yolo import SegmentationModel
 from utils.callbacks import Callbacks
-from utils.general import (LOGGER, NUM_THREADS, TQDM_BAR_FORMAT, Profile, check_dataset, check_img_size,
-                           check_requirements, check_yaml, coco80_to_coco91_class, colorstr, increment_path,
-                           non_max_suppression, print_args, scale_boxes, xywh2xyxy, xyxy2xywh)
-from utils.metrics import ConfusionMatrix, box_iou
+from utils.general import (DETECTIONS_FORMATS, LOGGER, NUM_THREADS, TQDM_BAR_FORMAT, DetectionsWriter, Profile,
+                           check_dataset, check_img_size, check_requirements, check_yaml, coco80_to_coco91_class,
+                           colorstr, increment_path, label_lines, non_max_suppression, print_args, scale_boxes, xywh2xyxy, xyxy2xywh)
+from utils.metrics import ConfusionMatrix, box_iou, match_predictions
 from utils.plots import output_to_target, plot_val_study
 from utils.segment.dataloaders import create_dataloader
 from utils.segment.general import mask_iou, process_mask, process_mask_upsample, scale_image
@@ -56,16 +56,13 @@ from utils.torch_utils import de_parallel, select_device, smart_inference_mode
 
 def save_one_txt(predn, save_conf, shape, file):
     # Save one txt result
-    gn = torch.tensor(shape)[[1, 0, 1, 0]]  # normalization gain whwh
-    for *xyxy, conf, cls in predn.tolist():
-        xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
-        line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
+    if len(predn):
         with open(file, 'a') as f:
-            f.write(('%g ' * len(line)).rstrip() % line + '\n')
+            f.write(label_lines(predn, shape, save_conf))  # one vectorized conversion and write per image
 
 
-def save_one_json(predn, jdict, path, class_map, pred_masks):
-    # Save one JSON result {"image_id": 42, "category_id": 18, "bbox": [258.15, 41.29, 348.26, 243.78], "score": 0.236}
+def encode_rles(pred_masks):
+    # Encode (h,w,n) native-space masks as n COCO RLE dicts with utf-8 counts
     from pycocotools.mask import encode
 
     def single_encode(x):
@@ -73,12 +70,15 @@ def save_one_json(predn, jdict, path, class_map, pred_masks):
         rle["counts"] = rle["counts"].decode("utf-8")
         return rle
 
+    with ThreadPool(NUM_THREADS) as pool:
+        return pool.map(single_encode, np.transpose(pred_masks, (2, 0, 1)))
+
+
+def save_one_json(predn, jdict, path, class_map, rles):
+    # Save one JSON result {"image_id": 42, "category_id": 18, "bbox": [258.15, 41.29, 348.26, 243.78], "score": 0.236}
     image_id = int(path.stem) if path.stem.isnumeric() else path.stem
     box = xyxy2xywh(predn[:, :4])  # xywh
     box[:, :2] -= box[:, 2:] / 2  # xy center to top-left corner
-    pred_masks = np.transpose(pred_masks, (2, 0, 1))
-    with ThreadPool(NUM_THREADS) as pool:
-        rles = pool.map(single_encode, pred_masks)
     for i, (p, b) in enumerate(zip(predn.tolist(), box.tolist())):
         jdict.append({
             'image_id': image_id,
@@ -110,19 +110,8 @@ def process_batch(detections, labels, iouv, pred_masks=None, gt_masks=None, over
     else:  # boxes
         iou = box_iou(labels[:, 1:], detections[:, :4])
 
-    correct = np.zeros((detections.shape[0], iouv.shape[0])).astype(bool)
     correct_class = labels[:, 0:1] == detections[:, 5]
-    for i in range(len(iouv)):
-        x = torch.where((iou >= iouv[i]) & correct_class)  # IoU > threshold and classes match
-        if x[0].shape[0]:
-            matches = torch.cat((torch.stack(x, 1), iou[x[0], x[1]][:, None]), 1).cpu().numpy()  # [label, detect, iou]
-            if x[0].shape[0] > 1:
-                matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
-                # matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
-            correct[matches[:, 1].astype(int), i] = True
-    return torch.tensor(correct, dtype=torch.bool, device=iouv.device)
+    return match_predictions(iou, correct_class, iouv)  # all IoU levels at once, on device
 
 
 @smart_inference_mode()
@@ -144,6 +133,7 @@ def run(
         save_hybrid=False,  # save label+prediction hybrid results to *.txt
         save_conf=False,  # save confidences in --save-txt labels
         save_json=False,  # save a COCO-JSON results file
+        save_detections=None,  # (optional) save detections and mask RLEs to a columnar file: npz, parquet or arrow
         project=ROOT / 'runs/val-seg',  # save to project/name
         name='exp',  # save to project/name
         exist_ok=False,  # existing project/name ok, do not increment
@@ -158,7 +148,7 @@ def run(
         compute_loss=None,
         callbacks=Callbacks(),
 ):
-    if save_json:
+    if save_json or save_detections:
         check_requirements(['pycocotools'])
         process = process_mask_upsample  # more accurate
     else:
@@ -236,6 +226,7 @@ def run(
     metrics = Metrics()
     loss = torch.zeros(4, device=device)
     jdict, stats = [], []
+    det_writer = DetectionsWriter(save_dir / f'detections.{save_detections}', masks=True) if save_detections else None
     # callbacks.run('on_val_start')
     pbar = tqdm(dataloader, desc=s, bar_format=TQDM_BAR_FORMAT)  # progress bar
     for batch_i, (im, targets, paths, shapes, masks) in enumerate(pbar):
@@ -317,10 +308,14 @@ def run(
             # Save/log
             if save_txt:
                 save_one_txt(predn, save_conf, shape, file=save_dir / 'labels' / f'{path.stem}.txt')
-            if save_json:
+            if save_json or det_writer:
                 pred_masks = scale_image(im[si].shape[1:],
                                          pred_masks.permute(1, 2, 0).contiguous().cpu().numpy(), shape, shapes[si][1])
-                save_one_json(predn, jdict, path, class_map, pred_masks)  # append to COCO-JSON dictionary
+                rles = encode_rles(pred_masks)
+                if save_json:
+                    save_one_json(predn, jdict, path, class_map, rles)  # append to COCO-JSON dictionary
+                if det_writer:
+                    det_writer.write(path.stem, predn, [json.dumps(x) for x in rles])
             # callbacks.run('on_val_image_end', pred, predn, path, names, im[si])
 
         # Plot images
@@ -393,6 +388,8 @@ def run(
 
     # Return results
     model.float()  # for training
+    if det_writer:
+        det_writer.close()  # flush last row group
     if not training:
         s = f"\n{len(list(save_dir.glob('labels/*.txt')))} labels saved to {save_dir / 'labels'}" if save_txt else ''
         LOGGER.info(f"Results saved to {colorstr('bold', save_dir)}{s}")
@@ -419,6 +416,7 @@ def parse_opt():
     parser.add_argument('--save-hybrid', action='store_true', help='save label+prediction hybrid results to *.txt')
     parser.add_argument('--save-conf', action='store_true', help='save confidences in --save-txt labels')
     parser.add_argument('--save-json', action='store_true', help='save a COCO-JSON results file')
+    parser.add_argument('--save-detections', choices=DETECTIONS_FORMATS, help='save detections and mask RLEs to a file')
     parser.add_argument('--project', default=ROOT / 'runs/val-seg', help='save results to project/name')
     parser.add_argument('--name', default='exp', help='save to project/name')
     parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
@@ -0,0 +1,93 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Dataloader tests
+
+Usage:
+    $ python -m pytest tests/test_dataloaders.py
+"""
+
+import random
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+import yaml
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[1]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+
+from utils import dataloaders
+from utils.dataloaders import LoadImagesAndLabels, LoadShardedImagesAndLabels
+
+
+def images(path, shape, n=8, seed=0):
+    # Smooth random PNG images of (h, w) shape with YOLO labels in path/images and path/labels
+    rng = np.random.default_rng(seed)
+    (path / 'images').mkdir(parents=True)
+    (path / 'labels').mkdir()
+    for i in range(n):
+        im = cv2.GaussianBlur(rng.integers(0, 255, (*shape, 3), dtype=np.uint8), (0, 0), 4)
+        cv2.imwrite(str(path / 'images' / f'{i}.png'), cv2.normalize(im, None, 0, 255, cv2.NORM_MINMAX))
+        xy, wh = rng.uniform(0.3, 0.7, (4, 2)), rng.uniform(0.1, 0.4, (4, 2))
+        lines = (f'{i % 3} {x} {y} {w} {h}\n' for (x, y), (w, h) in zip(xy, wh))
+        (path / 'labels' / f'{i}.txt').write_text(''.join(lines))
+    return path / 'images'
+
+
+@pytest.mark.parametrize('shape', [(600, 1000), (300, 400)])  # below 0.5x (INTER_AREA pre-shrink), above 0.5x
+def test_fuse_warp_parity(tmp_path, shape):
+    # --fuse-warp single warp matches resize, letterbox and random_perspective(): same labels, pixels within tolerance
+    with open(ROOT / 'data/hyps/hyp.scratch-low.yaml', errors='ignore') as f:
+        hyp = {**yaml.safe_load(f), 'mosaic': 0.0, 'hsv_h': 0.0, 'hsv_s': 0.0, 'hsv_v': 0.0}  # non-mosaic samples
+    path = images(tmp_path, shape)
+    y = []
+    for fuse_warp in False, True:
+        dataset = LoadImagesAndLabels(path, 256, augment=True, hyp=hyp, fuse_warp=fuse_warp)
+        dataset.albumentations.transform = None  # random pixel transforms are not seeded by random/np.random
+        random.seed(0)
+        np.random.seed(0)
+        y.append([dataset[i][:2] for i in range(len(dataset))])
+    for (im, labels), (imf, labelsf) in zip(*y):
+        assert im.shape == imf.shape
+        assert np.array_equal(labels.numpy(), labelsf.numpy())
+        d = (im.float() - imf.float()).abs()
+        assert d.mean() < 1.5 and d.quantile(0.99) <= 6  # interpolation differences, measured 0.88 and 4
+
+
+def test_labels_cache_dirs(tmp_path, monkeypatch):
+    # Unchanged image and label directories load the labels *.cache without hashing or stat of every file
+    path = images(tmp_path, (64, 64))
+    assert len(LoadImagesAndLabels(path, 64)) == 8
+    with monkeypatch.context() as m:
+        for k in 'get_hash', 'file_stamp':
+            m.setattr(dataloaders, k, lambda *args: pytest.fail(f'{k}() called for unchanged directories'))
+        assert len(LoadImagesAndLabels(path, 64)) == 8
+    cv2.imwrite(str(path / '8.png'), np.zeros((64, 64, 3), dtype=np.uint8))  # new image and label
+    (tmp_path / 'labels' / '8.txt').write_text('1 0.5 0.5 0.2 0.2\n')
+    dataset = LoadImagesAndLabels(path, 64)
+    assert len(dataset) == 9 and dataset.labels[-1][0, 0] == 1
+
+
+@pytest.mark.parametrize('world_size, workers', [(1, 1), (2, 1), (1, 3), (2, 4), (4, 5)])  # up to 20 consumers
+def test_shard_consumers(tmp_path, monkeypatch, world_size, workers):
+    # DDP ranks and dataloader workers stream disjoint images, len(dataset) per rank, from fewer or more shards
+    dataset = LoadImagesAndLabels(images(tmp_path, (64, 64), n=18), 64)
+    sizes = list(LoadShardedImagesAndLabels.write(tmp_path / 'shards', dataset))
+    list(LoadShardedImagesAndLabels.write(tmp_path / 'shards', dataset, shard_size=sum(sizes) // 4))  # ~4 shards
+    monkeypatch.setattr(dataloaders, 'WORLD_SIZE', world_size)
+    ranks = []
+    for rank in range(world_size):
+        monkeypatch.setattr(dataloaders, 'RANK', rank)
+        dataset = LoadShardedImagesAndLabels(tmp_path / 'shards', 64)
+        x = []
+        for w in range(workers):
+            monkeypatch.setattr(dataloaders, 'get_worker_info', lambda: SimpleNamespace(num_workers=workers, id=w))
+            x += [i for i, _ in dataset.stream()]
+        ranks.append(x)
+    x = sum(ranks, [])
+    assert 3 <= len(dataset.shards) < 8 and all(len(r) == len(dataset) for r in ranks) and len(set(x)) == len(x)
@@ -0,0 +1,87 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Detections file tests
+
+Usage:
+    $ python -m pytest tests/test_detections.py
+"""
+
+import json
+import sys
+from pathlib import Path
+
+import cv2
+import numpy as np
+import pytest
+import torch
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[1]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+
+import val
+from models.yolo import Model
+from utils.general import DETECTIONS_FORMATS, DetectionsReader, DetectionsWriter
+
+
+def dataset(path, n=6, nc=2, seed=0):
+    # Random images and YOLO labels in path, returns (data dict, {image stem: (n,6) native-space ground truth})
+    rng, gt = np.random.default_rng(seed), {}
+    (path / 'images').mkdir(parents=True)
+    (path / 'labels').mkdir()
+    for i in range(n):
+        h, w = rng.integers(48, 128, 2)
+        cv2.imwrite(str(path / 'images' / f'{i}.jpg'), rng.integers(0, 255, (h, w, 3), dtype=np.uint8))
+        xy, wh, c = rng.uniform(0.3, 0.7, (3, 2)), rng.uniform(0.1, 0.4, (3, 2)), rng.integers(0, nc, 3)
+        (path / 'labels' / f'{i}.txt').write_text(''.join(f'{c[j]} {xy[j][0]} {xy[j][1]} {wh[j][0]} {wh[j][1]}\n'
+                                                          for j in range(3)))
+        xyxy = np.concatenate((xy - wh / 2, xy + wh / 2), 1) * (w, h, w, h)
+        gt[str(i)] = np.concatenate((xyxy, np.full((3, 1), 0.9), c[:, None]), 1).astype(np.float32)
+    return {'path': str(path), 'train': 'images', 'val': 'images', 'names': {i: str(i) for i in range(nc)}}, gt
+
+
+@pytest.mark.parametrize('format', DETECTIONS_FORMATS)
+def test_detections_round_trip(tmp_path, format):
+    # Rows and mask RLEs read back per image across row groups
+    if format != 'npz':
+        pytest.importorskip('pyarrow')
+    rng, ref = np.random.default_rng(0), {}
+    w = DetectionsWriter(tmp_path / f'detections.{format}', rows=16, masks=True)
+    for i in range(20):
+        det = rng.random((rng.integers(0, 6), 6)).astype(np.float32)
+        det[:, 5] = rng.integers(0, 80, len(det))  # cls
+        ref[str(i)] = det, [json.dumps({'size': [4, 4], 'counts': f'{i}_{j}'}) for j in range(len(det))]
+        w.write(str(i), det, ref[str(i)][1])
+    w.close()
+    r = DetectionsReader(tmp_path / f'detections.{format}')
+    assert r.masks and len(r) == sum(len(x) > 0 for x, _ in ref.values())
+    for image, (det, masks) in ref.items():
+        assert np.allclose(r.get(image), det) and r.rles(image) == masks
+    assert r.get('missing').shape == (0, 6) and r.rles('missing') == []
+    r.close()
+
+
+def test_val_detections(tmp_path, monkeypatch):
+    # val.py --detections evaluates a saved detections file, ground truth detections give mAP@0.5 ~1
+    monkeypatch.setenv('TORCH_FORCE_NO_WEIGHTS_ONLY_LOAD', '1')  # torch>=2.6 torch.load() of the test checkpoint
+    data, gt = dataset(tmp_path / 'data')
+    weights = tmp_path / 'model.pt'
+    model = Model(ROOT / 'models/yolov5n.yaml', nc=len(data['names']))
+    model.nc, model.names = len(data['names']), data['names']  # attached like train.py
+    torch.save({'model': model.half()}, weights)
+    w = DetectionsWriter(tmp_path / 'detections.npz')
+    for image, det in gt.items():
+        w.write(image, det)
+    w.close()
+    (mp, mr, map50, map, *_), _, _ = val.run(data,
+                                            weights,
+                                            batch_size=4,
+                                            imgsz=128,
+                                            device='cpu',
+                                            workers=0,
+                                            half=False,
+                                            plots=False,
+                                            detections=tmp_path / 'detections.npz',
+                                            project=tmp_path / 'runs')
+    assert map50 > 0.99 and map > 0.9
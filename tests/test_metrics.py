@@ -0,0 +1,254 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+Metrics tests
+
+Usage:
+    $ python -m pytest tests/test_metrics.py
+"""
+
+import contextlib
+import io
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+import torch
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[1]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+
+import val
+from utils.general import scale_boxes, scale_boxes_batched, xywh2xyxy
+from utils.metrics import APAccumulator, COCOEvaluator, ConfusionMatrix, box_iou, match_predictions
+
+
+def coco(n=40, nc=6, seed=0):
+    # Random COCO instances dict and predictions with small/medium/large, crowd and empty images, duplicates and misses
+    rng = np.random.default_rng(seed)
+    images = [{'id': int(i), 'width': 640, 'height': 480} for i in rng.choice(100000, n, replace=False)]
+    categories = [{'id': int(c), 'name': str(c)} for c in sorted(rng.choice(90, nc, replace=False) + 1)]
+    anno, jdict = [], []
+    for im in images[:-3]:  # last images have no labels
+        for _ in range(rng.integers(0, 15)):
+            wh = rng.choice([8, 24, 60, 200]) * rng.uniform(0.5, 1.5, 2)
+            xy = rng.uniform(0, 400, 2)
+            c = categories[rng.integers(nc)]['id']
+            anno.append({'id': len(anno) + 1, 'image_id': im['id'], 'category_id': c, 'bbox': [*xy, *wh],
+                         'area': float(wh.prod() * rng.uniform(0.6, 1)), 'iscrowd': int(rng.random() < 0.05)})
+            for _ in range(rng.integers(0, 3)):  # matched or duplicate predictions
+                jdict.append({'image_id': im['id'], 'category_id': c, 'score': float(rng.random()),
+                              'bbox': [float(x) for x in np.r_[xy, wh] + rng.normal(0, wh.mean() * 0.15, 4)]})
+    for im in images:  # false positives, including too many per image for maxDets
+        for _ in range(rng.integers(0, 120 if im is images[0] else 5)):
+            jdict.append({'image_id': im['id'], 'category_id': categories[rng.integers(nc)]['id'],
+                          'score': float(rng.random()), 'bbox': [*rng.uniform(0, 400, 2), *rng.uniform(4, 200, 2)]})
+    return {'images': images, 'annotations': anno, 'categories': categories}, jdict
+
+
+def batch(nb=8, nc=3, seed=0, shape=(256, 320)):
+    # Random letterboxed val.py batch with ragged label and prediction counts: (targets, preds, dataloader shapes)
+    rng = np.random.default_rng(seed)
+    h, w = shape
+    targets, preds, shapes = [], [], []
+    for i in range(nb):
+        h0, w0 = rng.integers(100, 900, 2)
+        r = min(h / h0, w / w0)
+        pad = (w - w0 * r) / 2, (h - h0 * r) / 2
+        shapes.append(((h0, w0), ((r, r), pad)))
+        nl = 0 if i == 1 else rng.integers(1, 9)  # image 1 without labels
+        xy = np.array(pad) + rng.uniform(0.2, 0.8, (nl, 2)) * (w0 * r, h0 * r)
+        wh, c = rng.uniform(8, 80, (nl, 2)), rng.integers(0, nc, nl)
+        targets += [[i, c[j], *xy[j], *wh[j]] for j in range(nl)]
+        xyxy = np.concatenate((xy - wh / 2, xy + wh / 2), 1)
+        p = [(*xyxy[j], 0, c[j]) for j in range(nl) for _ in range(rng.integers(0, 3))]  # misses and duplicates
+        p += [(*xy, *xy + rng.uniform(8, 80, 2), 0, rng.integers(nc)) for xy in rng.uniform(0, w, (3, 2))]  # FPs
+        p = np.array(p if i != 2 else [], dtype=np.float32).reshape(-1, 6)  # image 2 without predictions
+        p[:, :4] += rng.normal(0, 4, (len(p), 4))
+        p[:, 4] = np.sort(rng.random(len(p)))[::-1]  # NMS order, decreasing conf
+        p[rng.random(len(p)) < 0.2, 5] = rng.integers(0, nc)  # wrong classes
+        preds.append(torch.from_numpy(p))
+    return torch.tensor(targets, dtype=torch.float32).view(-1, 6), preds, shapes
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_batch_metrics_parity(seed):
+    # val.py --batch-metrics (scale_boxes_batched, match_predictions, process_images) matches the per-image path
+    targets, preds, shapes = batch(seed=seed)
+    im_shape, iouv = (256, 320), torch.linspace(0.5, 0.95, 10)
+
+    # Per-image, as val.py without --batch-metrics
+    cm, predns, correct = ConfusionMatrix(nc=3), [], []
+    for si, pred in enumerate(preds):
+        labels = targets[targets[:, 0] == si, 1:]
+        predn = scale_boxes(im_shape, pred.clone()[:, :4], shapes[si][0], shapes[si][1])
+        predns.append(torch.cat((predn, pred[:, 4:]), 1))
+        if not len(pred):
+            if len(labels):
+                cm.process_batch(detections=None, labels=labels[:, 0])
+            continue
+        c = torch.zeros(len(pred), 10, dtype=torch.bool)
+        if len(labels):
+            tbox = scale_boxes(im_shape, xywh2xyxy(labels[:, 1:5]), shapes[si][0], shapes[si][1])
+            labelsn = torch.cat((labels[:, 0:1], tbox), 1)
+            c = val.process_batch(predns[-1], labelsn, iouv)
+            cm.process_batch(predns[-1], labelsn)
+        correct.append(c)
+
+    # Whole batch, as val.py --batch-metrics
+    n = [len(x) for x in preds]
+    pi, ti = torch.from_numpy(np.repeat(np.arange(len(preds)), n)), targets[:, 0].long()
+    pred = torch.cat(preds, 0)
+    predn = torch.cat((scale_boxes_batched(pred[:, :4], pi, shapes), pred[:, 4:]), 1)
+    tbox = scale_boxes_batched(xywh2xyxy(targets[:, 2:6]), ti, shapes)
+    labelsn = torch.cat((targets[:, 1:2], tbox), 1)
+    correct_class = (labelsn[:, 0:1] == predn[:, 5]) & (ti[:, None] == pi)
+    cmb = ConfusionMatrix(nc=3)
+    cmb.process_images(predn, labelsn, pi, ti)
+
+    assert torch.allclose(predn, torch.cat(predns, 0), atol=1e-3)
+    correct = torch.cat(correct, 0)
+    assert correct.any() and torch.equal(match_predictions(box_iou(tbox, predn[:, :4]), correct_class, iouv), correct)
+    assert cm.matrix.sum() > 0 and np.array_equal(cmb.matrix, cm.matrix)
+
+
+@pytest.mark.parametrize('subset', [False, True])
+def test_coco_evaluator_parity(tmp_path, subset):
+    # Native COCOEvaluator returns the same 12 summary stats as pycocotools COCOeval(iouType='bbox')
+    pytest.importorskip('pycocotools')
+    from pycocotools.coco import COCO
+    from pycocotools.cocoeval import COCOeval
+
+    anno, jdict = coco()
+    img_ids = [x['id'] for x in anno['images'][::2]] if subset else None
+    (tmp_path / 'anno.json').write_text(json.dumps(anno))
+    with contextlib.redirect_stdout(io.StringIO()):
+        gt = COCO(str(tmp_path / 'anno.json'))
+        ref = COCOeval(gt, gt.loadRes(jdict), 'bbox')
+        if subset:
+            ref.params.imgIds = img_ids
+        ref.evaluate()
+        ref.accumulate()
+        ref.summarize()
+    stats = COCOEvaluator(anno, img_ids).evaluate(jdict)
+    assert np.allclose(stats[:12], ref.stats[:12], atol=1E-9), np.c_[stats, ref.stats]
+
+
+def greedy_match(iou, correct_class, iouv):
+    # Previous per-threshold process_batch() matching, with ties broken to the lowest label and prediction index
+    correct = np.zeros((iou.shape[1], len(iouv)), dtype=bool)
+    for i in range(len(iouv)):
+        x = torch.where((iou >= iouv[i]) & correct_class)  # IoU > threshold and classes match
+        if x[0].shape[0]:
+            matches = torch.cat((torch.stack(x, 1), iou[x[0], x[1]][:, None]), 1).numpy()  # [label, detect, iou]
+            if x[0].shape[0] > 1:
+                matches = matches[np.lexsort((matches[:, 0], -matches[:, 2]))]  # decreasing IoU, then label
+                matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
+                matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
+            correct[matches[:, 1].astype(int), i] = True
+    return torch.from_numpy(correct)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_match_predictions_parity(seed):
+    # match_predictions() matches the previous greedy loop, with IoU ties and empty predictions or labels
+    rng = np.random.default_rng(seed)
+    iouv = torch.linspace(0.5, 0.95, 10)
+    for m, n in (0, 5), (5, 0), (0, 0), *rng.integers(1, 30, (10, 2)):
+        iou = torch.from_numpy(rng.integers(0, 21, (m, n)) / 20).float()  # 0.05 steps, ties and exact thresholds
+        correct_class = torch.from_numpy(rng.random((m, n)) < 0.5)
+        correct = match_predictions(iou, correct_class, iouv)
+        assert correct.shape == (n, 10) and torch.equal(correct, greedy_match(iou, correct_class, iouv))
+
+
+def stats(n=20000, nc=10, seed=0):
+    # Random (correct, conf, pcls, tcls) with precision increasing with conf and correct decreasing over IoU thresholds
+    rng = np.random.default_rng(seed)
+    conf = rng.random(n, dtype=np.float32)
+    correct = rng.random((n, 1)) < conf[:, None] * (1 - np.arange(10) / 12)
+    tcls = rng.integers(0, nc, int(correct[:, 0].sum() * 1.3))  # missed labels
+    pcls = rng.integers(0, nc, n)
+    return torch.from_numpy(correct), torch.from_numpy(conf), torch.from_numpy(pcls), torch.from_numpy(tcls)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_ap_accumulator_bins(seed):
+    # Binned mAP within the documented APAccumulator tolerance of exact mAP: bins=100, >=1000 predictions per class
+    x = stats(seed=seed)
+    ap = []
+    for bins in 0, 100:
+        acc = APAccumulator(10, bins=bins)
+        for image in zip(*(t.chunk(200) for t in x)):
+            acc.update(*image)
+        ap.append(acc.result(names={})[5])
+    assert abs(ap[0][:, 0].mean() - ap[1][:, 0].mean()) < 1E-3  # mAP@0.5
+    assert abs(ap[0].mean() - ap[1].mean()) < 1E-3  # mAP@0.5:0.95
+
+
+@pytest.mark.parametrize('bins', [0, 100])
+def test_ap_accumulator_merge(bins):
+    # Accumulators merged from --shards processes give the single-process result
+    x = stats(n=2000)
+    acc, shards = APAccumulator(10, bins=bins), [APAccumulator(10, bins=bins) for _ in range(3)]
+    for i, image in enumerate(zip(*(t.chunk(40) for t in x))):
+        acc.update(*image)
+        shards[i % 3].update(*image)
+    shards[0].merge(shards[1])
+    shards[0].merge(shards[2])
+    assert np.array_equal(shards[0].nt, acc.nt)
+    for a, b in zip(shards[0].result(names={}), acc.result(names={})):
+        assert np.allclose(a, b)
+
+
+def greedy_confusion(matrix, detections, labels, nc, conf=0.25, iou_thres=0.45):
+    # Previous ConfusionMatrix.process_batch() loop, with ties broken to the lowest label and detection index
+    if detections is None:
+        for gc in labels.int():
+            matrix[nc, gc] += 1  # background FN
+        return
+    detections = detections[detections[:, 4] > conf]
+    gt_classes, detection_classes = labels[:, 0].int(), detections[:, 5].int()
+    iou = box_iou(labels[:, 1:], detections[:, :4])
+    x = torch.where(iou > iou_thres)
+    matches = torch.cat((torch.stack(x, 1), iou[x[0], x[1]][:, None]), 1).numpy()
+    if x[0].shape[0] > 1:
+        matches = matches[np.lexsort((matches[:, 0], -matches[:, 2]))]  # decreasing IoU, then label
+        matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
+        matches = matches[np.lexsort((matches[:, 1], -matches[:, 2]))]  # decreasing IoU, then detection
+        matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
+    n = matches.shape[0] > 0
+    m0, m1, _ = matches.transpose().astype(int)
+    for i, gc in enumerate(gt_classes):
+        j = m0 == i
+        if n and sum(j) == 1:
+            matrix[detection_classes[m1[j]], gc] += 1  # correct
+        else:
+            matrix[nc, gc] += 1  # true background
+    if n:
+        for i, dc in enumerate(detection_classes):
+            if not any(m1 == i):
+                matrix[dc, nc] += 1  # predicted background
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_confusion_matrix_parity(seed):
+    # Vectorized ConfusionMatrix counts, merge() and matrix match the previous loop, incl. background rows and ties
+    rng, nc = np.random.default_rng(seed), 4
+    ref, cm, shards = np.zeros((nc + 1, nc + 1)), ConfusionMatrix(nc), [ConfusionMatrix(nc) for _ in range(2)]
+    for i in range(50):
+        m, n = rng.integers(0, 8, 2) if i > 2 else ((3, 0), (0, 4), (0, 0))[i]  # empty labels and detections
+        boxes = rng.integers(0, 8, (6, 4)) * 8 + np.array([0, 0, 16, 16])  # few distinct boxes, IoU ties
+        labels = torch.tensor(np.c_[rng.integers(0, nc, m), boxes[rng.integers(0, 6, m)]], dtype=torch.float32)
+        detections = boxes[rng.integers(0, 6, n)] + rng.integers(0, 2, (n, 4)) * 4
+        detections = torch.tensor(np.c_[detections, rng.random(n), rng.integers(0, nc, n)], dtype=torch.float32)
+        if rng.random() < 0.1:
+            detections, labels = None, labels[:, 0]  # val.py images without predictions
+        greedy_confusion(ref, detections, labels, nc)
+        cm.process_batch(detections, labels)
+        shards[i % 2].process_batch(detections, labels)
+    shards[0].merge(shards[1])
+    assert ref[nc].sum() and ref[:, nc].sum()  # background FN and FP counted
+    assert np.array_equal(cm.matrix, ref) and np.array_equal(shards[0].matrix, ref)
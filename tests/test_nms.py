@@ -0,0 +1,114 @@
+# YOLOv5 🚀 by Ultralytics, GPL-3.0 license
+"""
+NMS tests
+
+Usage:
+    $ python -m pytest tests/test_nms.py
+"""
+
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+import torch
+import torchvision
+
+FILE = Path(__file__).resolve()
+ROOT = FILE.parents[1]  # YOLOv5 root directory
+if str(ROOT) not in sys.path:
+    sys.path.append(str(ROOT))  # add ROOT to PATH
+
+from models.common import AutoShape, DetectMultiBackend
+from models.yolo import Model
+from utils.general import NMSStats, nms_numpy, non_max_suppression, non_max_suppression_numpy
+
+
+def predictions(bs=4, na=2000, nc=5, nm=0, empty=(1,), seed=0):
+    # Random (bs, na, 5+nc+nm) model outputs with clustered boxes, images in 'empty' have no candidates
+    g = torch.Generator().manual_seed(seed)
+    p = torch.rand(bs, na, 5 + nc + nm, generator=g)
+    p[..., :2] = p[..., :2] * 160 + torch.randint(0, 4, (bs, na, 2), generator=g) * 160  # xy clustered on a grid
+    p[..., 2:4] = p[..., 2:4] * 120 + 10  # wh
+    for i in empty:
+        p[i, :, 4] = 0  # no objectness
+    return p
+
+
+@pytest.mark.parametrize('multi_label', [False, True])
+@pytest.mark.parametrize('agnostic', [False, True])
+@pytest.mark.parametrize('max_det', [300, 5])
+def test_batched_nms_parity(multi_label, agnostic, max_det):
+    # Loop-free batched NMS returns the same per-image detections as the per-image loop
+    p = predictions(nm=2)
+    kwargs = dict(conf_thres=0.25, iou_thres=0.45, agnostic=agnostic, multi_label=multi_label, max_det=max_det, nm=2)
+    a = non_max_suppression(p.clone(), **kwargs)
+    b = non_max_suppression(p.clone(), batched=True, **kwargs)
+    assert len(a) == len(b) == len(p)
+    for x, y in zip(a, b):
+        assert x.shape == y.shape
+        assert torch.allclose(x, y)
+    assert not len(a[1])  # empty image
+    assert all(len(x) <= max_det for x in b)
+    if max_det == 5:
+        assert all(len(x) == max_det for i, x in enumerate(b) if i != 1)  # truncated
+
+
+def test_batched_nms_classes():
+    # Class filter and all-empty batches
+    p = predictions()
+    a = non_max_suppression(p.clone(), classes=[0, 3])
+    b = non_max_suppression(p.clone(), classes=[0, 3], batched=True)
+    assert all(torch.allclose(x, y) for x, y in zip(a, b))
+    assert all(set(x[:, 5].tolist()) <= {0, 3} for x in b)
+    b = non_max_suppression(predictions(empty=range(4)), batched=True)
+    assert [x.shape for x in b] == [(0, 6)] * 4
+
+
+@pytest.mark.parametrize('batched', [False, True])
+def test_nms_budget_stats(batched):
+    # Budgeted NMS returns detections only, per-image truncation counts go to the optional stats out-parameter
+    p = predictions()
+    stats = NMSStats()
+    y = non_max_suppression(p.clone(), conf_thres=0.01, budget=1E-9, batched=batched, stats=stats)
+    assert isinstance(y, list) and len(y) == len(p)
+    assert stats.k == 1 and len(stats) == len(p)
+    assert stats.truncated == [max(n - 1, 0) for n in stats.candidates]
+    assert stats.candidates[1] == 0 and stats.candidates[0] > 1
+    assert isinstance(non_max_suppression(p.clone(), budget=1E-9, batched=batched), list)
+
+
+@pytest.mark.parametrize('n', [0, 1, 500, 3000])
+def test_nms_numpy_parity(n):
+    # Vectorized NumPy NMS keeps the same boxes in the same order as torchvision greedy NMS, across blocks
+    p = predictions(bs=1, na=n, nc=1, empty=())[0].numpy().astype(np.float64)
+    boxes = np.concatenate((p[:, :2] - p[:, 2:4] / 2, p[:, :2] + p[:, 2:4] / 2), 1)
+    for iou_thres in 0.3, 0.45, 0.7:
+        i = torchvision.ops.nms(torch.from_numpy(boxes), torch.from_numpy(p[:, 4]), iou_thres).numpy()
+        assert np.array_equal(nms_numpy(boxes, p[:, 4], iou_thres), i)
+
+
+def test_non_max_suppression_numpy_parity():
+    # NumPy NMS returns the same per-image detections as PyTorch NMS
+    p = predictions(nm=2)
+    a = non_max_suppression(p.clone(), nm=2)
+    b = non_max_suppression_numpy(p.numpy().copy(), nm=2)
+    assert all(x.shape == y.shape and np.allclose(x.numpy(), y, atol=1E-4) for x, y in zip(a, b))
+
+
+def test_prefilter_restored(tmp_path, monkeypatch):
+    # DetectMultiBackend(conf_thres=) and AutoShape.prefilter only prefilter their own forward, later calls decode all
+    monkeypatch.setenv('TORCH_FORCE_NO_WEIGHTS_ONLY_LOAD', '1')  # torch>=2.6 torch.load() of the test checkpoint
+    model = Model(ROOT / 'models/yolov5n.yaml', nc=2).eval()
+    torch.save({'model': model}, tmp_path / 'model.pt')
+    x = torch.rand(2, 3, 64, 64)
+    y = model(x)[0]
+
+    backend = DetectMultiBackend(tmp_path / 'model.pt')
+    backend(x, conf_thres=0.5)
+    assert torch.equal(backend.model(x)[0], y)
+
+    shape = AutoShape(model)
+    shape.prefilter = True
+    shape(np.zeros((64, 64, 3), dtype=np.uint8))
+    assert torch.equal(model(x)[0], y)
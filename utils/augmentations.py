@@ -9,10 +9,12 @@ import random
 import cv2
 import numpy as np
 import torch
+import torch.nn.functional as F
 import torchvision.transforms as T
 import torchvision.transforms.functional as TF
 
-from utils.general import LOGGER, check_version, colorstr, resample_segments, segment2box, xywhn2xyxy
+from utils.general import (LOGGER, check_version, colorstr, resample_segments, segment2box, xywhn2xyxy,
+                           xyxy2xywhn)
 from utils.metrics import bbox_ioa
 
 IMAGENET_MEAN = 0.485, 0.456, 0.406  # RGB mean
@@ -111,6 +113,16 @@ def replicate(im, labels):
 def letterbox(im, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleFill=False, scaleup=True, stride=32):
     # Resize and pad image while meeting stride-multiple constraints
     shape = im.shape[:2]  # current shape [height, width]
+    ratio, (dw, dh), new_unpad, (top, bottom, left, right) = letterbox_params(shape, new_shape, auto, scaleFill,
+                                                                              scaleup, stride)
+    if shape[::-1] != new_unpad:  # resize
+        im = cv2.resize(im, new_unpad, interpolation=cv2.INTER_LINEAR)
+    im = cv2.copyMakeBorder(im, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)  # add border
+    return im, ratio, (dw, dh)
+
+
+def letterbox_params(shape, new_shape=(640, 640), auto=True, scaleFill=False, scaleup=True, stride=32):
+    # Return letterbox() ratio, (dw, dh) padding, resized (w, h) and (top, bottom, left, right) borders for shape (h, w)
     if isinstance(new_shape, int):
         new_shape = (new_shape, new_shape)
 
@@ -132,13 +144,9 @@ def letterbox(im, new_shape=(640, 640), color=(114, 114, 114), auto=True, scaleF
 
     dw /= 2  # divide padding into 2 sides
     dh /= 2
-
-    if shape[::-1] != new_unpad:  # resize
-        im = cv2.resize(im, new_unpad, interpolation=cv2.INTER_LINEAR)
     top, bottom = int(round(dh - 0.1)), int(round(dh + 0.1))
     left, right = int(round(dw - 0.1)), int(round(dw + 0.1))
-    im = cv2.copyMakeBorder(im, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)  # add border
-    return im, ratio, (dw, dh)
+    return ratio, (dw, dh), new_unpad, (top, bottom, left, right)
 
 
 def random_perspective(im,
@@ -149,17 +157,21 @@ def random_perspective(im,
                        scale=.1,
                        shear=10,
                        perspective=0.0,
-                       border=(0, 0)):
+                       border=(0, 0),
+                       dst=None,
+                       pre=None,
+                       shape=None):
     # torchvision.transforms.RandomAffine(degrees=(-10, 10), translate=(0.1, 0.1), scale=(0.9, 1.1), shear=(-10, 10))
-    # targets = [cls, xyxy]
-
-    height = im.shape[0] + border[0] * 2  # shape(h,w,c)
-    width = im.shape[1] + border[1] * 2
+    # targets = [cls, xyxy], dst = (optional) preallocated output image to warp into
+    # pre = (optional) 3x3 im to targets pixel transform of shape (h, w), i.e. resize and letterbox fused into one warp
+    shape = shape or im.shape[:2]
+    height = shape[0] + border[0] * 2  # shape(h,w,c)
+    width = shape[1] + border[1] * 2
 
     # Center
     C = np.eye(3)
-    C[0, 2] = -im.shape[1] / 2  # x translation (pixels)
-    C[1, 2] = -im.shape[0] / 2  # y translation (pixels)
+    C[0, 2] = -shape[1] / 2  # x translation (pixels)
+    C[1, 2] = -shape[0] / 2  # y translation (pixels)
 
     # Perspective
     P = np.eye(3)
@@ -186,11 +198,12 @@ def random_perspective(im,
 
     # Combined rotation matrix
     M = T @ S @ R @ P @ C  # order of operations (right to left) is IMPORTANT
-    if (border[0] != 0) or (border[1] != 0) or (M != np.eye(3)).any():  # image changed
+    Mi = M if pre is None else M @ pre  # image transform
+    if (border[0] != 0) or (border[1] != 0) or (Mi != np.eye(3)).any():  # image changed
         if perspective:
-            im = cv2.warpPerspective(im, M, dsize=(width, height), borderValue=(114, 114, 114))
+            im = cv2.warpPerspective(im, Mi, dsize=(width, height), dst=dst, borderValue=(114, 114, 114))
         else:  # affine
-            im = cv2.warpAffine(im, M[:2], dsize=(width, height), borderValue=(114, 114, 114))
+            im = cv2.warpAffine(im, Mi[:2], dsize=(width, height), dst=dst, borderValue=(114, 114, 114))
 
     # Visualize
     # import matplotlib.pyplot as plt
@@ -286,12 +299,14 @@ def cutout(im, labels, p=0.5):
     return labels
 
 
-def mixup(im, labels, im2, labels2):
-    # Applies MixUp augmentation https://arxiv.org/pdf/1710.09412.pdf
+def mixup(im, labels, im2, labels2, dst=None):
+    # Applies MixUp augmentation https://arxiv.org/pdf/1710.09412.pdf, labels written into dst (n1+n2,5) if given
     r = np.random.beta(32.0, 32.0)  # mixup ratio, alpha=beta=32.0
-    im = (im * r + im2 * (1 - r)).astype(np.uint8)
-    labels = np.concatenate((labels, labels2), 0)
-    return im, labels
+    im = cv2.addWeighted(im, r, im2, 1 - r, -0.5, dst=im)  # blend in place, -0.5 truncates like astype(np.uint8)
+    if dst is None:
+        return im, np.concatenate((labels, labels2), 0)
+    dst[:len(labels)], dst[len(labels):] = labels, labels2
+    return im, dst
 
 
 def box_candidates(box1, box2, wh_thr=2, ar_thr=100, area_thr=0.1, eps=1e-16):  # box1(4,n), box2(4,n)
@@ -302,6 +317,99 @@ def box_candidates(box1, box2, wh_thr=2, ar_thr=100, area_thr=0.1, eps=1e-16):
     return (w2 > wh_thr) & (h2 > wh_thr) & (w2 * h2 / (w1 * h1 + eps) > area_thr) & (ar < ar_thr)  # candidates
 
 
+class BatchAugment:
+    # YOLOv5 batch augmentation of collated (b,3,2s,2s) uint8 RGB mosaic canvases on any device (CPU or CUDA), replaces
+    # per-sample random_perspective(), augment_hsv() and flips in dataloader workers with tensor ops over the batch
+    def __init__(self, hyp, size=640):
+        self.hyp = hyp
+        self.size = size  # output size s
+
+    def __call__(self, im, targets):
+        # im (b,3,2s,2s) uint8, targets (n,6) image, class, canvas xywhn -> im (b,3,s,s) uint8, targets output xywhn
+        M, scale = self.matrices(im.shape[0], im.shape[3], im.shape[2])
+        M, scale, targets = M.to(im.device), scale.to(im.device), targets.to(im.device)
+        targets = self.warp_targets(targets, M, scale, im.shape[3], im.shape[2])
+        im = self.warp(im, M)
+        im = self.hsv(im)
+        return self.flip(im, targets)
+
+    def matrices(self, b, w, h):
+        # Random canvas to output pixel transforms M (b,3,3) and scales (b), as random_perspective() per image
+        hyp, s = self.hyp, self.size
+        u = lambda x, lo, hi: torch.rand(x, dtype=torch.float64) * (hi - lo) + lo  # uniform(lo, hi)
+        C, P, R, S, T = torch.eye(3, dtype=torch.float64).repeat(5, b, 1, 1)
+        C[:, 0, 2], C[:, 1, 2] = -w / 2, -h / 2  # center
+        P[:, 2, 0], P[:, 2, 1] = u((2, b), -hyp['perspective'], hyp['perspective'])  # perspective
+        a, scale = u(b, -hyp['degrees'], hyp['degrees']) * math.pi / 180, u(b, 1 - hyp['scale'], 1 + hyp['scale'])
+        R[:, 0, 0], R[:, 0, 1] = a.cos() * scale, a.sin() * scale  # rotation and scale, cv2.getRotationMatrix2D()
+        R[:, 1, 0], R[:, 1, 1] = -a.sin() * scale, a.cos() * scale
+        S[:, 0, 1], S[:, 1, 0] = (u((2, b), -hyp['shear'], hyp['shear']) * math.pi / 180).tan()  # shear
+        T[:, 0, 2], T[:, 1, 2] = u((2, b), 0.5 - hyp['translate'], 0.5 + hyp['translate']) * s  # translation
+        return T @ S @ R @ P @ C, scale
+
+    def warp(self, im, M):
+        # Bilinear warpPerspective() of every image to (s,s) with border value 114, one grid_sample() call
+        b, _, h, w = im.shape
+        s = self.size
+        i = torch.arange(s, device=im.device, dtype=torch.float32)
+        x, y = i.view(1, -1).expand(s, s), i.view(-1, 1).expand(s, s)
+        xy = torch.stack((x, y, torch.ones_like(x)), -1).view(1, -1, 3)  # output pixels (1,s*s,3)
+        xy = xy @ torch.inverse(M).transpose(1, 2).float()  # source pixels (b,s*s,3)
+        xy = xy[..., :2] / xy[..., 2:3]
+        grid = ((xy + 0.5) / torch.tensor((w, h), device=im.device) * 2 - 1).view(b, s, s, 2)  # pixel centers
+        im = F.grid_sample(im.float() - 114, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+        return (im + 114).round_().clamp_(0, 255).byte()
+
+    def warp_targets(self, targets, M, scale, w, h):
+        # Transform canvas xywhn boxes with M, clip to output, drop boxes as box_candidates(), return output xywhn
+        if not len(targets):
+            return targets
+        s = self.size
+        i = targets[:, 0].long()
+        box = xywhn2xyxy(targets[:, 2:6].double(), w, h)
+        xy = box[:, [0, 1, 2, 3, 0, 3, 2, 1]].view(-1, 4, 2)  # x1y1, x2y2, x1y2, x2y1
+        xy = torch.cat((xy, torch.ones_like(xy[..., :1])), 2) @ M[i].transpose(1, 2)  # (n,4,3)
+        xy = xy[..., :2] / xy[..., 2:3]
+        new = torch.cat((xy.min(1)[0], xy.max(1)[0]), 1).clamp(0, s)  # xyxy
+        box = box * scale[i, None]
+        w1, h1, w2, h2 = box[:, 2] - box[:, 0], box[:, 3] - box[:, 1], new[:, 2] - new[:, 0], new[:, 3] - new[:, 1]
+        ar = torch.max(w2 / (h2 + 1e-16), h2 / (w2 + 1e-16))  # aspect ratio
+        k = (w2 > 2) & (h2 > 2) & (w2 * h2 / (w1 * h1 + 1e-16) > 0.1) & (ar < 100)  # box_candidates()
+        targets = targets[k].clone()
+        targets[:, 2:6] = xyxy2xywhn(new[k], w=s, h=s, clip=True, eps=1E-3).to(targets.dtype)
+        return targets
+
+    def hsv(self, im):
+        # augment_hsv() with per-image random gains, RGB to OpenCV-style HSV and back as tensor ops
+        gains = self.hyp['hsv_h'], self.hyp['hsv_s'], self.hyp['hsv_v']
+        if not any(gains):
+            return im
+        r = ((torch.rand(im.shape[0], 3) * 2 - 1) * torch.tensor(gains) + 1).to(im.device)[:, :, None, None]
+        x = im.float()
+        v, mn = x.max(1, keepdim=True)[0], x.min(1, keepdim=True)[0]
+        c = v - mn  # chroma
+        red, green, blue = x.split(1, 1)
+        cc = c.clamp(min=1e-9)
+        hue = torch.where(v == red, (green - blue) / cc, torch.where(v == green, (blue - red) / cc + 2,
+                                                                       (red - green) / cc + 4))
+        hue = (hue / 6 % 1 * r[:, 0:1]) % 1  # hue as a fraction of the circle
+        sat = (c / v.clamp(min=1e-9) * r[:, 1:2]).clamp(0, 1)
+        v = (v * r[:, 2:3]).clamp(0, 255)
+        k = (torch.tensor((5, 3, 1), device=im.device).view(1, 3, 1, 1) + hue * 6) % 6
+        x = v - v * sat * torch.min(k, 4 - k).clamp(0, 1)  # RGB
+        return x.round_().clamp_(0, 255).byte()
+
+    def flip(self, im, targets):
+        # Flip up-down then left-right with hyp probabilities per image, targets xywhn
+        for dim, p, j in ((2, self.hyp['flipud'], 3), (3, self.hyp['fliplr'], 2)):  # image dim, probability, column
+            if p:
+                f = (torch.rand(im.shape[0]) < p).to(im.device)
+                im = torch.where(f[:, None, None, None], im.flip(dim), im)
+                if len(targets):
+                    targets[:, j] = torch.where(f[targets[:, 0].long()], 1 - targets[:, j], targets[:, j])
+        return im, targets
+
+
 def classify_albumentations(
         augment=True,
         size=224,
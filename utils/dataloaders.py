@@ -3,14 +3,18 @@
 Dataloaders and dataset utils
 """
 
+import atexit
 import contextlib
 import glob
 import hashlib
+import io
 import json
 import math
 import os
 import random
 import shutil
+import tarfile
+import tempfile
 import time
 from itertools import repeat
 from multiprocessing.pool import Pool, ThreadPool
@@ -25,11 +29,11 @@ import torch.nn.functional as F
 import torchvision
 import yaml
 from PIL import ExifTags, Image, ImageOps
-from torch.utils.data import DataLoader, Dataset, dataloader, distributed
+from torch.utils.data import DataLoader, Dataset, IterableDataset, dataloader, distributed, get_worker_info
 from tqdm import tqdm
 
 from utils.augmentations import (Albumentations, augment_hsv, classify_albumentations, classify_transforms, copy_paste,
-                                 letterbox, mixup, random_perspective)
+                                 letterbox, letterbox_params, mixup, random_perspective)
 from utils.general import (DATASETS_DIR, LOGGER, NUM_THREADS, TQDM_BAR_FORMAT, check_dataset, check_requirements,
                            check_yaml, clean_str, cv2, is_colab, is_kaggle, segments2boxes, unzip_file, xyn2xy,
                            xywh2xyxy, xywhn2xyxy, xyxy2xywhn)
@@ -39,8 +43,14 @@ from utils.torch_utils import torch_distributed_zero_first
 HELP_URL = 'See https://github.com/ultralytics/yolov5/wiki/Train-Custom-Data'
 IMG_FORMATS = 'bmp', 'dng', 'jpeg', 'jpg', 'mpo', 'png', 'tif', 'tiff', 'webp', 'pfm'  # include image suffixes
 VID_FORMATS = 'asf', 'avi', 'gif', 'm4v', 'mkv', 'mov', 'mp4', 'mpeg', 'mpg', 'ts', 'wmv'  # include video suffixes
+REDUCED_COLOR = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8}  # cv2.imread() flags for JPEG DCT scaling by reduction factor
 LOCAL_RANK = int(os.getenv('LOCAL_RANK', -1))  # https://pytorch.org/docs/stable/elastic/run.html
 RANK = int(os.getenv('RANK', -1))
+WORLD_SIZE = int(os.getenv('WORLD_SIZE', 1))
 PIN_MEMORY = str(os.getenv('PIN_MEMORY', True)).lower() == 'true'  # global pin_memory for dataloaders
 
 # Get orientation exif tag
@@ -115,12 +125,15 @@ def create_dataloader(path,
                       image_weights=False,
                       quad=False,
                       prefix='',
-                      shuffle=False):
+                      shuffle=False,
+                      batch_augment=False,
+                      fuse_warp=False):
     if rect and shuffle:
         LOGGER.warning('WARNING ⚠️ --rect is incompatible with DataLoader shuffle, setting shuffle=False')
         shuffle = False
+    sharded = isinstance(path, (str, Path)) and (Path(path) / 'shards.cache').is_file()  # pack_dataset.py output
     with torch_distributed_zero_first(rank):  # init dataset *.cache only once if DDP
-        dataset = LoadImagesAndLabels(
+        dataset = (LoadShardedImagesAndLabels if sharded else LoadImagesAndLabels)(
             path,
             imgsz,
             batch_size,
@@ -132,18 +145,20 @@ def create_dataloader(path,
             stride=int(stride),
             pad=pad,
             image_weights=image_weights,
-            prefix=prefix)
+            prefix=prefix,
+            batch_augment=batch_augment,
+            fuse_warp=fuse_warp)
 
     batch_size = min(batch_size, len(dataset))
     nd = torch.cuda.device_count()  # number of CUDA devices
     nw = min([os.cpu_count() // max(nd, 1), batch_size if batch_size > 1 else 0, workers])  # number of workers
-    sampler = None if rank == -1 else distributed.DistributedSampler(dataset, shuffle=shuffle)
-    loader = DataLoader if image_weights else InfiniteDataLoader  # only DataLoader allows for attribute updates
+    sampler = None if rank == -1 or sharded else distributed.DistributedSampler(dataset, shuffle=shuffle)
+    loader = DataLoader if image_weights or sharded else InfiniteDataLoader  # only DataLoader allows attribute updates
     generator = torch.Generator()
     generator.manual_seed(6148914691236517205 + RANK)
     return loader(dataset,
                   batch_size=batch_size,
-                  shuffle=shuffle and sampler is None,
+                  shuffle=shuffle and sampler is None and not sharded,  # shards shuffle in the dataset
                   num_workers=nw,
                   sampler=sampler,
                   pin_memory=PIN_MEMORY,
@@ -237,7 +252,15 @@ class LoadScreenshots:
 
 class LoadImages:
     # YOLOv5 image/video dataloader, i.e. `python detect.py --source image.jpg/vid.mp4`
-    def __init__(self, path, img_size=640, stride=32, auto=True, transforms=None, vid_stride=1):
+    def __init__(self,
+                 path,
+                 img_size=640,
+                 stride=32,
+                 auto=True,
+                 transforms=None,
+                 vid_stride=1,
+                 batch_size=1,
+                 rect=False):
         files = []
         for p in sorted(path) if isinstance(path, (list, tuple)) else [path]:
             p = str(Path(p).resolve())
@@ -254,6 +277,37 @@ class LoadImages:
         videos = [x for x in files if x.split('.')[-1].lower() in VID_FORMATS]
         ni, nv = len(images), len(videos)
 
+        # Batched inference, images ordered so that batches of one letterbox shape are consecutive
+        self.batch_shapes = {}  # image file: letterbox shape (h,w)
+        if batch_size > 1 and ni and not transforms:
+            s = []  # wh
+            for f in images:
+                with Image.open(f) as im:  # header only
+                    s.append(exif_size(im))
+            s = np.array(s)
+        if rect and batch_size > 1 and ni and not transforms:  # aspect-ratio sorted, one minimal shape per batch
+            ar = s[:, 1] / s[:, 0]  # aspect ratio
+            irect = ar.argsort()
+            images, ar = [images[i] for i in irect], ar[irect]
+            bi = np.floor(np.arange(ni) / batch_size).astype(int)  # batch index
+            shapes = [[1, 1]] * (bi[-1] + 1)
+            for i in range(len(shapes)):
+                ari = ar[bi == i]
+                mini, maxi = ari.min(), ari.max()
+                if maxi < 1:
+                    shapes[i] = [maxi, 1]
+                elif mini > 1:
+                    shapes[i] = [1, 1 / mini]
+            sz = max(img_size) if isinstance(img_size, (list, tuple)) else img_size
+            shapes = np.ceil(np.array(shapes) * sz / stride).astype(int) * stride
+            self.batch_shapes = {f: tuple(shapes[i]) for f, i in zip(images, bi)}
+        elif batch_size > 1 and ni and not transforms:  # grouped by letterbox() shape, stable within groups
+            shapes = []
+            for w, h in s:
+                _, _, (nw, nh), (top, bottom, left, right) = letterbox_params((h, w), img_size, auto, stride=stride)
+                shapes.append((nh + top + bottom, nw + left + right))
+            images = [images[i] for i in sorted(range(ni), key=shapes.__getitem__)]
+
         self.img_size = img_size
         self.stride = stride
         self.files = images + videos
@@ -263,6 +317,9 @@ class LoadImages:
         self.auto = auto
         self.transforms = transforms  # optional
         self.vid_stride = vid_stride  # video frame-rate stride
+        self.batch_size = batch_size  # images or frames of one video per batch, same letterbox shape
+        self.batch_frames = []  # video frame per batch item
+        self.pending = None  # item read ahead that did not fit the last batch
         if any(videos):
             self._new_video(videos[0])  # new video
         else:
@@ -272,9 +329,35 @@ class LoadImages:
 
     def __iter__(self):
         self.count = 0
+        self.pending = None
         return self
 
     def __next__(self):
+        return self._next() if self.batch_size == 1 else self._next_batch()
+
+    def _next_batch(self):
+        # Return up to batch_size consecutive items with equal mode, video and shape as lists of paths, im0s and strings
+        batch = []
+        while len(batch) < self.batch_size:
+            if batch and batch[0][5] == 'video' and 0 < self.frames <= self.frame:
+                break  # end of video, do not read into the next one
+            try:
+                x = self.pending or (*self._next(), self.mode, getattr(self, 'frame', 0))
+            except StopIteration:
+                break
+            self.pending = None
+            if batch and (x[5], x[1].shape, x[3]) != (batch[0][5], batch[0][1].shape, batch[0][3]):
+                self.pending = x  # starts the next batch
+                break
+            batch.append(x)
+        if not batch:
+            raise StopIteration
+        path, im, im0, cap, s, mode, frame = zip(*batch)
+        self.mode, self.batch_frames = mode[0], list(frame)
+        im = torch.stack(im) if isinstance(im[0], torch.Tensor) else np.stack(im)
+        return list(path), im, list(im0), cap[0], list(s)
+
+    def _next(self):
         if self.count == self.nf:
             raise StopIteration
         path = self.files[self.count]
@@ -308,7 +391,8 @@ class LoadImages:
         if self.transforms:
             im = self.transforms(im0)  # transforms
         else:
-            im = letterbox(im0, self.img_size, stride=self.stride, auto=self.auto)[0]  # padded resize
+            shape = self.batch_shapes.get(path)  # rect batch shape
+            im = letterbox(im0, shape or self.img_size, stride=self.stride, auto=self.auto and not shape)[0]  # resize
             im = im.transpose((2, 0, 1))[::-1]  # HWC to CHW, BGR to RGB
             im = np.ascontiguousarray(im)  # contiguous
 
@@ -428,9 +512,141 @@ def img2label_paths(img_paths):
     return [sb.join(x.rsplit(sa, 1)).rsplit('.', 1)[0] + '.txt' for x in img_paths]
 
 
+def dir_mtimes(dirs):
+    # Return {directory: mtime} of directories, None for missing ones
+    return {str(d): os.stat(d).st_mtime_ns if os.path.isdir(d) else None for d in dirs}
+
+
+def list_images(path, prefix=''):
+    # Return (image files, {directory: mtime}) under directory path, from an *.index file of per-directory listings
+    # made with os.scandir. Only directories with a changed mtime are listed again (in parallel, one tree level at a
+    # time), so new files are appended to the index without walking the whole tree. The index is kept next to the
+    # labels *.cache
+    path, version = Path(path), 0.1  # index version
+    file = Path(img2label_paths([str(path / 'x')])[0]).parent.with_suffix('.index')  # i.e. labels/train2017.index
+    try:
+        index = np.load(file, allow_pickle=True).item()
+        assert index['version'] == version
+    except Exception:
+        index = {'dirs': {}}
+
+    def scan(d):
+        # Return (mtime, image files, subdirectories) of directory d, listed again only if its mtime changed
+        t = os.stat(d).st_mtime_ns
+        if index['dirs'].get(d, (None,))[0] == t:
+            return index['dirs'][d], False
+        files, dirs = [], []
+        with os.scandir(d) as it:
+            for x in it:
+                if not x.name.startswith('.'):  # skip hidden like glob
+                    if x.is_dir():
+                        dirs.append(x.path)
+                    elif x.name.rsplit('.', 1)[-1].lower() in IMG_FORMATS:
+                        files.append(x.path)
+        return (t, files, dirs), True
+
+    todo, listings, changed = [str(path)], {}, False
+    with ThreadPool(NUM_THREADS) as pool:
+        while todo:
+            results = pool.map(scan, todo)
+            listings.update(zip(todo, (x for x, _ in results)))
+            changed |= any(c for _, c in results)
+            todo = [d for x, _ in results for d in x[2]]
+    if changed or len(listings) != len(index['dirs']):  # new, changed or removed directories
+        try:
+            tmp = file.with_name(f'{file.name}.{os.getpid()}.npy')
+            np.save(tmp, {'dirs': listings, 'version': version})
+            os.replace(tmp, file)  # atomic
+        except Exception as e:
+            LOGGER.warning(f'{prefix}WARNING ⚠️ Index directory {file.parent} is not writeable: {e}')  # not writeable
+    return [f for _, files, _ in listings.values() for f in files], {d: x[0] for d, x in listings.items()}
+
+
+class MappedImages:
+    """ Resized images packed into memory-mapped shard files with a (shard, offset, nbytes, h0, w0, h, w) index
+    --cache shm: uncompressed shards in shared memory, all dataloader workers and DDP ranks map the same pages, so
+    RAM does not grow with workers. --cache disk: shards next to the labels *.cache, optionally lz4 or zstd compressed.
+    Indexing returns a writable copy of one image, the mapped shards stay read-only. The index is written last with a
+    version and hash, a valid index marks a complete cache.
+    """
+    version = 0.1  # index version
+    shard_size = 1 << 32  # max bytes per shard file
+
+    def __init__(self, file, key=None):
+        self.file = Path(file)
+        x = np.load(self.path(self.file, 'index.npy'), allow_pickle=True).item()
+        assert x['version'] == self.version, 'version changed'
+        assert key is None or x['hash'] == key, 'images or img_size changed'
+        self.index, self.compress = x['index'], x['compress']
+        self.mm, self.decompress = {}, None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        k, o, nb, _, _, h, w = self.index[i]
+        if k not in self.mm:  # map each shard once per process
+            self.mm[k] = np.memmap(self.path(self.file, k), dtype=np.uint8, mode='r')
+        b = self.mm[k][o:o + nb]
+        if self.compress:
+            self.decompress = self.decompress or self.codec(self.compress)[1]
+            b = np.frombuffer(self.decompress(b), dtype=np.uint8)
+        return b.reshape(h, w, 3).copy()  # writable copy, augmentations edit images in place
+
+    def __getstate__(self):
+        return {**self.__dict__, 'mm': {}, 'decompress': None}  # spawned workers re-map instead of pickling contents
+
+    @staticmethod
+    def path(file, suffix):
+        return file.with_name(f'{file.name}.{suffix}')
+
+    @staticmethod
+    def codec(compress=None):
+        # Return (compress, decompress) functions for None, 'lz4' or 'zstd'
+        if compress == 'lz4':
+            check_requirements('lz4')
+            import lz4.frame
+            return lz4.frame.compress, lz4.frame.decompress
+        if compress == 'zstd':
+            check_requirements('zstandard')
+            import zstandard
+            return zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+        assert compress is None, f'unknown --cache compression {compress}, use lz4 or zstd'
+        return (lambda x: x), None
+
+    @classmethod
+    def write(cls, file, results, key='', compress=None):
+        # Pack an iterable of (im, hw_original, hw_resized) into shard files, yields images, renamed once complete
+        file, index, f, k, o = Path(file), [], None, -1, 0
+        fn, pid = cls.codec(compress)[0], os.getpid()
+        for im, (h0, w0), (h, w) in results:
+            b = fn(memoryview(np.ascontiguousarray(im)).cast('B'))
+            if f is None or o + len(b) > cls.shard_size:  # next shard
+                if f:
+                    f.close()
+                k, o = k + 1, 0
+                f = open(cls.path(file, f'{k}.{pid}.tmp'), 'wb')
+            f.write(b)
+            index.append((k, o, len(b), h0, w0, h, w))
+            o += len(b)
+            yield im
+        if f:
+            f.close()
+        for x in file.parent.glob(f'{file.name}.*'):  # previous cache
+            if not x.name.endswith('.tmp'):
+                x.unlink()
+        for i in range(k + 1):
+            cls.path(file, f'{i}.{pid}.tmp').rename(cls.path(file, i))
+        x = {'index': np.array(index, dtype=np.int64).reshape(-1, 7), 'compress': compress, 'hash': key}
+        np.save(cls.path(file, f'{pid}.index.npy'), {**x, 'version': cls.version})
+        cls.path(file, f'{pid}.index.npy').rename(cls.path(file, 'index.npy'))
+
+
 class LoadImagesAndLabels(Dataset):
     # YOLOv5 train_loader/val_loader, loads images and labels for training and validation
-    cache_version = 0.6  # dataset labels *.cache version
+    cache_version = 0.7  # dataset labels *.cache version
+    reuse_buffers = True  # reuse per-worker mosaic canvases, warp outputs and label arrays between samples
+    reduced_decode = True  # training only, decode JPEGs at 1/2, 1/4 or 1/8 resolution when still larger than img_size
     rand_interp_methods = [cv2.INTER_NEAREST, cv2.INTER_LINEAR, cv2.INTER_CUBIC, cv2.INTER_AREA, cv2.INTER_LANCZOS4]
 
     def __init__(self,
@@ -446,26 +662,34 @@ class LoadImagesAndLabels(Dataset):
                  stride=32,
                  pad=0.0,
                  min_items=0,
-                 prefix=''):
+                 prefix='',
+                 batch_augment=False,
+                 fuse_warp=False):
         self.img_size = img_size
         self.augment = augment
         self.hyp = hyp
         self.image_weights = image_weights
         self.rect = False if image_weights else rect
         self.mosaic = self.augment and not self.rect  # load 4 images at a time into a mosaic (only during training)
+        self.batch_augment = batch_augment and self.mosaic  # return (2s,2s) canvases for BatchAugment in train.py
+        self.fuse_warp = fuse_warp  # resize, letterbox and random_perspective() as one warp for non-mosaic samples
         self.mosaic_border = [-img_size // 2, -img_size // 2]
         self.stride = stride
         self.path = path
         self.albumentations = Albumentations(size=img_size) if augment else None
+        self.buffers = {}  # reusable arrays, one set per dataloader worker
 
         try:
-            f = []  # image files
+            f, dirs = [], {}  # image files, {directory: mtime} of listed directories
             for p in path if isinstance(path, list) else [path]:
                 p = Path(p)  # os-agnostic
                 if p.is_dir():  # dir
-                    f += glob.glob(str(p / '**' / '*.*'), recursive=True)
+                    files, d = list_images(p, prefix)  # incremental *.index, faster than glob(p/'**'/'*.*')
+                    f += files
+                    dirs.update(d)
                     # f = list(p.rglob('*.*'))  # pathlib
                 elif p.is_file():  # file
+                    dirs[str(p)] = None  # listed files, no directory mtimes to check
                     with open(p) as t:
                         t = t.read().strip().splitlines()
                         parent = str(p.parent) + os.sep
@@ -479,15 +703,26 @@ class LoadImagesAndLabels(Dataset):
         except Exception as e:
             raise Exception(f'{prefix}Error loading data from {path}: {e}\n{HELP_URL}') from e
 
-        # Check cache
-        self.label_files = img2label_paths(self.im_files)  # labels
-        cache_path = (p if p.is_file() else Path(self.label_files[0]).parent).with_suffix('.cache')
+        # Check cache, directory datasets compare image and label directory mtimes instead of hashing every file: files
+        # added, removed or renamed are found, label files edited in place need a changed directory or a new cache
+        cache_path = (p if p.is_file() else Path(img2label_paths(self.im_files[:1])[0]).parent).with_suffix('.cache')
+        dirs = None if None in dirs.values() else {
+            **dirs, **dir_mtimes(Path(img2label_paths([os.path.join(d, 'x.jpg')])[0]).parent for d in dirs)}
+        if dirs:
+            dirs.pop(str(cache_path.parent), None)  # saving the *.cache changes the mtime of its own directory
+        self.label_files = None if dirs else img2label_paths(self.im_files)  # labels, only needed to hash and verify
         try:
-            cache, exists = np.load(cache_path, allow_pickle=True).item(), True  # load dict
+            cache = np.load(cache_path, allow_pickle=True).item()  # load dict
             assert cache['version'] == self.cache_version  # matches current version
-            assert cache['hash'] == get_hash(self.label_files + self.im_files)  # identical hash
+            if dirs:
+                exists = cache.get('dirs') == dirs  # identical directory mtimes
+            else:
+                exists = cache['hash'] == get_hash(self.label_files + self.im_files)  # identical hash
         except Exception:
-            cache, exists = self.cache_labels(cache_path, prefix), False  # run cache ops
+            cache, exists = {}, False
+        if not exists:
+            self.label_files = self.label_files or img2label_paths(self.im_files)
+            cache = self.cache_labels(cache_path, prefix, cache, dirs)  # run cache ops on new and changed files
 
         # Display cache
         nf, nm, ne, nc, n = cache.pop('results')  # found, missing, empty, corrupt, total
@@ -499,7 +734,7 @@ class LoadImagesAndLabels(Dataset):
         assert nf > 0 or not augment, f'{prefix}No labels found in {cache_path}, can not start training. {HELP_URL}'
 
         # Read cache
-        [cache.pop(k) for k in ('hash', 'version', 'msgs')]  # remove items
+        [cache.pop(k, None) for k in ('hash', 'version', 'msgs', 'files', 'dirs')]  # remove items
         labels, shapes, self.segments = zip(*cache.values())
         nl = len(np.concatenate(labels, 0))  # number of labels
         assert nl > 0 or not augment, f'{prefix}All labels empty in {cache_path}, can not start training. {HELP_URL}'
@@ -537,6 +772,8 @@ class LoadImagesAndLabels(Dataset):
                     self.segments[i] = segment[j]
             if single_cls:  # single-class training, merge all classes into 0
                 self.labels[i][:, 0] = 0
+        if self.batch_augment and any(len(x) for x in self.segments):
+            LOGGER.warning(f'{prefix}WARNING ⚠️ --batch-augment warps boxes only, label segments are ignored')
 
         # Rectangular Training
         if self.rect:
@@ -564,25 +801,47 @@ class LoadImagesAndLabels(Dataset):
             self.batch_shapes = np.ceil(np.array(shapes) * img_size / stride + pad).astype(int) * stride
 
         # Cache images into RAM/disk for faster training
-        if cache_images == 'ram' and not self.check_cache_ram(prefix=prefix):
+        if cache_images in ('ram', 'shm') and not self.check_cache_ram(prefix=prefix):
             cache_images = False
         self.ims = [None] * n
-        self.npy_files = [Path(f).with_suffix('.npy') for f in self.im_files]
-        if cache_images:
+        if cache_images == 'shm' or str(cache_images).startswith('disk'):  # packed shard files, disk or shared memory
+            self.cache_images_to_file(cache_images, cache_path, prefix)
+        elif cache_images:  # 'ram'
             b, gb = 0, 1 << 30  # bytes of cached images, bytes per gigabytes
             self.im_hw0, self.im_hw = [None] * n, [None] * n
-            fcn = self.cache_images_to_disk if cache_images == 'disk' else self.load_image
-            results = ThreadPool(NUM_THREADS).imap(fcn, range(n))
+            results = ThreadPool(NUM_THREADS).imap(self.load_image, range(n))
             pbar = tqdm(enumerate(results), total=n, bar_format=TQDM_BAR_FORMAT, disable=LOCAL_RANK > 0)
             for i, x in pbar:
-                if cache_images == 'disk':
-                    b += self.npy_files[i].stat().st_size
-                else:  # 'ram'
-                    self.ims[i], self.im_hw0[i], self.im_hw[i] = x  # im, hw_orig, hw_resized = load_image(self, i)
-                    b += self.ims[i].nbytes
+                self.ims[i], self.im_hw0[i], self.im_hw[i] = x  # im, hw_orig, hw_resized = load_image(self, i)
+                b += self.ims[i].nbytes
                 pbar.desc = f'{prefix}Caching images ({b / gb:.1f}GB {cache_images})'
             pbar.close()
 
+    def cache_images_to_file(self, cache_images, cache_path, prefix=''):
+        # Map resized images packed into shard files, packing them first if missing or outdated
+        # 'shm': /dev/shm (or tmp dir) file removed at exit, 'disk', 'disk-lz4', 'disk-zstd': kept next to cache_path
+        key = get_hash(self.im_files + [str(self.img_size), str(self.augment)])  # images, sizes and interpolation
+        if cache_images == 'shm':
+            file = (Path('/dev/shm') if Path('/dev/shm').is_dir() else Path(tempfile.gettempdir())) / f'yolov5_{key}'
+        else:
+            file = cache_path.with_name(f"{cache_path.stem}_{self.img_size}{'_aug' if self.augment else ''}.images")
+        try:
+            self.ims = MappedImages(file, key)
+        except Exception:
+            b, gb = 0, 1 << 30  # bytes of cached images, bytes per gigabytes
+            compress = cache_images.split('-')[1] if '-' in cache_images else None
+            results = MappedImages.write(file, ThreadPool(NUM_THREADS).imap(self.load_image, range(self.n)), key,
+                                         compress)
+            pbar = tqdm(results, total=self.n, bar_format=TQDM_BAR_FORMAT, disable=LOCAL_RANK > 0)
+            for im in pbar:
+                b += im.nbytes
+                pbar.desc = f'{prefix}Caching images ({b / gb:.1f}GB {cache_images})'
+            pbar.close()
+            if cache_images == 'shm':
+                atexit.register(lambda: [x.unlink() for x in file.parent.glob(f'{file.name}.*')])
+            self.ims = MappedImages(file, key)
+        self.im_hw0, self.im_hw = self.ims.index[:, 3:5].tolist(), self.ims.index[:, 5:7].tolist()
+
     def check_cache_ram(self, safety_margin=0.1, prefix=''):
         # Check image caching requirements vs available memory
         b, gb = 0, 1 << 30  # bytes of cached images, bytes per gigabytes
@@ -600,28 +859,40 @@ class LoadImagesAndLabels(Dataset):
                         f"{'caching images ✅' if cache else 'not caching images ⚠️'}")
         return cache
 
-    def cache_labels(self, path=Path('./labels.cache'), prefix=''):
-        # Cache dataset labels, check images and read shapes
+    def cache_labels(self, path=Path('./labels.cache'), prefix='', old=None, dirs=None):
+        # Cache dataset labels, check images and read shapes, re-verifying only files new or changed since old cache
+        # dirs: {directory: mtime} of all image and label directories, if listed, to skip the hash while unchanged
         x = {}  # dict
         nm, nf, ne, nc, msgs = 0, 0, 0, 0, []  # number missing, found, empty, corrupt, messages
         desc = f"{prefix}Scanning {path.parent / path.stem}..."
+        old = old or {}
+        stamps = ThreadPool(NUM_THREADS).map(file_stamp, zip(self.im_files, self.label_files))  # (size, mtime)
+        files = old.get('files', {})  # {im_file: ((size, mtime), nm, nf, ne, nc, msg)}
+        files = {f: files[f] for f, s in zip(self.im_files, stamps) if files.get(f, (None,))[0] == s}  # unchanged only
+        new = [(f, lb, s) for f, lb, s in zip(self.im_files, self.label_files, stamps) if f not in files]
         with Pool(NUM_THREADS) as pool:
-            pbar = tqdm(pool.imap(verify_image_label, zip(self.im_files, self.label_files, repeat(prefix))),
+            pbar = tqdm(pool.imap(verify_image_label, ((f, lb, prefix) for f, lb, _ in new)),
                         desc=desc,
                         total=len(self.im_files),
+                        initial=len(files),
                         bar_format=TQDM_BAR_FORMAT)
-            for im_file, lb, shape, segments, nm_f, nf_f, ne_f, nc_f, msg in pbar:
-                nm += nm_f
-                nf += nf_f
-                ne += ne_f
-                nc += nc_f
+            for (f, _, s), (im_file, lb, shape, segments, nm_f, nf_f, ne_f, nc_f, msg) in zip(new, pbar):
+                files[f] = s, nm_f, nf_f, ne_f, nc_f, msg
                 if im_file:
-                    x[im_file] = [lb, shape, segments]
-                if msg:
-                    msgs.append(msg)
-                pbar.desc = f"{desc} {nf} images, {nm + ne} backgrounds, {nc} corrupt"
+                    old[im_file] = [lb, shape, segments]
+                pbar.desc = f"{desc} {len(files)} checked, {len(new)} new or changed"
 
         pbar.close()
+        for f in self.im_files:  # in dataset order
+            _, nm_f, nf_f, ne_f, nc_f, msg = files[f]
+            nm += nm_f
+            nf += nf_f
+            ne += ne_f
+            nc += nc_f
+            if f in old and not nc_f:
+                x[f] = old[f]
+            if msg:
+                msgs.append(msg)
         if msgs:
             LOGGER.info('\n'.join(msgs))
         if nf == 0:
@@ -629,11 +900,14 @@ class LoadImagesAndLabels(Dataset):
         x['hash'] = get_hash(self.label_files + self.im_files)
         x['results'] = nf, nm, ne, nc, len(self.im_files)
         x['msgs'] = msgs  # warnings
+        x['files'] = files  # {im_file: ((size, mtime), nm, nf, ne, nc, msg)} for incremental updates
+        x['dirs'] = dirs  # {directory: mtime} when this cache was made
         x['version'] = self.cache_version  # cache version
         try:
-            np.save(path, x)  # save cache for next time
-            path.with_suffix('.cache.npy').rename(path)  # remove .npy suffix
-            LOGGER.info(f'{prefix}New cache created: {path}')
+            tmp = path.with_suffix(f'.{os.getpid()}.cache.npy')
+            np.save(tmp, x)  # save cache for next time
+            os.replace(tmp, path)  # atomic, other processes never read a partial cache
+            LOGGER.info(f'{prefix}New cache created: {path} ({len(new)} new or changed files verified)')
         except Exception as e:
             LOGGER.warning(f'{prefix}WARNING ⚠️ Cache directory {path.parent} is not writeable: {e}')  # not writeable
         return x
@@ -659,29 +933,48 @@ class LoadImagesAndLabels(Dataset):
 
             # MixUp augmentation
             if random.random() < hyp['mixup']:
-                img, labels = mixup(img, labels, *self.load_mosaic(random.randint(0, self.n - 1)))
+                img2, labels2 = self.load_mosaic(self.mixup_index(), k=1)
+                dst = self.buffer('labels_mixup', (len(labels) + len(labels2), 5), np.float32)  # mixed labels
+                img, labels = mixup(img, labels, img2, labels2, dst)
 
         else:
             # Load image
-            img, (h0, w0), (h, w) = self.load_image(index)
+            fuse = self.augment and self.fuse_warp and not self.batch_augment  # one warp from the loaded image
+            img, (h0, w0), (h, w) = self.load_image(index, resize=not fuse)
 
             # Letterbox
             shape = self.batch_shapes[self.batch[index]] if self.rect else self.img_size  # final letterboxed shape
-            img, ratio, pad = letterbox(img, shape, auto=False, scaleup=self.augment)
+            if fuse:  # letterbox() geometry only, image warped below
+                ratio, pad, (nw, nh), (top, bottom, left, right) = letterbox_params((h, w), shape, auto=False)
+                if nw < img.shape[1] / 2 or nh < img.shape[0] / 2:  # INTER_LINEAR warps alias below 0.5x, shrink first
+                    img = cv2.resize(img, (nw, nh), interpolation=cv2.INTER_AREA)
+                sx, sy = nw / img.shape[1], nh / img.shape[0]  # loaded image to letterbox scale, cv2.resize() centers
+                pre = np.array([[sx, 0, left + 0.5 * sx - 0.5], [0, sy, top + 0.5 * sy - 0.5], [0, 0, 1]])
+            else:
+                img, ratio, pad = letterbox(img, shape, auto=False, scaleup=self.augment)
             shapes = (h0, w0), ((h / h0, w / w0), pad)  # for COCO mAP rescaling
 
             labels = self.labels[index].copy()
             if labels.size:  # normalized xywh to pixel xyxy format
                 labels[:, 1:] = xywhn2xyxy(labels[:, 1:], ratio[0] * w, ratio[1] * h, padw=pad[0], padh=pad[1])
 
-            if self.augment:
+            if self.batch_augment:  # center in a (2s,2s) canvas like load_mosaic(), warped later by BatchAugment
+                b = -self.mosaic_border[0]
+                img = cv2.copyMakeBorder(img, b, b, b, b, cv2.BORDER_CONSTANT, value=(114, 114, 114))
+                labels[:, 1:] += b
+            elif self.augment:
+                im = img
                 img, labels = random_perspective(img,
                                                  labels,
                                                  degrees=hyp['degrees'],
                                                  translate=hyp['translate'],
                                                  scale=hyp['scale'],
                                                  shear=hyp['shear'],
-                                                 perspective=hyp['perspective'])
+                                                 perspective=hyp['perspective'],
+                                                 pre=pre if fuse else None,
+                                                 shape=(nh + top + bottom, nw + left + right) if fuse else None)
+                if img is im:  # identity warp returns the loaded image, which may be cached, copy before HSV in place
+                    img = img.copy()
 
         nl = len(labels)  # number of labels
         if nl:
@@ -692,6 +985,7 @@ class LoadImagesAndLabels(Dataset):
             img, labels = self.albumentations(img, labels)
             nl = len(labels)  # update after albumentations
 
+        if self.augment and not self.batch_augment:
             # HSV color-space
             augment_hsv(img, hgain=hyp['hsv_h'], sgain=hyp['hsv_s'], vgain=hyp['hsv_v'])
 
@@ -721,43 +1015,58 @@ class LoadImagesAndLabels(Dataset):
 
         return torch.from_numpy(img), labels_out, self.im_files[index], shapes
 
-    def load_image(self, i):
-        # Loads 1 image from dataset index 'i', returns (im, original hw, resized hw)
-        im, f, fn = self.ims[i], self.im_files[i], self.npy_files[i],
-        if im is None:  # not cached in RAM
-            if fn.exists():  # load npy
-                im = np.load(fn)
-            else:  # read image
-                im = cv2.imread(f)  # BGR
-                assert im is not None, f'Image Not Found {f}'
-            h0, w0 = im.shape[:2]  # orig hw
+    def load_image(self, i, resize=True):
+        # Loads 1 image from dataset index 'i', returns (im, original hw, resized hw), resize=False skips the resize
+        im, f = self.ims[i], self.im_files[i]
+        if im is None:  # not cached in RAM or packed files
+            w0, h0 = (int(x) for x in self.shapes[i])  # orig wh from labels cache, EXIF-corrected like cv2.imread()
+            r = self.img_size / max(h0, w0)  # ratio
+            k = 1  # decoder reduction
+            if self.augment and self.reduced_decode and f.lower().endswith(('.jpg', '.jpeg', '.mpo')):
+                k = next((x for x in (8, 4, 2) if r * x <= 1), 1)  # largest reduction still >= img_size
+            im = cv2.imread(f, REDUCED_COLOR[k])  # BGR
+            assert im is not None, f'Image Not Found {f}'
+            if k == 1:
+                h0, w0 = im.shape[:2]  # orig hw
+            elif im.shape[:2] != (math.ceil(h0 / k), math.ceil(w0 / k)):  # EXIF 5, 7 transposed by cv2, not exif_size()
+                h0, w0 = w0, h0  # orig hw in decoded orientation
             r = self.img_size / max(h0, w0)  # ratio
-            if r != 1:  # if sizes are not equal
+            if r != 1 and resize:  # if sizes are not equal
                 interp = cv2.INTER_LINEAR if (self.augment or r > 1) else cv2.INTER_AREA
                 im = cv2.resize(im, (int(w0 * r), int(h0 * r)), interpolation=interp)
-            return im, (h0, w0), im.shape[:2]  # im, hw_original, hw_resized
-        return self.ims[i], self.im_hw0[i], self.im_hw[i]  # im, hw_original, hw_resized
-
-    def cache_images_to_disk(self, i):
-        # Saves an image as an *.npy file for faster loading
-        f = self.npy_files[i]
-        if not f.exists():
-            np.save(f.as_posix(), cv2.imread(self.im_files[i]))
-
-    def load_mosaic(self, index):
-        # YOLOv5 4-mosaic loader. Loads 1 image + 3 random images into a 4-image mosaic
-        labels4, segments4 = [], []
+            return im, (h0, w0), (int(h0 * r), int(w0 * r))  # im, hw_original, hw_resized
+        return im, self.im_hw0[i], self.im_hw[i]  # im, hw_original, hw_resized
+
+    def buffer(self, name, shape, dtype=np.uint8):
+        # Return a reusable array of shape from this worker's buffers, only reallocated to grow
+        if not self.reuse_buffers:
+            return np.empty(shape, dtype=dtype)
+        b = self.buffers.get(name)
+        if b is None or len(b) < shape[0] or b.shape[1:] != tuple(shape[1:]) or b.dtype != dtype:
+            b = self.buffers[name] = np.empty((max(shape[0], 2 * len(b) if b is not None else 0), *shape[1:]), dtype)
+        return b[:shape[0]]
+
+    def mixup_index(self):
+        # Return a random dataset index for the MixUp mosaic
+        return random.randint(0, self.n - 1)
+
+    def load_mosaic(self, index, k=0):
+        # YOLOv5 4-mosaic loader. Loads 1 image + 3 random images into a 4-image mosaic, k: buffer set (1 for MixUp)
+        segments4 = []
         s = self.img_size
         yc, xc = (int(random.uniform(-x, 2 * s + x)) for x in self.mosaic_border)  # mosaic center x, y
         indices = [index] + random.choices(self.indices, k=3)  # 3 additional image indices
         random.shuffle(indices)
+        labels4 = self.buffer(f'labels4_{k}', (sum(len(self.labels[i]) for i in indices), 5), np.float32)
+        j = 0  # labels4 row
         for i, index in enumerate(indices):
             # Load image
             img, _, (h, w) = self.load_image(index)
 
             # place img in img4
             if i == 0:  # top left
-                img4 = np.full((s * 2, s * 2, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
+                img4 = self.buffer(f'mosaic4_{k}', (s * 2, s * 2, img.shape[2]))  # base image with 4 tiles
+                img4.fill(114)
                 x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc  # xmin, ymin, xmax, ymax (large image)
                 x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h  # xmin, ymin, xmax, ymax (small image)
             elif i == 1:  # top right
@@ -775,21 +1084,23 @@ class LoadImagesAndLabels(Dataset):
             padh = y1a - y1b
 
             # Labels
-            labels, segments = self.labels[index].copy(), self.segments[index].copy()
+            labels, segments = labels4[j:j + len(self.labels[index])], self.segments[index].copy()
+            labels[:] = self.labels[index]
+            j += len(labels)
             if labels.size:
                 labels[:, 1:] = xywhn2xyxy(labels[:, 1:], w, h, padw, padh)  # normalized xywh to pixel xyxy format
                 segments = [xyn2xy(x, w, h, padw, padh) for x in segments]
-            labels4.append(labels)
             segments4.extend(segments)
 
-        # Concat/clip labels
-        labels4 = np.concatenate(labels4, 0)
+        # Clip labels
         for x in (labels4[:, 1:], *segments4):
             np.clip(x, 0, 2 * s, out=x)  # clip when using random_perspective()
         # img4, labels4 = replicate(img4, labels4)  # replicate
 
         # Augment
         img4, labels4, segments4 = copy_paste(img4, labels4, segments4, p=self.hyp['copy_paste'])
+        if self.batch_augment:  # warped later by BatchAugment
+            return img4, labels4
         img4, labels4 = random_perspective(img4,
                                            labels4,
                                            segments4,
@@ -798,16 +1109,19 @@ class LoadImagesAndLabels(Dataset):
                                            scale=self.hyp['scale'],
                                            shear=self.hyp['shear'],
                                            perspective=self.hyp['perspective'],
-                                           border=self.mosaic_border)  # border to remove
+                                           border=self.mosaic_border,  # border to remove
+                                           dst=self.buffer(f'warp_{k}', (s, s, img4.shape[2])))
 
         return img4, labels4
 
     def load_mosaic9(self, index):
         # YOLOv5 9-mosaic loader. Loads 1 image + 8 random images into a 9-image mosaic
-        labels9, segments9 = [], []
+        segments9 = []
         s = self.img_size
         indices = [index] + random.choices(self.indices, k=8)  # 8 additional image indices
         random.shuffle(indices)
+        labels9 = self.buffer('labels9', (sum(len(self.labels[i]) for i in indices), 5), np.float32)
+        j = 0  # labels9 row
         hp, wp = -1, -1  # height, width previous
         for i, index in enumerate(indices):
             # Load image
@@ -815,7 +1129,8 @@ class LoadImagesAndLabels(Dataset):
 
             # place img in img9
             if i == 0:  # center
-                img9 = np.full((s * 3, s * 3, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
+                img9 = self.buffer('mosaic9', (s * 3, s * 3, img.shape[2]))  # base image with 4 tiles
+                img9.fill(114)
                 h0, w0 = h, w
                 c = s, s, s + w, s + h  # xmin, ymin, xmax, ymax (base) coordinates
             elif i == 1:  # top
@@ -839,11 +1154,12 @@ class LoadImagesAndLabels(Dataset):
             x1, y1, x2, y2 = (max(x, 0) for x in c)  # allocate coords
 
             # Labels
-            labels, segments = self.labels[index].copy(), self.segments[index].copy()
+            labels, segments = labels9[j:j + len(self.labels[index])], self.segments[index].copy()
+            labels[:] = self.labels[index]
+            j += len(labels)
             if labels.size:
                 labels[:, 1:] = xywhn2xyxy(labels[:, 1:], w, h, padx, pady)  # normalized xywh to pixel xyxy format
                 segments = [xyn2xy(x, w, h, padx, pady) for x in segments]
-            labels9.append(labels)
             segments9.extend(segments)
 
             # Image
@@ -854,8 +1170,7 @@ class LoadImagesAndLabels(Dataset):
         yc, xc = (int(random.uniform(0, s)) for _ in self.mosaic_border)  # mosaic center x, y
         img9 = img9[yc:yc + 2 * s, xc:xc + 2 * s]
 
-        # Concat/clip labels
-        labels9 = np.concatenate(labels9, 0)
+        # Offset/clip labels
         labels9[:, [1, 3]] -= xc
         labels9[:, [2, 4]] -= yc
         c = np.array([xc, yc])  # centers
@@ -875,7 +1190,8 @@ class LoadImagesAndLabels(Dataset):
                                            scale=self.hyp['scale'],
                                            shear=self.hyp['shear'],
                                            perspective=self.hyp['perspective'],
-                                           border=self.mosaic_border)  # border to remove
+                                           border=self.mosaic_border,  # border to remove
+                                           dst=self.buffer('warp9', (s, s, img9.shape[2])))
 
         return img9, labels9
 
@@ -913,6 +1229,159 @@ class LoadImagesAndLabels(Dataset):
         return torch.stack(im4, 0), torch.cat(label4, 0), path4, shapes4
 
 
+class LoadShardedImagesAndLabels(LoadImagesAndLabels, IterableDataset):
+    """ YOLOv5 train_loader streaming sequential tar shards written by pack_dataset.py
+    Shards hold images pre-resized to img_size and named by dataset index, labels, segments and shapes for the whole
+    split are in one small shards.cache so train.py can check classes and anchors up front. Each rank and dataloader
+    worker reads its own contiguous range of images, whole shards and at most two partial ones, front to back into a
+    buffer of decoded images, and __getitem__() mosaics and augments random buffered images exactly as
+    LoadImagesAndLabels does. --rect and --image-weights need random access.
+    """
+    version = 0.1  # shards.cache version
+    shuffle_buffer = 512  # decoded images held per dataloader worker for shuffling and mosaic when augmenting
+
+    def __init__(self,
+                 path,
+                 img_size=640,
+                 batch_size=16,
+                 augment=False,
+                 hyp=None,
+                 rect=False,
+                 image_weights=False,
+                 cache_images=False,
+                 single_cls=False,
+                 stride=32,
+                 pad=0.0,
+                 min_items=0,
+                 prefix='',
+                 batch_augment=False,
+                 fuse_warp=False):
+        assert not (rect or image_weights), f'{prefix}--rect and --image-weights are not supported for shards {path}'
+        self.path = Path(path)
+        x = np.load(self.path / 'shards.cache', allow_pickle=True).item()
+        assert x['version'] == self.version, f'{prefix}{path} version changed, run pack_dataset.py again'
+        assert x['img_size'] == img_size, f"{prefix}{path} packed at --img {x['img_size']}, not {img_size}"
+        self.img_size = img_size
+        self.augment = augment
+        self.hyp = hyp
+        self.image_weights = False
+        self.rect = False
+        self.mosaic = augment
+        self.batch_augment = batch_augment and self.mosaic
+        self.fuse_warp = fuse_warp
+        self.mosaic_border = [-img_size // 2, -img_size // 2]
+        self.stride = stride
+        self.albumentations = Albumentations(size=img_size) if augment else None
+        self.buffers = {}  # reusable arrays, one set per dataloader worker
+        self.shards = x['shards']  # [(file, number of images)]
+        self.im_files, self.labels, self.segments = x['files'], x['labels'], x['segments']
+        self.label_files = img2label_paths(self.im_files)
+        self.shapes, self.im_hw0, self.im_hw = x['shapes'], x['hw0'], x['hw']  # wh original, hw original, hw resized
+        self.n = len(self.im_files)
+        self.ims = [None] * self.n  # decoded images, buffered ones only
+        self.indices = []  # dataset indices in the buffer
+        if single_cls:  # single-class training, merge all classes into 0
+            for lb in self.labels:
+                lb[:, 0] = 0
+        nl = len(np.concatenate(self.labels, 0))  # number of labels
+        assert nl > 0 or not augment, f'{prefix}All labels empty in {path}, can not start training. {HELP_URL}'
+        if cache_images:
+            LOGGER.warning(f'{prefix}WARNING ⚠️ --cache {cache_images} ignored, images are streamed from shards')
+        if self.batch_augment and any(len(x) for x in self.segments):
+            LOGGER.warning(f'{prefix}WARNING ⚠️ --batch-augment warps boxes only, label segments are ignored')
+        if LOCAL_RANK in {-1, 0}:
+            LOGGER.info(f'{prefix}Streaming {self.n} images from {len(self.shards)} shards in {path}')
+
+    def __len__(self):
+        return self.n // WORLD_SIZE  # per DDP rank
+
+    def __iter__(self):
+        # Yield samples of random buffered images while streaming this worker's shards, then drain the buffer
+        n = self.shuffle_buffer if self.augment else 0
+        for i, im in self.stream():
+            self.ims[i] = im
+            self.indices.append(i)
+            if len(self.indices) > n:
+                yield self.pop()
+        while self.indices:
+            yield self.pop()
+
+    def pop(self):
+        # Return __getitem__() for a random buffered image (first if not augmenting) and remove it from the buffer
+        j = random.randrange(len(self.indices)) if self.augment else 0
+        x, i = self[j], self.indices[j]
+        self.indices[j] = self.indices[-1]
+        self.indices.pop()
+        self.ims[i] = None  # each image is streamed once per epoch
+        return x
+
+    def mixup_index(self):
+        # Return a random buffered dataset index for the MixUp mosaic, images outside the buffer are not decoded
+        return random.choice(self.indices)
+
+    def stream(self):
+        # Yield (index, image) of this rank and worker's contiguous range of shard members, len(self) over all workers
+        info = get_worker_info()
+        nw, w = (info.num_workers, info.id) if info else (1, 0)
+        k = len(self) // nw + (w < len(self) % nw)  # images to yield, equal across ranks so DDP steps stay in sync
+        a = max(RANK, 0) * self.n // WORLD_SIZE + w * (len(self) // nw) + min(w, len(self) % nw)  # first image
+        start = np.cumsum([0] + [n for _, n in self.shards])  # first image of each shard
+        parts = [(f, max(a - s, 0), min(a + k - s, n))  # (shard file, first member, last member + 1)
+                 for (f, n), s in zip(self.shards, start) if a < s + n and s < a + k]
+        for f, lo, hi in random.sample(parts, len(parts)) if self.augment else parts:
+            with tarfile.open(self.path / f, 'r:') as tar:  # sequential read, headers only for skipped members
+                for j, m in enumerate(tar):
+                    if j >= hi:
+                        break
+                    if j >= lo:
+                        i = int(m.name.split('.')[0])  # dataset index
+                        yield i, cv2.imdecode(np.frombuffer(tar.extractfile(m).read(), np.uint8), cv2.IMREAD_COLOR)
+
+    @classmethod
+    def write(cls, out, dataset, shard_size=1 << 30, ext='.jpg'):
+        # Pack LoadImagesAndLabels images resized to img_size into sequential tar shards, yields bytes per image
+        out, shards, hw0, hw, tar, nb, pid = Path(out), [], [], [], None, 0, os.getpid()
+        out.mkdir(parents=True, exist_ok=True)
+
+        def encode(i):
+            im, h0w0, h_w = dataset.load_image(i)
+            return cv2.imencode(ext, im)[1].tobytes(), h0w0, h_w
+
+        with ThreadPool(NUM_THREADS) as pool:
+            for i, (b, h0w0, h_w) in enumerate(pool.imap(encode, range(dataset.n))):
+                if tar is None or nb + len(b) > shard_size:  # next shard
+                    if tar:
+                        tar.close()
+                    shards.append([f'{len(shards):06d}.tar', 0])
+                    tar, nb = tarfile.open(out / f'{shards[-1][0]}.{pid}.tmp', 'w'), 0
+                m = tarfile.TarInfo(f'{i:08d}{ext}')
+                m.size = len(b)
+                tar.addfile(m, io.BytesIO(b))
+                shards[-1][1] += 1
+                nb += len(b)
+                hw0.append(h0w0)
+                hw.append(h_w)
+                yield len(b)
+        if tar:
+            tar.close()
+        for x in out.glob('*.tar'):  # previous shards
+            x.unlink()
+        for f, _ in shards:
+            (out / f'{f}.{pid}.tmp').rename(out / f)
+        x = {
+            'shards': [tuple(x) for x in shards],
+            'files': dataset.im_files,
+            'labels': dataset.labels,
+            'segments': dataset.segments,
+            'shapes': dataset.shapes,
+            'hw0': hw0,
+            'hw': hw,
+            'img_size': dataset.img_size,
+            'version': cls.version}
+        np.save(out / f'shards.{pid}.npy', x)
+        os.replace(out / f'shards.{pid}.npy', out / 'shards.cache')  # written last, marks complete shards
+
+
 # Ancillary functions --------------------------------------------------------------------------------------------------
 def flatten_recursive(path=DATASETS_DIR / 'coco128'):
     # Flatten a recursive directory by bringing all files to top level
@@ -984,6 +1453,11 @@ def autosplit(path=DATASETS_DIR / 'coco128/images', weights=(0.9, 0.1, 0.0), ann
                 f.write(f'./{img.relative_to(path.parent).as_posix()}' + '\n')  # add image to txt file
 
 
+def file_stamp(files):
+    # Return (size, mtime) of each existing file, for incremental label caches
+    return tuple((x.st_size, x.st_mtime_ns) for x in (os.stat(f) for f in files if os.path.exists(f)))
+
+
 def verify_image_label(args):
     # Verify one image-label pair
     im_file, lb_file, prefix = args
@@ -11,10 +11,12 @@ import logging.config
 import math
 import os
 import platform
+import queue
 import random
 import re
 import signal
 import sys
+import threading
 import time
 import urllib
 from copy import deepcopy
@@ -162,9 +164,9 @@ CONFIG_DIR = user_config_dir()  # Ultralytics settings dir
 
 class Profile(contextlib.ContextDecorator):
     # YOLOv5 Profile class. Usage: @Profile() decorator or 'with Profile():' context manager
-    def __init__(self, t=0.0):
+    def __init__(self, t=0.0, cuda=None):
         self.t = t
-        self.cuda = torch.cuda.is_available()
+        self.cuda = torch.cuda.is_available() if cuda is None else cuda  # cuda=False for CPU-only background stages
 
     def __enter__(self):
         self.start = self.time()
@@ -215,6 +217,240 @@ class WorkingDirectory(contextlib.ContextDecorator):
         os.chdir(self.cwd)
 
 
+class Stage:
+    # Pipeline stage running fn(*args) on queued args in a background thread. Usage: s = Stage(fn); s.put(args)
+    def __init__(self, fn, depth=2, dt=None):
+        self.q = queue.Queue(maxsize=depth)  # bounded, put() blocks when the stage falls behind
+        self.dt = dt or Profile(cuda=False)  # stage time
+        self.error = None
+        self.thread = threading.Thread(target=self._run, args=(fn,), daemon=True)
+        self.thread.start()
+
+    def _run(self, fn):
+        for args in iter(self.q.get, None):
+            if self.error is None:  # keep draining after an error so put() never blocks
+                try:
+                    with self.dt:
+                        fn(*args)
+                except Exception as e:
+                    self.error = e
+
+    def put(self, args):
+        if self.error:
+            raise self.error
+        self.q.put(args)
+
+    def close(self):
+        # Wait for queued args to finish, re-raising any stage error
+        self.q.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+
+
+def prefetch(iterable, depth=2, dt=None, fn=None):
+    # Iterate in a background thread up to depth items ahead of the consumer, fn(x) runs on each item in that thread
+    q, end = queue.Queue(maxsize=depth), object()
+    dt = dt or Profile(cuda=False)  # stage time
+
+    def worker():
+        try:
+            it = iter(iterable)
+            while True:
+                with dt:
+                    x = next(it, end)
+                    x = fn(x) if fn and x is not end else x
+                q.put(x)
+                if x is end:
+                    return
+        except Exception as e:
+            q.put(e)
+
+    threading.Thread(target=worker, daemon=True).start()
+    for x in iter(q.get, end):
+        if isinstance(x, Exception):
+            raise x
+        yield x
+
+
+class LabelWriter:
+    # Buffered --save-txt writer, one write per image to dir/{name}.txt, or appended to a single file with name prefixes
+    # Usage: w = LabelWriter(dir); w.write(name, det, shape); w.close()
+    def __init__(self, dir, save_conf=False, file=None, buffer=1 << 20, threaded=False):
+        self.dir = Path(dir)
+        self.save_conf = save_conf  # append confidences
+        self.f = open(file, 'a') if file else None  # single file for all images
+        self.buffer, self.lines, self.size = buffer, [], 0  # single file flush threshold (characters)
+        self.stage = Stage(self._write, depth=64) if threaded else None  # async text conversion and writes
+
+    def write(self, name, det, shape):
+        # Queue (n,6) xyxy, conf, cls pixel detections of one image with shape (h,w)
+        self.stage.put((name, det, shape)) if self.stage else self._write(name, det, shape)
+
+    def _write(self, name, det, shape):
+        if not len(det):
+            return
+        s = label_lines(det, shape, self.save_conf)
+        if self.f:
+            self.lines.append(''.join(f'{name} {x}\n' for x in s.splitlines()))
+            self.size += len(self.lines[-1])
+            if self.size > self.buffer:
+                self.flush()
+        else:
+            with open(self.dir / f'{name}.txt', 'a') as f:
+                f.write(s)
+
+    def flush(self):
+        if self.lines:
+            self.f.write(''.join(self.lines))
+            self.lines, self.size = [], 0
+
+    def close(self):
+        if self.stage:
+            self.stage.close()
+        if self.f:
+            self.flush()
+            self.f.close()
+
+
+DETECTIONS_FORMATS = 'npz', 'parquet', 'arrow'  # DetectionsWriter file formats
+DETECTIONS_COLUMNS = 'image', 'cls', 'conf', 'x1', 'y1', 'x2', 'y2'  # plus 'mask' COCO RLE json with masks=True
+
+
+class DetectionsWriter:
+    # Columnar detections sink written in row groups during inference, format by suffix: *.npz, *.parquet or *.arrow
+    # Usage: w = DetectionsWriter('detections.parquet'); w.write(image, det); w.close()
+    def __init__(self, file, rows=1 << 20, masks=False):
+        self.file = Path(file)
+        self.format = self.file.suffix[1:]
+        assert self.format in DETECTIONS_FORMATS, f'invalid format {self.file}, valid are {DETECTIONS_FORMATS}'
+        if self.format != 'npz':
+            check_requirements('pyarrow')
+        if self.file.exists():
+            self.file.unlink()  # npz row groups are appended
+        self.rows, self.masks = rows, masks  # rows per row group, mask RLE column
+        self.buffer, self.n, self.groups, self.writer = [], 0, 0, None
+
+    def write(self, image, det, masks=()):
+        # Buffer (n,6) xyxy, conf, cls pixel detections of one image, masks as n COCO RLE json strings if masks=True
+        if len(det):
+            det = det[:, :6].float().cpu().numpy() if isinstance(det, torch.Tensor) else np.asarray(det)[:, :6]
+            assert not self.masks or len(masks) == len(det), f'{len(det)} detections but {len(masks)} masks'
+            self.buffer.append((np.full(len(det), str(image)), det, np.asarray(masks if self.masks else [], str)))
+            self.n += len(det)
+            if self.n >= self.rows:
+                self.flush()
+
+    def flush(self):
+        # Write buffered detections as one row group
+        if not self.buffer:
+            return
+        images, det, masks = (np.concatenate(x) for x in zip(*self.buffer))
+        cols = dict(zip(DETECTIONS_COLUMNS, (images, det[:, 5].astype(np.int32), *det[:, [4, 0, 1, 2, 3]].T)))
+        if self.masks:
+            cols['mask'] = masks
+        if self.format == 'npz':  # one {column}_{group}.npy array per column and row group, np.load() reads lazily
+            with ZipFile(self.file, 'a') as z:
+                for k, v in cols.items():
+                    with z.open(f'{k}_{self.groups:05d}.npy', 'w', force_zip64=True) as f:
+                        np.lib.format.write_array(f, np.ascontiguousarray(v), allow_pickle=False)
+        else:
+            import pyarrow as pa
+            table = pa.table(cols)
+            if self.writer is None:
+                if self.format == 'parquet':
+                    import pyarrow.parquet as pq
+                    self.writer = pq.ParquetWriter(self.file, table.schema)
+                else:
+                    self.writer = pa.ipc.new_file(self.file, table.schema)
+            self.writer.write_table(table)
+        self.buffer, self.n = [], 0
+        self.groups += 1
+
+    def close(self):
+        if not self.groups and not self.buffer:  # no detections, write an empty row group so readers see the schema
+            self.buffer = [(np.empty(0, str), np.empty((0, 6), np.float32), np.empty(0, str))]
+        self.flush()
+        if self.writer:
+            self.writer.close()
+
+
+class DetectionsReader:
+    # Lazy per-image access to a DetectionsWriter file, holding an {image: row groups} index and one row group at a time
+    # Usage: r = DetectionsReader('detections.parquet'); det = r.get('image'); for image, det in r: ...; r.close()
+    def __init__(self, file):
+        self.file = Path(file)
+        self.format = self.file.suffix[1:]
+        assert self.format in DETECTIONS_FORMATS, f'invalid format {self.file}, valid are {DETECTIONS_FORMATS}'
+        if self.format == 'npz':
+            self.f = np.load(self.file)  # lazy NpzFile, arrays read per key
+            self.groups = sorted({k.rsplit('_', 1)[1] for k in self.f.files})
+            columns = {k.rsplit('_', 1)[0] for k in self.f.files}
+        else:
+            check_requirements('pyarrow')
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            if self.format == 'parquet':
+                self.f = pq.ParquetFile(self.file)
+            else:
+                self.source = pa.memory_map(str(self.file))
+                self.f = pa.ipc.open_file(self.source)
+            self.groups = list(range(self.f.num_row_groups if self.format == 'parquet' else self.f.num_record_batches))
+            columns = set((self.f.schema_arrow if self.format == 'parquet' else self.f.schema).names)
+        self.masks = 'mask' in columns  # COCO RLE json column, see rles()
+        self.index = {}  # image: row groups, built from image columns only
+        for g in range(len(self.groups)):
+            for image in np.unique(self.read(g, ('image',))['image']).tolist():
+                self.index.setdefault(image, []).append(g)
+        self.cache = None  # (row group, {image: ((n,6) detections, n mask RLEs)})
+
+    def __len__(self):
+        return len(self.index)  # number of images with detections
+
+    def __iter__(self):
+        for image in self.index:  # first row group order
+            yield image, self.get(image)
+
+    def read(self, g, columns=DETECTIONS_COLUMNS):
+        # Return {column: array} for row group 'g'
+        if self.format == 'npz':
+            return {k: self.f[f'{k}_{self.groups[g]}'] for k in columns}
+        t = self.f.read_row_group(g, columns=list(columns)) if self.format == 'parquet' else self.f.get_batch(g)
+        return {k: t.column(k).to_numpy(zero_copy_only=False) for k in columns}
+
+    def group(self, g):
+        # Return {image: ((n,6) xyxy, conf, cls array, n mask RLEs)} for row group 'g', cached until another is read
+        if self.cache is None or self.cache[0] != g:
+            cols = self.read(g, DETECTIONS_COLUMNS + ('mask',) if self.masks else DETECTIONS_COLUMNS)
+            det = np.stack([cols[k] for k in ('x1', 'y1', 'x2', 'y2', 'conf', 'cls')], 1).astype(np.float32)
+            i = np.argsort(cols['image'], kind='stable')  # group by image, keep detection order
+            images, start = np.unique(cols['image'][i], return_index=True)
+            masks = np.split(cols['mask'][i], start[1:]) if self.masks else [()] * len(images)
+            self.cache = g, dict(zip(images.tolist(), zip(np.split(det[i], start[1:]), masks)))
+        return self.cache[1]
+
+    def get(self, image):
+        # Return (n,6) xyxy, conf, cls detections of 'image', (0,6) if none
+        det = [self.group(g)[image][0] for g in self.index.get(image, ())]
+        return np.concatenate(det) if det else np.zeros((0, 6), np.float32)
+
+    def rles(self, image):
+        # Return COCO RLE json strings of 'image' masks in get() order, empty without a mask column
+        return [str(x) for g in self.index.get(image, ()) for x in self.group(g)[image][1]]
+
+    def close(self):
+        # Release the npz zip, parquet file or arrow memory map
+        (self.source if self.format == 'arrow' else self.f).close()
+
+
+def label_lines(det, shape, save_conf=False):
+    # Return normalized 'cls x y w h (conf)' label lines for (n,6) xyxy, conf, cls pixel detections in one conversion
+    gn = torch.tensor(shape, device=det.device)[[1, 0, 1, 0]]  # normalization gain whwh
+    x = torch.cat((det[:, 5:6], xyxy2xywh(det[:, :4]) / gn, det[:, 4:5]), 1)[:, :6 if save_conf else 5]
+    fmt = ('%g ' * x.shape[1]).rstrip() + '\n'
+    return ''.join(fmt % tuple(line) for line in x.tolist())
+
+
 def methods(instance):
     # Get class/instance methods
     return [f for f in dir(instance) if callable(getattr(instance, f)) and not f.startswith("__")]
@@ -840,6 +1076,14 @@ def scale_boxes(img1_shape, boxes, img0_shape, ratio_pad=None):
     return boxes
 
 
+def scale_boxes_batched(boxes, index, shapes):
+    # Rescale xyxy boxes of several batch images at once, index: batch image of each box, shapes: dataloader shapes
+    s = torch.tensor([(*pad, ratio[0], w0, h0) for (h0, w0), (ratio, pad) in shapes], dtype=boxes.dtype)
+    s = s.to(boxes.device)[index]  # (n,5) pad_w, pad_h, gain, w0, h0 per box
+    boxes = (boxes - s[:, [0, 1, 0, 1]]) / s[:, 2:3]
+    return torch.min(boxes.clamp(0), s[:, [3, 4, 3, 4]])  # clip to native shape
+
+
 def scale_segments(img1_shape, segments, img0_shape, ratio_pad=None, normalize=False):
     # Rescale coords (xyxy) from img1_shape to img0_shape
     if ratio_pad is None:  # calculate from img0_shape
@@ -881,6 +1125,90 @@ def clip_segments(segments, shape):
         segments[:, 1] = segments[:, 1].clip(0, shape[0])  # y
 
 
+class NMSStats:
+    # YOLOv5 NMSStats class, per-image pre-NMS truncation counts filled in by non_max_suppression(stats=)
+    def __init__(self, bs=1, k=30000, budget=None):
+        self.reset(bs, k, budget)
+
+    def reset(self, bs=1, k=30000, budget=None):
+        self.k = k  # pre-NMS top-k boxes per image
+        self.budget = budget  # NMS latency target per image (seconds)
+        self.candidates = [0] * bs  # boxes per image after confidence filtering
+        self.truncated = [0] * bs  # boxes per image dropped by pre-NMS top-k
+
+    def __len__(self):
+        return len(self.truncated)
+
+    def __str__(self):
+        n = sum(x > 0 for x in self.truncated)  # images truncated
+        return f'NMS top-{self.k}: {sum(self.truncated)} boxes truncated in {n}/{len(self)} images'
+
+
+NMS_COST = {}  # seconds per pre-NMS box, by device type
+
+
+def nms_cost(device=torch.device('cpu'), n=3000):
+    # Seconds per pre-NMS box of torchvision NMS on 'device', measured once per device type, call at warmup
+    if device.type not in NMS_COST:
+        boxes = torch.rand(n, 4, device=device) * 640
+        boxes[:, 2:] += boxes[:, :2]  # xywh-like to xyxy
+        scores = torch.rand(n, device=device)
+        torchvision.ops.nms(boxes, scores, 0.45)  # warmup
+        with Profile(cuda=device.type == 'cuda') as dt:
+            for _ in range(3):
+                torchvision.ops.nms(boxes, scores, 0.45)
+        NMS_COST[device.type] = dt.t / 3 / n
+    return NMS_COST[device.type]
+
+
+def nms_topk(budget, device=torch.device('cpu'), max_nms=30000):
+    # Pre-NMS top-k boxes per image that fit an NMS latency 'budget' (seconds per image) on 'device'
+    return int(min(max(budget / nms_cost(device), 1), max_nms))
+
+
+NMS_METHODS = 'hard', 'merge', 'soft', 'matrix', 'wbf'  # non_max_suppression() suppression methods
+
+
+def soft_nms(boxes, scores, score_thres=0.001, sigma=0.5, max_det=300):
+    # Gaussian Soft-NMS https://arxiv.org/abs/1704.04503, returns kept indices (descending score) and decayed scores
+    scores = scores.clone()
+    order, keep = torch.arange(len(scores), device=scores.device), []
+    while order.numel() and len(keep) < max_det:
+        j = scores[order].argmax()
+        keep.append(order[j])
+        order = order[torch.arange(len(order), device=order.device) != j]  # remove kept box
+        iou = box_iou(boxes[keep[-1]][None], boxes[order])[0]  # (1,n) IoU only, no dense matrix
+        scores[order] *= torch.exp(-iou ** 2 / sigma)  # decay overlapping scores
+        order = order[scores[order] > score_thres]
+    return (torch.stack(keep) if keep else order), scores
+
+
+def matrix_nms(boxes, scores, score_thres=0.001, sigma=2.0):
+    # Matrix NMS https://arxiv.org/abs/2003.10152 for boxes sorted by descending score, returns kept indices and scores
+    iou = box_iou(boxes, boxes).triu_(diagonal=1)  # IoU with higher-scored boxes
+    cmax = iou.max(0)[0]  # compensation, max IoU of each box with any higher-scored box
+    decay = torch.exp(-sigma * (iou ** 2 - cmax[:, None] ** 2)).min(0)[0]  # Gaussian decay
+    scores = scores * decay
+    i = (scores > score_thres).nonzero(as_tuple=False)[:, 0]
+    return i[scores[i].argsort(descending=True)], scores
+
+
+def weighted_boxes_fusion(boxes, scores, iou_thres=0.45):
+    # Weighted Boxes Fusion https://arxiv.org/abs/1910.13302, returns cluster indices, fused boxes and fused scores
+    i = torchvision.ops.nms(boxes, scores, iou_thres)  # cluster heads
+    iou, j = box_iou(boxes[i], boxes).max(0)  # (k,n) IoU, assign each box to its best cluster head
+    j[i] = torch.arange(len(i), device=i.device)  # heads always belong to their own cluster
+    m = iou > iou_thres
+    m[i] = True
+    j, w = j[m], scores[m]  # cluster index, weight
+    ws = torch.zeros_like(scores[i]).index_add_(0, j, w)  # sum of weights per cluster
+    b = boxes.clone()
+    b[i] = torch.zeros_like(boxes[i]).index_add_(0, j, boxes[m] * w[:, None]) / ws[:, None]  # fused boxes
+    s = scores.clone()
+    s[i] = ws / torch.bincount(j, minlength=len(i))  # fused scores, mean cluster score
+    return i[s[i].argsort(descending=True)], b, s
+
+
 def non_max_suppression(
         prediction,
         conf_thres=0.25,
@@ -891,6 +1219,10 @@ def non_max_suppression(
         labels=(),
         max_det=300,
         nm=0,  # number of masks
+        batched=False,  # single NMS call for the whole batch instead of a per-image loop
+        budget=None,  # NMS latency target per image (seconds), limits pre-NMS boxes to a top-k instead of a time limit
+        method='hard',  # suppression method, one of NMS_METHODS
+        stats=None,  # (optional) NMSStats, filled with per-image pre-NMS candidate and truncation counts
 ):
     """Non-Maximum Suppression (NMS) on inference results to reject overlapping detections
 
@@ -912,15 +1244,26 @@ def non_max_suppression(
     # Checks
     assert 0 <= conf_thres <= 1, f'Invalid Confidence threshold {conf_thres}, valid values are between 0.0 and 1.0'
     assert 0 <= iou_thres <= 1, f'Invalid IoU {iou_thres}, valid values are between 0.0 and 1.0'
+    assert method in NMS_METHODS, f'Invalid NMS method {method}, valid values are {NMS_METHODS}'
 
     # Settings
     # min_wh = 2  # (pixels) minimum box width and height
     max_wh = 7680  # (pixels) maximum box width and height
-    max_nms = 30000  # maximum number of boxes into torchvision.ops.nms()
+    max_nms = 3000 if method == 'matrix' else 30000  # maximum number of boxes into NMS, matrix-NMS is dense (n,n)
     time_limit = 0.5 + 0.05 * bs  # seconds to quit after
     redundant = True  # require redundant detections
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
-    merge = False  # use merge-NMS
+    merge = method == 'merge'  # use merge-NMS
+    if budget is not None:  # degrade by pre-NMS top-k, never skip images
+        max_nms = nms_topk(budget, prediction.device, max_nms)
+        time_limit = float('inf')
+    if stats is not None:
+        stats.reset(bs, max_nms, budget)
+
+    if batched and method == 'hard':  # other methods run per image
+        output = _batched_nms(prediction, xc, conf_thres, iou_thres, classes, agnostic, multi_label, labels, max_det,
+                              nm, max_wh, max_nms, stats)
+        return [x.to(device) for x in output] if mps else output
 
     t = time.time()
     mi = 5 + nc  # mask start index
@@ -968,6 +1311,8 @@ def non_max_suppression(
 
         # Check shape
         n = x.shape[0]  # number of boxes
+        if stats is not None:
+            stats.candidates[xi], stats.truncated[xi] = n, max(n - max_nms, 0)
         if not n:  # no boxes
             continue
         elif n > max_nms:  # excess boxes
@@ -978,7 +1323,15 @@ def non_max_suppression(
         # Batched NMS
         c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
         boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
-        i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
+        if method == 'soft':  # decay overlapping scores sequentially
+            i, x[:, 4] = soft_nms(boxes, scores, score_thres=conf_thres, max_det=max_det)
+        elif method == 'matrix':  # decay overlapping scores in parallel
+            i, x[:, 4] = matrix_nms(boxes, scores, score_thres=conf_thres)
+        elif method == 'wbf':  # fuse clusters into score-weighted boxes
+            i, b, x[:, 4] = weighted_boxes_fusion(boxes, scores, iou_thres)
+            x[:, :4] = b - c  # remove class offsets
+        else:  # 'hard', 'merge'
+            i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
         if i.shape[0] > max_det:  # limit detections
             i = i[:max_det]
         if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
@@ -999,6 +1352,169 @@ def non_max_suppression(
     return output
 
 
+def _batched_nms(prediction, xc, conf_thres, iou_thres, classes, agnostic, multi_label, labels, max_det, nm, max_wh,
+                 max_nms, stats=None):
+    # Loop-free NMS over the whole batch, boxes are offset by (image, class) group and suppressed in one NMS call
+    bs = prediction.shape[0]  # batch size
+    nc = prediction.shape[2] - nm - 5  # number of classes
+    mi = 5 + nc  # mask start index
+    b, a = xc.nonzero(as_tuple=True)  # image index, anchor index of candidates
+    x = prediction[b, a]  # candidates (n, 5+nc+nm)
+
+    # Cat apriori labels if autolabelling
+    if labels and any(len(lb) for lb in labels):
+        v = torch.zeros((sum(len(lb) for lb in labels), nc + nm + 5), device=x.device)
+        lb = torch.cat([lb for lb in labels if len(lb)], 0)
+        v[:, :4] = lb[:, 1:5]  # box
+        v[:, 4] = 1.0  # conf
+        v[range(len(lb)), lb[:, 0].long() + 5] = 1.0  # cls
+        bv = torch.cat([torch.full((len(lb),), xi, device=x.device) for xi, lb in enumerate(labels) if len(lb)])
+        x, b = torch.cat((x, v), 0), torch.cat((b, bv.long()), 0)
+
+    # Compute conf
+    x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+
+    # Box/Mask
+    box = xywh2xyxy(x[:, :4])  # center_x, center_y, width, height) to (x1, y1, x2, y2)
+    mask = x[:, mi:]  # zero columns if no masks
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    if multi_label:
+        i, j = (x[:, 5:mi] > conf_thres).nonzero(as_tuple=False).T
+        x, b = torch.cat((box[i], x[i, 5 + j, None], j[:, None].float(), mask[i]), 1), b[i]
+    else:  # best class only
+        conf, j = x[:, 5:mi].max(1, keepdim=True)
+        i = conf.view(-1) > conf_thres
+        x, b = torch.cat((box, conf, j.float(), mask), 1)[i], b[i]
+
+    # Filter by class
+    if classes is not None:
+        i = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, b = x[i], b[i]
+
+    # Sort by image then confidence, keep at most max_nms boxes per image
+    i = (b * 4 - x[:, 4].double()).argsort()  # image ascending, confidence descending
+    x, b = x[i], b[i]
+    n = torch.bincount(b, minlength=bs)  # boxes per image
+    rank = torch.arange(len(b), device=b.device) - (n.cumsum(0) - n)[b]  # index within image
+    if stats is not None:
+        stats.candidates, stats.truncated = n.tolist(), (n - max_nms).clamp(min=0).tolist()
+    if (n > max_nms).any():  # excess boxes
+        i = rank < max_nms
+        x, b = x[i], b[i]
+
+    # Batched NMS, offsets computed in float64 to keep full box precision
+    g = b * (1 if agnostic else nc + 1) + (0 if agnostic else x[:, 5].long())  # (image, class) group
+    boxes, scores = x[:, :4].double() + (g * max_wh)[:, None], x[:, 4].double()  # boxes (offset by group), scores
+    i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS, sorted by descending score
+
+    # Limit detections per image and split into per-image outputs
+    i = i[(b[i] * 4 - scores[i]).argsort()]  # image ascending, confidence descending
+    n = torch.bincount(b[i], minlength=bs)  # detections per image
+    rank = torch.arange(len(i), device=i.device) - (n.cumsum(0) - n)[b[i]]  # index within image
+    i = i[rank < max_det]
+    return list(x[i].split(n.clamp(max=max_det).tolist()))
+
+
+def box_iou_numpy(box1, box2, eps=1e-7):
+    # (n,4) and (m,4) xyxy boxes to (n,m) IoU matrix in NumPy
+    (a1, b1, a2, b2), (c1, d1, c2, d2) = box1.T[..., None], box2.T[:, None]  # (n,1) and (1,m) coordinates
+    inter = (np.minimum(a2, c2) - np.maximum(a1, c1)).clip(0) * (np.minimum(b2, d2) - np.maximum(b1, d1)).clip(0)
+    return inter / ((a2 - a1) * (b2 - b1) + (c2 - c1) * (d2 - d1) - inter + eps)
+
+
+def nms_numpy(boxes, scores, iou_thres=0.45, block=32):
+    # Greedy NMS of (n,4) xyxy boxes in NumPy, returns kept indices sorted by descending score (torchvision.ops.nms)
+    # Vectorized over blocks of the highest-scored undecided boxes: a matrix IoU triu pass keeps every box with no
+    # undecided higher-scored overlap and drops the boxes these overlap, repeated until the block is decided, then all
+    # later boxes overlapping the kept ones are dropped at once. Exactly greedy NMS with (block,n) memory
+    order = scores.argsort()[::-1]  # sort by confidence
+    boxes, rest, keep = boxes[order], np.arange(len(order)), []
+    while rest.size:
+        i, rest = rest[:block], rest[block:]
+        over = np.triu(box_iou_numpy(boxes[i], boxes[i]) > iou_thres, 1).astype(np.float32)  # (i,j) i higher-scored
+        undecided, k = np.ones(len(i), dtype=np.float32), np.zeros(len(i), dtype=bool)
+        while undecided.any():
+            ki = undecided * (undecided @ over == 0)  # no undecided higher-scored overlap, keep
+            undecided *= (ki @ over == 0) * (1 - ki)  # drop kept and suppressed boxes
+            k |= ki > 0
+        keep.append(i[k])
+        rest = rest[(box_iou_numpy(boxes[i[k]], boxes[rest]) <= iou_thres).all(0)]  # drop overlapping later boxes
+    return order[np.concatenate(keep)] if keep else order[:0]
+
+
+def non_max_suppression_numpy(
+        prediction,
+        conf_thres=0.25,
+        iou_thres=0.45,
+        classes=None,
+        agnostic=False,
+        multi_label=False,
+        max_det=300,
+        nm=0,  # number of masks
+):
+    """Non-Maximum Suppression (NMS) in NumPy for non-PyTorch backends, i.e. DetectMultiBackend numpy outputs
+
+    Returns:
+         list of detections, on (n,6) np.ndarray per image [xyxy, conf, cls]
+    """
+
+    if isinstance(prediction, (list, tuple)):  # segmentation models output = (pred, proto)
+        prediction = prediction[0]  # select only inference output
+
+    bs = prediction.shape[0]  # batch size
+    nc = prediction.shape[2] - nm - 5  # number of classes
+    xc = prediction[..., 4] > conf_thres  # candidates
+
+    # Checks
+    assert 0 <= conf_thres <= 1, f'Invalid Confidence threshold {conf_thres}, valid values are between 0.0 and 1.0'
+    assert 0 <= iou_thres <= 1, f'Invalid IoU {iou_thres}, valid values are between 0.0 and 1.0'
+
+    # Settings
+    max_wh = 7680  # (pixels) maximum box width and height
+    max_nms = 30000  # maximum number of boxes into nms_numpy()
+    multi_label &= nc > 1  # multiple labels per box
+
+    mi = 5 + nc  # mask start index
+    output = [np.zeros((0, 6 + nm), dtype=prediction.dtype)] * bs
+    for xi, x in enumerate(prediction):  # image index, image inference
+        x = x[xc[xi]]  # confidence
+        if not x.shape[0]:
+            continue
+
+        # Compute conf
+        x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+
+        # Box/Mask
+        box = xywh2xyxy(x[:, :4])  # center_x, center_y, width, height) to (x1, y1, x2, y2)
+        mask = x[:, mi:]  # zero columns if no masks
+
+        # Detections matrix nx6 (xyxy, conf, cls)
+        if multi_label:
+            i, j = (x[:, 5:mi] > conf_thres).nonzero()
+            x = np.concatenate((box[i], x[i, 5 + j][:, None], j[:, None].astype(x.dtype), mask[i]), 1)
+        else:  # best class only
+            j = x[:, 5:mi].argmax(1)
+            conf = x[:, 5:mi].max(1)
+            x = np.concatenate((box, conf[:, None], j[:, None].astype(x.dtype), mask), 1)[conf > conf_thres]
+
+        # Filter by class
+        if classes is not None:
+            x = x[(x[:, 5:6] == np.array(classes)).any(1)]
+
+        # Check shape
+        if not x.shape[0]:  # no boxes
+            continue
+        x = x[x[:, 4].argsort()[::-1][:max_nms]]  # sort by confidence and remove excess boxes
+
+        # Batched NMS
+        c = x[:, 5:6].astype(np.float32) * (0 if agnostic else max_wh)  # classes (float32 to avoid FP16 overflow)
+        i = nms_numpy(x[:, :4] + c, x[:, 4], iou_thres)[:max_det]  # NMS, limit detections
+        output[xi] = x[i]
+
+    return output
+
+
 def strip_optimizer(f='best.pt', s=''):  # from utils.general import *; strip_optimizer()
     # Strip optimizer from 'f' to finalize training, optionally save as 's'
     x = torch.load(f, map_location=torch.device('cpu'))
@@ -27,6 +27,7 @@ from pathlib import Path
 
 import numpy as np
 import torch
+from torch.utils.data import DataLoader
 from tqdm import tqdm
 
 FILE = Path(__file__).resolve()
@@ -38,24 +39,15 @@ ROOT = Path(os.path.relpath(ROOT, Path.cwd()))  # relative
 from models.common import DetectMultiBackend
 from utils.callbacks import Callbacks
 from utils.dataloaders import create_dataloader
-from utils.general import (LOGGER, TQDM_BAR_FORMAT, Profile, check_dataset, check_img_size, check_requirements,
-                           check_yaml, coco80_to_coco91_class, colorstr, increment_path, non_max_suppression,
-                           print_args, scale_boxes, xywh2xyxy, xyxy2xywh)
-from utils.metrics import ConfusionMatrix, ap_per_class, box_iou
+from utils.general import (DETECTIONS_FORMATS, LOGGER, NMS_METHODS, TQDM_BAR_FORMAT, DetectionsWriter, LabelWriter,
+                           DetectionsReader, Profile, check_dataset, check_img_size, check_requirements, check_yaml,
+                           coco80_to_coco91_class, colorstr, increment_path, non_max_suppression,
+                           print_args, scale_boxes, scale_boxes_batched, xywh2xyxy, xyxy2xywh)
+from utils.metrics import APAccumulator, COCOEvaluator, ConfusionMatrix, box_iou, match_predictions
 from utils.plots import output_to_target, plot_images, plot_val_study
 from utils.torch_utils import select_device, smart_inference_mode
 
 
-def save_one_txt(predn, save_conf, shape, file):
-    # Save one txt result
-    gn = torch.tensor(shape)[[1, 0, 1, 0]]  # normalization gain whwh
-    for *xyxy, conf, cls in predn.tolist():
-        xywh = (xyxy2xywh(torch.tensor(xyxy).view(1, 4)) / gn).view(-1).tolist()  # normalized xywh
-        line = (cls, *xywh, conf) if save_conf else (cls, *xywh)  # label format
-        with open(file, 'a') as f:
-            f.write(('%g ' * len(line)).rstrip() % line + '\n')
-
-
 def save_one_json(predn, jdict, path, class_map):
     # Save one JSON result {"image_id": 42, "category_id": 18, "bbox": [258.15, 41.29, 348.26, 243.78], "score": 0.236}
     image_id = int(path.stem) if path.stem.isnumeric() else path.stem
@@ -78,20 +70,9 @@ def process_batch(detections, labels, iouv):
     Returns:
         correct (array[N, 10]), for 10 IoU levels
     """
-    correct = np.zeros((detections.shape[0], iouv.shape[0])).astype(bool)
     iou = box_iou(labels[:, 1:], detections[:, :4])
     correct_class = labels[:, 0:1] == detections[:, 5]
-    for i in range(len(iouv)):
-        x = torch.where((iou >= iouv[i]) & correct_class)  # IoU > threshold and classes match
-        if x[0].shape[0]:
-            matches = torch.cat((torch.stack(x, 1), iou[x[0], x[1]][:, None]), 1).cpu().numpy()  # [label, detect, iou]
-            if x[0].shape[0] > 1:
-                matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 1], return_index=True)[1]]
-                # matches = matches[matches[:, 2].argsort()[::-1]]
-                matches = matches[np.unique(matches[:, 0], return_index=True)[1]]
-            correct[matches[:, 1].astype(int), i] = True
-    return torch.tensor(correct, dtype=torch.bool, device=iouv.device)
+    return match_predictions(iou, correct_class, iouv)  # all IoU levels at once, on device
 
 
 @smart_inference_mode()
@@ -103,6 +84,8 @@ def run(
         conf_thres=0.001,  # confidence threshold
         iou_thres=0.6,  # NMS IoU threshold
         max_det=300,  # maximum detections per image
+        batched_nms=False,  # run one NMS call per batch instead of per image
+        nms='hard',  # NMS method: hard, merge, soft, matrix or wbf
         task='val',  # train, val, test, speed or study
         device='',  # cuda device, i.e. 0 or 0,1,2,3 or cpu
         workers=8,  # max dataloader workers (per RANK in DDP mode)
@@ -112,7 +95,16 @@ def run(
         save_txt=False,  # save results to *.txt
         save_hybrid=False,  # save label+prediction hybrid results to *.txt
         save_conf=False,  # save confidences in --save-txt labels
+        save_txt_file=None,  # (optional) append all --save-txt labels to this one file, prefixed by image name
+        save_txt_async=False,  # write --save-txt labels in a background thread
         save_json=False,  # save a COCO-JSON results file
+        native_coco=False,  # evaluate --save-json results with the native COCOEvaluator instead of pycocotools
+        save_detections=None,  # (optional) save detections to a columnar file: npz, parquet or arrow
+        detections=None,  # (optional) evaluate a saved detections file instead of model predictions
+        ap_bins=0,  # streaming mAP from per-class confidence histograms with this many bins, 0 = exact
+        batch_metrics=False,  # compute metrics for whole batches on device, no per-image host sync
+        shards=1,  # split the dataset across this many processes, each with its own model
+        shard=None,  # (internal) index of this --shards process, returns raw metric state
         project=ROOT / 'runs/val',  # save to project/name
         name='exp',  # save to project/name
         exist_ok=False,  # existing project/name ok, do not increment
@@ -126,7 +118,10 @@ def run(
         compute_loss=None,
 ):
     # Initialize/load model and set device
+    args = {k: v for k, v in locals().items() if k != 'callbacks'}  # run() arguments for --shards processes
     training = model is not None
+    parallel = shards > 1 and shard is None and not training  # spawn --shards processes and merge their results
+    assert not (parallel and (save_txt_file or save_detections)), '--shards does not support single output files'
     if training:  # called by train.py
         device, pt, jit, engine = next(model.parameters()).device, True, False, False  # get model device, PyTorch model
         half &= device.type != 'cpu'  # half precision only supported on CUDA
@@ -180,6 +175,15 @@ def run(
                                        rect=rect,
                                        workers=workers,
                                        prefix=colorstr(f'{task}: '))[0]
+        if shard is not None:  # contiguous batches of this --shards process, same rect shapes as a single process
+            dataset, bs = dataloader.dataset, dataloader.batch_size
+            n = [len(x) for x in np.array_split(np.arange(len(dataloader)), shards)]  # batches per shard
+            dataloader = DataLoader(dataset,
+                                    batch_size=bs,
+                                    sampler=range(sum(n[:shard]) * bs, min(sum(n[:shard + 1]) * bs, len(dataset))),
+                                    num_workers=dataloader.num_workers,
+                                    pin_memory=dataloader.pin_memory,
+                                    collate_fn=dataloader.collate_fn)
 
     seen = 0
     confusion_matrix = ConfusionMatrix(nc=nc)
@@ -191,9 +195,15 @@ def run(
     tp, fp, p, r, f1, mp, mr, map50, ap50, map = 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0
     dt = Profile(), Profile(), Profile()  # profiling times
     loss = torch.zeros(3, device=device)
-    jdict, stats, ap, ap_class = [], [], [], []
+    jdict, ap, ap_class = [], [], []
+    stats = APAccumulator(nc, niou, bins=ap_bins, device=device)  # (correct, conf, pcls, tcls) accumulator
+    label_writer = None  # --save-txt labels
+    if save_txt:
+        label_writer = LabelWriter(save_dir / 'labels', save_conf, file=save_txt_file, threaded=save_txt_async)
+    det_writer = DetectionsWriter(save_dir / f'detections.{save_detections}') if save_detections else None
+    saved = DetectionsReader(detections) if detections else None  # lazy (n,6) native-space detections per image
     callbacks.run('on_val_start')
-    pbar = tqdm(dataloader, desc=s, bar_format=TQDM_BAR_FORMAT)  # progress bar
+    pbar = tqdm(() if parallel else dataloader, desc=s, bar_format=TQDM_BAR_FORMAT, disable=bool(shard))  # progress bar
     for batch_i, (im, targets, paths, shapes) in enumerate(pbar):
         callbacks.run('on_val_batch_start')
         with dt[0]:
@@ -206,7 +216,14 @@ def run(
 
         # Inference
         with dt[1]:
-            preds, train_out = model(im) if compute_loss else (model(im, augment=augment), None)
+            if saved is not None:  # saved native-space detections to letterbox space, no model
+                preds = []
+                for p, (_, ((gain, _), pad)) in zip(paths, shapes):
+                    x = torch.tensor(saved.get(Path(p).stem), device=device)
+                    x[:, :4] = x[:, :4] * gain + torch.tensor(pad * 2, device=device)
+                    preds.append(x)
+            else:
+                preds, train_out = model(im) if compute_loss else (model(im, augment=augment), None)
 
         # Loss
         if compute_loss:
@@ -216,66 +233,123 @@ def run(
         targets[:, 2:] *= torch.tensor((width, height, width, height), device=device)  # to pixels
         lb = [targets[targets[:, 0] == i, 1:] for i in range(nb)] if save_hybrid else []  # for autolabelling
         with dt[2]:
-            preds = non_max_suppression(preds,
-                                        conf_thres,
-                                        iou_thres,
-                                        labels=lb,
-                                        multi_label=True,
-                                        agnostic=single_cls,
-                                        max_det=max_det)
+            if saved is None:
+                preds = non_max_suppression(preds,
+                                            conf_thres,
+                                            iou_thres,
+                                            labels=lb,
+                                            multi_label=True,
+                                            agnostic=single_cls,
+                                            max_det=max_det,
+                                            batched=batched_nms,
+                                            method=nms)
 
         # Metrics
-        for si, pred in enumerate(preds):
-            labels = targets[targets[:, 0] == si, 1:]
-            nl, npr = labels.shape[0], pred.shape[0]  # number of labels, predictions
-            path, shape = Path(paths[si]), shapes[si][0]
-            correct = torch.zeros(npr, niou, dtype=torch.bool, device=device)  # init
-            seen += 1
-
-            if npr == 0:
-                if nl:
-                    stats.append((correct, *torch.zeros((2, 0), device=device), labels[:, 0]))
-                    if plots:
-                        confusion_matrix.process_batch(detections=None, labels=labels[:, 0])
-                continue
-
-            # Predictions
+        if batch_metrics:
+            n = [len(x) for x in preds]  # predictions per image
+            pi = torch.from_numpy(np.repeat(np.arange(nb), n)).to(device)  # image index per prediction
+            ti = targets[:, 0].long()  # image index per label
+            pred = torch.cat(preds, 0)
             if single_cls:
                 pred[:, 5] = 0
-            predn = pred.clone()
-            scale_boxes(im[si].shape[1:], predn[:, :4], shape, shapes[si][1])  # native-space pred
-
-            # Evaluate
-            if nl:
-                tbox = xywh2xyxy(labels[:, 1:5])  # target boxes
-                scale_boxes(im[si].shape[1:], tbox, shape, shapes[si][1])  # native-space labels
-                labelsn = torch.cat((labels[:, 0:1], tbox), 1)  # native-space labels
-                correct = process_batch(predn, labelsn, iouv)
-                if plots:
-                    confusion_matrix.process_batch(predn, labelsn)
-            stats.append((correct, pred[:, 4], pred[:, 5], labels[:, 0]))  # (correct, conf, pcls, tcls)
-
-            # Save/log
-            if save_txt:
-                save_one_txt(predn, save_conf, shape, file=save_dir / 'labels' / f'{path.stem}.txt')
-            if save_json:
-                save_one_json(predn, jdict, path, class_map)  # append to COCO-JSON dictionary
-            callbacks.run('on_val_image_end', pred, predn, path, names, im[si])
+                preds = pred.split(n)
+            predn = torch.cat((scale_boxes_batched(pred[:, :4], pi, shapes), pred[:, 4:]), 1)  # native-space preds
+            tbox = scale_boxes_batched(xywh2xyxy(targets[:, 2:6]), ti, shapes)  # native-space labels
+            labelsn = torch.cat((targets[:, 1:2], tbox), 1)
+            correct_class = (labelsn[:, 0:1] == predn[:, 5]) & (ti[:, None] == pi)  # same class and image
+            correct = match_predictions(box_iou(tbox, predn[:, :4]), correct_class, iouv)
+            stats.update(correct, pred[:, 4], pred[:, 5], targets[:, 1])  # (correct, conf, pcls, tcls)
+            if plots:
+                confusion_matrix.process_images(predn, labelsn, pi, ti)
+            seen += nb
+
+            # Save/log, per image only when needed
+            if save_txt or det_writer or save_json or callbacks.get_registered_actions('on_val_image_end'):
+                for si, (pred, predn) in enumerate(zip(preds, predn.split(n))):
+                    path, shape = Path(paths[si]), shapes[si][0]
+                    if save_txt:
+                        label_writer.write(path.stem, predn, shape)
+                    if det_writer:
+                        det_writer.write(path.stem, predn)
+                    if save_json:
+                        save_one_json(predn, jdict, path, class_map)  # append to COCO-JSON dictionary
+                    callbacks.run('on_val_image_end', pred, predn, path, names, im[si])
+        else:
+            for si, pred in enumerate(preds):
+                labels = targets[targets[:, 0] == si, 1:]
+                nl, npr = labels.shape[0], pred.shape[0]  # number of labels, predictions
+                path, shape = Path(paths[si]), shapes[si][0]
+                correct = torch.zeros(npr, niou, dtype=torch.bool, device=device)  # init
+                seen += 1
+
+                if npr == 0:
+                    if nl:
+                        stats.update(correct, *torch.zeros((2, 0), device=device), labels[:, 0])
+                        if plots:
+                            confusion_matrix.process_batch(detections=None, labels=labels[:, 0])
+                    continue
+
+                # Predictions
+                if single_cls:
+                    pred[:, 5] = 0
+                predn = pred.clone()
+                scale_boxes(im[si].shape[1:], predn[:, :4], shape, shapes[si][1])  # native-space pred
+
+                # Evaluate
+                if nl:
+                    tbox = xywh2xyxy(labels[:, 1:5])  # target boxes
+                    scale_boxes(im[si].shape[1:], tbox, shape, shapes[si][1])  # native-space labels
+                    labelsn = torch.cat((labels[:, 0:1], tbox), 1)  # native-space labels
+                    correct = process_batch(predn, labelsn, iouv)
+                    if plots:
+                        confusion_matrix.process_batch(predn, labelsn)
+                stats.update(correct, pred[:, 4], pred[:, 5], labels[:, 0])  # (correct, conf, pcls, tcls)
+
+                # Save/log
+                if save_txt:
+                    label_writer.write(path.stem, predn, shape)
+                if det_writer:
+                    det_writer.write(path.stem, predn)
+                if save_json:
+                    save_one_json(predn, jdict, path, class_map)  # append to COCO-JSON dictionary
+                callbacks.run('on_val_image_end', pred, predn, path, names, im[si])
 
         # Plot images
-        if plots and batch_i < 3:
+        if plots and batch_i < 3 and not shard:
             plot_images(im, targets, paths, save_dir / f'val_batch{batch_i}_labels.jpg', names)  # labels
             plot_images(im, output_to_target(preds), paths, save_dir / f'val_batch{batch_i}_pred.jpg', names)  # pred
 
         callbacks.run('on_val_batch_end', batch_i, im, targets, paths, shapes, preds)
 
+    # Merge --shards
+    if shard is not None:  # raw state for the parent process
+        if label_writer:
+            label_writer.close()
+        return stats, confusion_matrix, seen, jdict, loss, dt
+    if parallel:
+        LOGGER.info(f'Validating {len(dataloader.dataset)} images in {shards} processes...')
+        files = [save_dir / f'shard{i}.pt' for i in range(shards)]
+        args.update(project=save_dir.parent, name=save_dir.name, exist_ok=True, workers=workers // shards)
+        with Profile(cuda=False) as wall:  # parent wall-clock time, shard times below overlap
+            torch.multiprocessing.spawn(run_shard, args=(args, files), nprocs=shards)
+        for f in files:
+            x_stats, x_confusion_matrix, x_seen, x_jdict, x_loss, x_dt = torch.load(f, map_location=device)
+            f.unlink()
+            stats.merge(x_stats)
+            confusion_matrix.merge(x_confusion_matrix)
+            seen += x_seen
+            jdict += x_jdict
+            loss += x_loss
+            for a, b in zip(dt, x_dt):
+                a.t += b.t  # summed process time, i.e. per-image compute cost
+
     # Compute metrics
-    stats = [torch.cat(x, 0).cpu().numpy() for x in zip(*stats)]  # to numpy
-    if len(stats) and stats[0].any():
-        tp, fp, p, r, f1, ap, ap_class = ap_per_class(*stats, plot=plots, save_dir=save_dir, names=names)
+    results = stats.result(plot=plots, save_dir=save_dir, names=names)
+    if results:
+        tp, fp, p, r, f1, ap, ap_class = results
         ap50, ap = ap[:, 0], ap.mean(1)  # AP@0.5, AP@0.5:0.95
         mp, mr, map50, map = p.mean(), r.mean(), ap50.mean(), ap.mean()
-    nt = np.bincount(stats[3].astype(int), minlength=nc)  # number of targets per class
+    nt = stats.nt  # number of targets per class
 
     # Print results
     pf = '%22s' + '%11i' * 2 + '%11.3g' * 4  # print format
@@ -284,7 +358,7 @@ def run(
         LOGGER.warning(f'WARNING ⚠️ no labels found in {task} set, can not compute metrics without labels')
 
     # Print results per class
-    if (verbose or (nc < 50 and not training)) and nc > 1 and len(stats):
+    if (verbose or (nc < 50 and not training)) and nc > 1 and results:
         for i, c in enumerate(ap_class):
             LOGGER.info(pf % (names[c], seen, nt[c], p[i], r[i], ap50[i], ap[i]))
 
@@ -292,7 +366,11 @@ def run(
     t = tuple(x.t / seen * 1E3 for x in dt)  # speeds per image
     if not training:
         shape = (batch_size, 3, imgsz, imgsz)
-        LOGGER.info(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per image at shape {shape}' % t)
+        if parallel:  # processes overlap, report summed process time and wall-clock time separately
+            LOGGER.info(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per image at shape {shape}, summed '
+                        f'over {shards} processes, {wall.t / seen * 1E3:.1f}ms wall-clock per image' % t)
+        else:
+            LOGGER.info(f'Speed: %.1fms pre-process, %.1fms inference, %.1fms NMS per image at shape {shape}' % t)
 
     # Plots
     if plots:
@@ -304,31 +382,50 @@ def run(
         w = Path(weights[0] if isinstance(weights, list) else weights).stem if weights is not None else ''  # weights
         anno_json = str(Path(data.get('path', '../coco')) / 'annotations/instances_val2017.json')  # annotations json
         pred_json = str(save_dir / f"{w}_predictions.json")  # predictions json
-        LOGGER.info(f'\nEvaluating pycocotools mAP... saving {pred_json}...')
+        LOGGER.info(f'\nEvaluating {"COCO" if native_coco else "pycocotools"} mAP... saving {pred_json}...')
         with open(pred_json, 'w') as f:
             json.dump(jdict, f)
-
-        try:  # https://github.com/cocodataset/cocoapi/blob/master/PythonAPI/pycocoEvalDemo.ipynb
-            check_requirements('pycocotools')
-            from pycocotools.coco import COCO
-            from pycocotools.cocoeval import COCOeval
-
-            anno = COCO(anno_json)  # init annotations api
-            pred = anno.loadRes(pred_json)  # init predictions api
-            eval = COCOeval(anno, pred, 'bbox')
-            if is_coco:
-                eval.params.imgIds = [int(Path(x).stem) for x in dataloader.dataset.im_files]  # image IDs to evaluate
-            eval.evaluate()
-            eval.accumulate()
-            eval.summarize()
-            map, map50 = eval.stats[:2]  # update results (mAP@0.5:0.95, mAP@0.5)
-        except Exception as e:
-            LOGGER.info(f'pycocotools unable to run: {e}')
+        img_ids = [int(Path(x).stem) for x in dataloader.dataset.im_files] if is_coco else None  # image IDs to evaluate
+
+        if native_coco:
+            try:
+                with open(anno_json) as f:
+                    anno = json.load(f)
+                eval = COCOEvaluator(anno, img_ids)
+                eval.evaluate(jdict)
+                eval.summarize()
+                map, map50 = eval.stats[:2]  # update results (mAP@0.5:0.95, mAP@0.5)
+            except Exception as e:
+                LOGGER.info(f'COCO evaluation unable to run: {e}')
+        else:
+            try:  # https://github.com/cocodataset/cocoapi/blob/master/PythonAPI/pycocoEvalDemo.ipynb
+                check_requirements('pycocotools')
+                from pycocotools.coco import COCO
+                from pycocotools.cocoeval import COCOeval
+
+                anno = COCO(anno_json)  # init annotations api
+                pred = anno.loadRes(pred_json)  # init predictions api
+                eval = COCOeval(anno, pred, 'bbox')
+                if is_coco:
+                    eval.params.imgIds = img_ids
+                eval.evaluate()
+                eval.accumulate()
+                eval.summarize()
+                map, map50 = eval.stats[:2]  # update results (mAP@0.5:0.95, mAP@0.5)
+            except Exception as e:
+                LOGGER.info(f'pycocotools unable to run: {e}')
 
     # Return results
     model.float()  # for training
+    if label_writer:
+        label_writer.close()  # flush buffered labels
+    if det_writer:
+        det_writer.close()  # flush last row group
+    if saved is not None:
+        saved.close()
     if not training:
         s = f"\n{len(list(save_dir.glob('labels/*.txt')))} labels saved to {save_dir / 'labels'}" if save_txt else ''
+        s = f'\nlabels saved to {save_txt_file}' if save_txt and save_txt_file else s
         LOGGER.info(f"Results saved to {colorstr('bold', save_dir)}{s}")
     maps = np.zeros(nc) + map
     for i, c in enumerate(ap_class):
@@ -336,6 +433,12 @@ def run(
     return (mp, mr, map50, map, *(loss.cpu() / len(dataloader)).tolist()), maps, t
 
 
+def run_shard(i, args, files):
+    # Validate shard i of a --shards run in a spawned process, save its raw metric state to files[i]
+    torch.set_num_threads(max(os.cpu_count() // args['shards'], 1))  # share CPU cores between processes
+    torch.save(run(**dict(args, shard=i)), files[i])
+
+
 def parse_opt():
     parser = argparse.ArgumentParser()
     parser.add_argument('--data', type=str, default=ROOT / 'data/coco128.yaml', help='dataset.yaml path')
@@ -345,6 +448,8 @@ def parse_opt():
     parser.add_argument('--conf-thres', type=float, default=0.001, help='confidence threshold')
     parser.add_argument('--iou-thres', type=float, default=0.6, help='NMS IoU threshold')
     parser.add_argument('--max-det', type=int, default=300, help='maximum detections per image')
+    parser.add_argument('--batched-nms', action='store_true', help='run one NMS call per batch instead of per image')
+    parser.add_argument('--nms', default='hard', choices=NMS_METHODS, help='NMS method')
     parser.add_argument('--task', default='val', help='train, val, test, speed or study')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     parser.add_argument('--workers', type=int, default=8, help='max dataloader workers (per RANK in DDP mode)')
@@ -354,7 +459,15 @@ def parse_opt():
     parser.add_argument('--save-txt', action='store_true', help='save results to *.txt')
     parser.add_argument('--save-hybrid', action='store_true', help='save label+prediction hybrid results to *.txt')
     parser.add_argument('--save-conf', action='store_true', help='save confidences in --save-txt labels')
+    parser.add_argument('--save-txt-file', type=str, default=None, help='append --save-txt labels to one file')
+    parser.add_argument('--save-txt-async', action='store_true', help='write --save-txt labels in a background thread')
+    parser.add_argument('--save-detections', choices=DETECTIONS_FORMATS, help='save detections to a columnar file')
+    parser.add_argument('--detections', type=str, default=None, help='evaluate a saved detections file, no inference')
+    parser.add_argument('--batch-metrics', action='store_true', help='compute metrics per batch on device')
+    parser.add_argument('--shards', type=int, default=1, help='validate in this many parallel processes')
+    parser.add_argument('--ap-bins', type=int, default=0, help='streaming mAP confidence bins, 0 for exact mAP')
     parser.add_argument('--save-json', action='store_true', help='save a COCO-JSON results file')
+    parser.add_argument('--native-coco', action='store_true', help='evaluate --save-json with native COCOEvaluator')
     parser.add_argument('--project', default=ROOT / 'runs/val', help='save to project/name')
     parser.add_argument('--name', default='exp', help='save to project/name')
     parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')